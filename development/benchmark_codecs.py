@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
+# Distributed under the terms of the 3-clause BSD License.
+#
+# Compare write and read throughput of step signatures stored with different
+# codecs. Usage:
+#
+#   python benchmark_codecs.py [-n NUM_SIGNATURES] [--codecs zlib lzma ...]
+#
+import argparse
+import os
+import pickle
+import tempfile
+import time
+
+from sos.compression import available_codecs, compress, decompress
+from sos.signatures import StepSignatures
+from sos.utils import env
+
+
+def make_signature(idx):
+    # a signature similar to the one produced by RuntimeInfo.write
+    # for a substep with a few input and output files
+    return {
+        'input': {
+            f'/path/to/project/data/sample_{idx}_R{x}.fastq.gz':
+            f'{idx:08x}{x:024x}' for x in range(2)
+        },
+        'output': {
+            f'/path/to/project/results/sample_{idx}.bam':
+            f'{idx:032x}'
+        },
+        'depends': {},
+        'vars': {
+            'sample': f'sample_{idx}',
+            'threads': 4,
+            'params': list(range(20))
+        },
+        'input_obj': [f'sample_{idx}_R1.fastq.gz', f'sample_{idx}_R2.fastq.gz'],
+        'output_obj': [f'sample_{idx}.bam'],
+        'depends_obj': [],
+        'init_signature': {},
+        'end_signature': {},
+    }
+
+
+def benchmark_codec(codec, signatures):
+    env.config['codec'] = codec
+    blobs = [pickle.dumps(x) for x in signatures]
+
+    start = time.perf_counter()
+    compressed = [compress(x) for x in blobs]
+    compress_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for x in compressed:
+        decompress(x)
+    decompress_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.makedirs(os.path.join(tmpdir, '.sos'))
+        env.exec_dir = tmpdir
+        db = StepSignatures()
+        start = time.perf_counter()
+        for idx, sig in enumerate(signatures):
+            db.set(f'{idx:016x}', sig, 'step')
+        db.commit()
+        write_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        db.get_by_step('step')
+        read_time = time.perf_counter() - start
+        db.close()
+
+    n = len(signatures)
+    print(f'{codec:>6} {sum(len(x) for x in compressed) / n:10.1f} '
+          f'{n / compress_time:12.0f} {n / decompress_time:12.0f} '
+          f'{n / write_time:12.0f} {n / read_time:12.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        'benchmark_codecs',
+        description='''Compare throughput of codecs used to compress step
+            signatures and task files''')
+    parser.add_argument(
+        '-n',
+        type=int,
+        default=10000,
+        help='Number of signatures, default to 10000')
+    parser.add_argument(
+        '--codecs',
+        nargs='+',
+        default=available_codecs(),
+        help='Codecs to benchmark, default to all available codecs')
+    args = parser.parse_args()
+
+    signatures = [make_signature(x) for x in range(args.n)]
+    raw_size = sum(len(pickle.dumps(x)) for x in signatures) / args.n
+    print(f'{args.n} signatures, average pickled size {raw_size:.1f} bytes')
+    print(f'{"codec":>6} {"avg size":>10} {"compress/s":>12} '
+          f'{"decompress/s":>12} {"db write/s":>12} {"db read/s":>12}')
+    for codec in args.codecs:
+        benchmark_codec(codec, signatures)
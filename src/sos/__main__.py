@@ -8,7 +8,8 @@ import ast
 import os
 import sys
 import datetime
-import pkg_resources
+
+from .entrypoints import get_entry_points
 
 script_help = '''A SoS script that defines one or more workflows, in format
     .sos or .ipynb. The script can be a filename or a URL from which the
@@ -48,7 +49,7 @@ transcript_help = '''Name of a file that records the execution transcript of
 #         return parser
 #     parser.set_defaults(func=cmd_install)
 #     subparsers = parser.add_subparsers(title='installers', dest='installer_name')
-#     for entrypoint in pkg_resources.iter_entry_points(group='sos_installers'):
+#     for entrypoint in get_entry_points('sos_installers'):
 #         try:
 #             name = entrypoint.name
 #             if not name.endswith('.parser'):
@@ -62,7 +63,7 @@ transcript_help = '''Name of a file that records the execution transcript of
 #
 # def cmd_install(args, unknown_args):
 #     from .utils import env, get_traceback
-#     for entrypoint in pkg_resources.iter_entry_points(group='sos_installers'):
+#     for entrypoint in get_entry_points('sos_installers'):
 #         try:
 #             if entrypoint.name == args.installer_name + '.func':
 #                 func = entrypoint.load()
@@ -107,7 +108,7 @@ def get_convert_parser(desc_only=False):
     subparsers = parser.add_subparsers(
         title='converters (name of converter is not needed from command line)',
         dest='converter_name')
-    for entrypoint in pkg_resources.iter_entry_points(group='sos_converters'):
+    for entrypoint in get_entry_points('sos_converters'):
         try:
             name = entrypoint.name
             if name.endswith('.parser'):
@@ -187,7 +188,7 @@ def print_converter_help():
         [x for x in sys.argv[2:] if x != '-h'])
     if from_format is None or to_format is None:
         return
-    for entrypoint in pkg_resources.iter_entry_points(group='sos_converters'):
+    for entrypoint in get_entry_points('sos_converters'):
         try:
             name = entrypoint.name
             if name.endswith('.parser'):
@@ -223,7 +224,7 @@ def print_converter_help():
 
 def cmd_convert(args, unknown_args):
     from .utils import env, get_traceback
-    for entrypoint in pkg_resources.iter_entry_points(group='sos_converters'):
+    for entrypoint in get_entry_points('sos_converters'):
         try:
             if entrypoint.name == args.converter_name:
                 converter = entrypoint.load()()
@@ -775,6 +776,11 @@ def get_worker_parser(desc_only=False):
     if desc_only:
         return parser
     parser.add_argument('-r', '--router', help='''Port of the router''')
+    parser.add_argument(
+        '--master_push', help='''Address to which workers push messages''')
+    parser.add_argument(
+        '--master_request',
+        help='''Address from which workers request information''')
     parser.add_argument(
         '-j',
         type=int,
@@ -792,6 +798,23 @@ def get_worker_parser(desc_only=False):
     parser.add_argument('--sig_mode', help='signature mode')
     parser.add_argument('--run_mode', help='run mode')
     parser.add_argument('--workdir', help='work directory')
+    parser.add_argument(
+        '--heartbeat',
+        type=float,
+        help='''Interval in seconds at which workers tell the router that
+            they are alive''')
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help='''Start a persistent worker daemon for the project in the
+            current (or --workdir) directory. sos processes executed in the
+            project with option worker_daemon=True in their configuration
+            will ask the daemon to start workers instead of starting workers
+            by themselves.''')
+    parser.add_argument(
+        '--stop',
+        action='store_true',
+        help='''Stop the worker daemon of the project.''')
     parser.add_argument(
         '-v',
         '--verbosity',
@@ -811,16 +834,20 @@ def cmd_worker(args, workflow_args):
     from .utils import env, load_config_files
     import pickle
     env.verbosity = args.verbosity
-    env.config = {
+    # keep default values of options such as msg_compress_size
+    env.config.update({
         'config_file': args.config,
         'sig_mode': args.sig_mode,
         'run_mode': args.run_mode,
         'sockets': {
-            'worker_backend': args.router
+            'worker_backend': args.router,
+            'master_push': args.master_push,
+            'master_request': args.master_request
         },
         'SOS_DEBUG': [],
-        'exec_mode': None
-    }
+        'exec_mode': None,
+        'worker_heartbeat_interval': args.heartbeat
+    })
     if args.env:
         try:
             with open(args.env, 'rb') as envfile:
@@ -828,11 +855,27 @@ def cmd_worker(args, workflow_args):
         except Exception as e:
             env.logger.warning(f'Failed to load environment variables: {e}')
 
-    try:
-        os.chdir(args.workdir)
-    except Exception:
-        env.logger.warning(
-            f'Failed to change directory to workdir {args.workdir}')
+    if args.workdir or not (args.daemon or args.stop):
+        try:
+            os.chdir(args.workdir)
+        except Exception:
+            env.logger.warning(
+                f'Failed to change directory to workdir {args.workdir}')
+    if args.daemon or args.stop:
+        env.exec_dir = os.getcwd()
+        try:
+            from .workers import WorkerDaemon, request_worker_daemon
+            if args.stop:
+                if request_worker_daemon(['stop']) is None:
+                    env.logger.warning('No worker daemon is running.')
+                else:
+                    env.logger.info('Worker daemon stopped.')
+            else:
+                WorkerDaemon().run()
+        except Exception as e:
+            env.logger.error(str(e))
+            sys.exit(1)
+        return
     load_config_files(args.config)
     try:
         from .workers import SoS_Worker
@@ -1318,8 +1361,7 @@ def cmd_execute(args, workflow_args):
             executor = BaseTaskExecutor()
         else:
             found = False
-            for entrypoint in pkg_resources.iter_entry_points(
-                    group='sos_taskexecutors'):
+            for entrypoint in get_entry_points('sos_taskexecutors'):
                 name = entrypoint.name.strip()
                 if name == args.executor:
                     try:
@@ -1875,10 +1917,10 @@ def cmd_remove(args, unknown_args):
             env.logger.info('No remaining placeholder file exists.')
         return
 
-    sig_files = workflow_signatures.files()
     if args.signature:
         # a special case where all file and runtime signatures are removed.
         # no other options are allowed.
+        sig_files = workflow_signatures.files()
         if sig_files:
             sig_ids = list(set([x[0] for x in sig_files]))
             step_signatures = StepSignatures()
@@ -1897,8 +1939,7 @@ def cmd_remove(args, unknown_args):
             )
         return
     #
-    tracked_files = list(
-        set(sum([sum(x[1].values(), []) for x in sig_files], [])))
+    tracked_files = workflow_signatures.tracked_paths()
     if tracked_files:
         env.logger.info(f'{len(tracked_files)} tracked files are identified.')
     else:
@@ -2081,6 +2122,136 @@ def cmd_remove(args, unknown_args):
         's' if removed > 1 else '', 'zapped' if args.zap else 'removed'))
 
 
+#
+# subcommand gc
+#
+
+
+def get_gc_parser(desc_only=False):
+    parser = argparse.ArgumentParser(
+        'gc',
+        description='''Remove signatures of files that no longer exist or
+            that are older than specified age from the .sos directory of the
+            current project, and compact signature databases.''')
+    parser.short_description = '''Remove obsolete signatures and compact signature
+        databases'''
+    if desc_only:
+        return parser
+    parser.add_argument(
+        '--age',
+        help='''Also remove signatures saved more than specified age ago.
+        Value of this parameter can be in units s (second), m (minute),
+        h (hour), or d (day, default), or in the format of HH:MM:SS.''')
+    parser.add_argument(
+        '-n',
+        '--dryrun',
+        action='store_true',
+        help='''Report signatures that would be removed, without actually
+            removing them or compacting the databases.''')
+    parser.add_argument(
+        '-v',
+        '--verbosity',
+        type=int,
+        choices=range(5),
+        default=2,
+        help='''Output error (0), warning (1), info (2) and debug (3)
+            information to standard output (default to 2). More debug information could be
+            generated by setting environmental variable SOS_DEBUG to comma separated topics
+            of GENERAL, WORKER, CONTROLLER, STEP, VARIABLE, EXECUTOR, TARGET, ZERONQ, TASK,
+            DAG, and ACTION, or ALL for all debug information''')
+    parser.set_defaults(func=cmd_gc)
+    return parser
+
+
+def _sos_dir_size(sos_dir):
+    size = 0
+    for item in os.scandir(sos_dir):
+        if item.is_file(follow_symlinks=False):
+            size += item.stat().st_size
+    return size
+
+
+def cmd_gc(args, unknown_args):
+    import glob
+    import time
+    from .utils import env, expand_time, pretty_size
+    from .targets import textMD5
+    from .signatures import (StepSignatures, WorkflowSignatures,
+                             get_file_hash_cache)
+
+    env.verbosity = args.verbosity
+
+    sos_dir = os.path.join(env.exec_dir, '.sos')
+    if not os.path.isdir(sos_dir):
+        env.logger.info('No signature is saved under the current directory.')
+        return
+
+    start_time = time.time()
+    size_before = _sos_dir_size(sos_dir)
+    cutoff = time.time() - expand_time(
+        args.age, default_unit='d') if args.age else None
+
+    workflow_signatures = WorkflowSignatures()
+    step_signatures = StepSignatures()
+    # signatures with tracked files that no longer exist (and are not zapped)
+    # cannot be validated
+    exists = {}
+    missing_files = set()
+    obsolete_sigs = set()
+    for sig_id, files in workflow_signatures.files():
+        for filename in sum(files.values(), []):
+            if filename not in exists:
+                exists[filename] = os.path.exists(filename) or os.path.exists(
+                    filename + '.zapped')
+            if not exists[filename]:
+                missing_files.add(filename)
+                obsolete_sigs.add(sig_id)
+    if cutoff is not None:
+        obsolete_sigs |= set(step_signatures.ids(before=cutoff))
+    # file signatures are named after md5 of the path of files
+    obsolete_file_info = [
+        os.path.join(sos_dir, f'{textMD5(x)}.file_info')
+        for x in missing_files
+    ]
+    if cutoff is not None:
+        obsolete_file_info.extend([
+            x for x in glob.glob(os.path.join(sos_dir, '*.file_info'))
+            if os.path.getmtime(x) < cutoff
+        ])
+    obsolete_file_info = {x for x in obsolete_file_info if os.path.isfile(x)}
+
+    if args.dryrun:
+        env.logger.info(
+            f'Would remove {len(obsolete_sigs)} step signatures and {len(obsolete_file_info)} file signatures.'
+        )
+        step_signatures.close()
+        workflow_signatures.close()
+        return
+
+    num_removed_steps = step_signatures.remove_many(list(obsolete_sigs))
+    workflow_signatures.remove_files(list(obsolete_sigs))
+    num_removed_records = workflow_signatures.remove_before(
+        cutoff) if cutoff is not None else 0
+    for filename in obsolete_file_info:
+        try:
+            os.remove(filename)
+        except Exception as e:
+            env.logger.debug(f'Failed to remove {filename}: {e}')
+    hash_cache = get_file_hash_cache()
+    num_removed_hashes = hash_cache.remove_missing()
+
+    for db in (step_signatures, workflow_signatures, hash_cache):
+        db.vacuum()
+        db.close()
+
+    reclaimed = max(size_before - _sos_dir_size(sos_dir), 0)
+    env.logger.info(
+        f'{num_removed_steps} step signatures, {len(obsolete_file_info)} file signatures, '
+        f'{num_removed_records} workflow records and {num_removed_hashes} cached file hashes are removed. '
+        f'{pretty_size(reclaimed)} reclaimed in {time.time() - start_time:.1f} seconds.'
+    )
+
+
 #
 # subcommand config
 #
@@ -2329,7 +2500,7 @@ def cmd_config(args, workflow_args):
 # Handling addon commands
 #
 def handle_addon(args, unknown_args):
-    for entrypoint in pkg_resources.iter_entry_points(group='sos_addons'):
+    for entrypoint in get_entry_points('sos_addons'):
         name = entrypoint.name.strip()
         if name.endswith('.func') and name.rsplit('.', 1)[0] == args.addon_name:
             func = entrypoint.load()
@@ -2405,7 +2576,7 @@ def main():
             version='%(prog)s {}'.format(SOS_FULL_VERSION))
         subparsers = master_parser.add_subparsers(
             title='subcommands',
-            metavar='{install,run,dryrun,status,push,pull,execute,kill,purge,config,convert,remove}'
+            metavar='{install,run,dryrun,status,push,pull,execute,kill,purge,config,convert,remove,gc}'
         )
 
         # command install
@@ -2465,13 +2636,16 @@ def main():
         add_sub_parser(subparsers,
                        get_remove_parser(desc_only='remove' != subcommand))
         #
+        # command gc
+        add_sub_parser(subparsers,
+                       get_gc_parser(desc_only='gc' != subcommand))
+        #
         # addon packages
         if subcommand is None or subcommand not in [
                 'install', 'run', 'dryrun', 'convert', 'push', 'pull', 'remove',
-                'config'
+                'gc', 'config'
         ]:
-            for entrypoint in pkg_resources.iter_entry_points(
-                    group='sos_addons'):
+            for entrypoint in get_entry_points('sos_addons'):
                 name = entrypoint.name
                 addon = entrypoint.load()()
                 if not hasattr(addon, 'get_parser'):
@@ -2520,6 +2694,12 @@ def main():
             sys.exit(0)
         # calling the associated functions
         args.func(args, workflow_args)
+        from .entrypoints import timing_report
+        from .utils import env
+        env.log_to_file(
+            'GENERAL',
+            f'Time spent on discovering and loading entry points:\n{timing_report()}'
+        )
     except KeyboardInterrupt:
         sys.exit('KeyboardInterrupt')
     except Exception as e:
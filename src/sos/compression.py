@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
+# Distributed under the terms of the 3-clause BSD License.
+'''
+Compression of signatures and task files.
+
+Compressed blocks start with a two-byte header with the version of the
+format and the codec used to compress the rest of the block. Blocks written
+by earlier versions of SoS are raw lzma (xz) streams and are recognized by
+the xz magic number.
+'''
+
+import lzma
+import pickle
+import zlib
+
+from .utils import env
+
+_FORMAT_VERSION = 1
+_XZ_MAGIC = b'\xfd7zXZ\x00'
+
+# codec name -> (codec id, compress function, decompress function)
+_codecs = {
+    'none': (0, lambda x: x, lambda x: x),
+    'zlib': (1, lambda x: zlib.compress(x, 1), zlib.decompress),
+    'lzma': (3, lzma.compress, lzma.decompress),
+}
+
+try:
+    import zstandard
+
+    _codecs['zstd'] = (2, lambda x: zstandard.ZstdCompressor().compress(x),
+                       lambda x: zstandard.ZstdDecompressor().decompress(x))
+except ImportError:
+    pass
+
+_codec_by_id = {v[0]: k for k, v in _codecs.items()}
+
+# unavailable codecs that have been reported
+_unavailable = set()
+
+
+def available_codecs():
+    return list(_codecs.keys())
+
+
+def _get_codec(codec):
+    if not codec:
+        codec = env.config['codec'] or 'zlib'
+    if codec not in _codecs:
+        if codec not in _unavailable:
+            _unavailable.add(codec)
+            env.logger.warning(
+                f'Codec {codec} is not available, use zlib instead. Available codecs are {", ".join(available_codecs())}.'
+            )
+        codec = 'zlib'
+    return codec
+
+
+def compress(data: bytes, codec: str = None) -> bytes:
+    '''Compress data with specified codec, or codec specified by option
+    codec in the config file (default to zlib).'''
+    codec = _get_codec(codec)
+    codec_id, compressor, _ = _codecs[codec]
+    return bytes((_FORMAT_VERSION, codec_id)) + compressor(data)
+
+
+def decompress(blob: bytes) -> bytes:
+    if blob.startswith(_XZ_MAGIC):
+        # blocks written by previous versions of sos
+        return lzma.decompress(blob)
+    if len(blob) < 2 or blob[0] != _FORMAT_VERSION:
+        raise ValueError('Unrecognized compressed block')
+    if blob[1] not in _codec_by_id:
+        raise ValueError(
+            f'Block compressed with an unsupported codec (id {blob[1]}). zstandard might need to be installed.'
+        )
+    return _codecs[_codec_by_id[blob[1]]][2](blob[2:])
+
+
+# blocks are saved to signature databases and task files that can be read
+# by other versions of Python, so the pickle protocol is pinned to the
+# highest protocol supported by Python 3.6
+_PICKLE_PROTOCOL = 4
+
+
+def dumps(obj, codec: str = None) -> bytes:
+    '''Pickle and compress obj'''
+    return compress(pickle.dumps(obj, _PICKLE_PROTOCOL), codec)
+
+
+def loads(blob: bytes):
+    '''Decompress and unpickle blob created by dumps or by lzma.compress
+    of pickled objects'''
+    return pickle.loads(decompress(blob))
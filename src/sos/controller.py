@@ -3,14 +3,19 @@
 # Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
 # Distributed under the terms of the 3-clause BSD License.
 import os
+import shutil
+import socket as _socket
 import sys
+import tempfile
 import zmq
 import time
 import threading
 from collections import defaultdict
+from itertools import count
 from .utils import env, ProcessKilled, get_localhost_ip
 from .signatures import StepSignatures, WorkflowSignatures
-from .messages import encode_msg, decode_msg
+from .messages import encode_msg, decode_msg, message_stats
+from .metrics import ControllerMetrics
 
 EVENT_MAP = {}
 for name in ('PUSH', 'PULL', 'PAIR', 'REQ', 'REP'):
@@ -47,6 +52,88 @@ def close_socket(socket, desc='', now=False):
     return socket
 
 
+# number of ipc addresses created by the process
+_ipc_count = count()
+
+
+def use_ipc_transport():
+    '''Test if sockets can be bound to ipc addresses, which is the case if
+    ipc is supported and all workers are on the local host'''
+    if env.config.get('transport', 'ipc') != 'ipc' or not zmq.has('ipc'):
+        return False
+    local_hosts = ('localhost', '127.0.0.1', _socket.gethostname(),
+                   get_localhost_ip())
+    # workers on remote hosts, specified with -j host:n, connect to tcp ports
+    for worker_proc in env.config.get('worker_procs', None) or []:
+        host = worker_proc.rsplit(':', 1)[0] if ':' in worker_proc else worker_proc
+        if not host.isdigit() and host not in local_hosts:
+            return False
+    return True
+
+
+def bind_to_random_address(socket):
+    '''Bind socket to a random ipc address if the controller uses ipc
+    transport, or to a random port of the local ip otherwise. Return the
+    address to which other processes can connect.'''
+    ipc_dir = env.config.get('sockets', {}).get('ipc_dir', None)
+    if ipc_dir:
+        address = f'ipc://{ipc_dir}/{os.getpid()}_{next(_ipc_count)}'
+        socket.bind(address)
+        return address
+    local_ip = get_localhost_ip()
+    port = socket.bind_to_random_port(f'tcp://{local_ip}')
+    return f'tcp://{local_ip}:{port}'
+
+
+# sockets released by steps that can be reused by later steps of the same
+# process, (pid, id of context, socket type, ipc dir) -> [(socket, address)]
+_socket_pool = defaultdict(list)
+
+
+def _pool_key(context, socket_type):
+    return (os.getpid(), id(context), socket_type,
+            env.config['sockets'].get('ipc_dir', None))
+
+
+def create_bound_socket(context, socket_type, desc=''):
+    '''Return a socket bound to a random address and the address, reusing a
+    socket released by release_bound_socket if possible.'''
+    pool = _socket_pool[_pool_key(context, socket_type)]
+    if pool:
+        return pool.pop()
+    socket = create_socket(context, socket_type, desc)
+    return socket, bind_to_random_address(socket)
+
+
+def release_bound_socket(context,
+                         socket_type,
+                         socket,
+                         address,
+                         desc='',
+                         reusable=True):
+    '''Keep a socket created by create_bound_socket for later use, or close
+    it if it is not reusable, e.g. if it might still receive messages.
+    Messages that have been received by the socket are discarded, and users
+    of reused sockets should ignore messages that arrive late.'''
+    if reusable:
+        while socket.poll(0):
+            socket.recv()
+        _socket_pool[_pool_key(context, socket_type)].append((socket, address))
+    else:
+        close_socket(socket, desc)
+
+
+def close_bound_sockets(context):
+    '''Close sockets of context that are kept for reuse'''
+    for key in list(_socket_pool.keys()):
+        if key[0] != os.getpid():
+            # sockets copied from the parent process
+            _socket_pool.pop(key)
+        elif key[1] == id(context):
+            for socket, address in _socket_pool.pop(key):
+                close_socket(socket, now=True)
+
+
 def zmq_term(context):
     #
     # the following is only valid when multiprocessing is started with the spawn method
@@ -124,6 +211,7 @@ def disconnect_controllers(context=None):
                         f'Disconnecting sockets from {os.getpid()}')
 
     if context:
+        close_bound_sockets(context)
         if 'CONTROLLER' in env.config['SOS_DEBUG'] or 'ALL' in env.config[
                 'SOS_DEBUG']:
             env.log_to_file('CONTROLLER', f'terminate context at {os.getpid()}')
@@ -145,8 +233,9 @@ class DotProgressBar:
         # broker to handle the execution of substeps
         self.progress_push_socket = create_socket(self.context, zmq.PUSH,
                                                   'progress push')
-        self.progress_port = self.progress_push_socket.bind_to_random_port(
-            'tcp://127.0.0.1')
+        # the progress bar is in the same process
+        self.progress_address = f'inproc://progress_{id(self)}'
+        self.progress_push_socket.bind(self.progress_address)
 
         self.thread = threading.Thread(target=self.run)
         self.thread.start()
@@ -154,7 +243,7 @@ class DotProgressBar:
     def run(self):
         progress_pull_socket = create_socket(self.context, zmq.PULL,
                                              'progress pull')
-        progress_pull_socket.connect(f'tcp://127.0.0.1:{self.progress_port}')
+        progress_pull_socket.connect(self.progress_address)
 
         # leading progress bar
         sys.stderr.write('\033[32m[\033[0m')
@@ -252,9 +341,16 @@ class Controller(threading.Thread):
         # completed steps
         self._completed_steps = {}
 
+        # id -> [context shared by substeps of steps, number of steps using
+        # the context], contexts are removed when no step uses them
+        self._substep_contexts = {}
+
         # substep workers
         self.workers = None
 
+        # throughput statistics
+        self.metrics = None
+
         # available resources
         self._resources = {}
 
@@ -268,8 +364,25 @@ class Controller(threading.Thread):
     def handle_master_push_msg(self, msg):
         try:
             if msg[0] in ('substep', 'step', 'workflow', 'task'):
-                # cache the request, route to first available worker
-                self.workers.add_request(msg[0], msg[1])
+                # cache the request, route to first available worker. The
+                # context of substeps tells the resources they need
+                self.workers.add_request(
+                    msg[0], msg[1],
+                    self._substep_contexts.get(msg[1].get('context', None),
+                                               [None])[0]
+                    if msg[0] == 'substep' else None)
+            elif msg[0] == 'substep_context':
+                if msg[1] in self._substep_contexts:
+                    self._substep_contexts[msg[1]][1] += 1
+                else:
+                    self._substep_contexts[msg[1]] = [msg[2], 1]
+            elif msg[0] == 'release_substep_contexts':
+                for context_id in msg[1]:
+                    if context_id not in self._substep_contexts:
+                        continue
+                    self._substep_contexts[context_id][1] -= 1
+                    if self._substep_contexts[context_id][1] <= 0:
+                        self._substep_contexts.pop(context_id)
             elif msg[0] == 'nprocs':
                 if 'CONTROLLER' in env.config[
                         'SOS_DEBUG'] or 'ALL' in env.config['SOS_DEBUG']:
@@ -292,8 +405,12 @@ class Controller(threading.Thread):
             elif msg[0] == 'step_sig':
                 self.step_signatures.set(*msg[1:])
             elif msg[0] == 'commit_sig':
-                self.workflow_signatures.commit()
-                self.step_signatures.commit()
+                # signatures are written by writer threads of the databases
+                # so there is no need to wait for the completion of writing.
+                # Records before and after the flush are written in separate
+                # transactions.
+                self.workflow_signatures.flush(wait=False)
+                self.step_signatures.flush(wait=False)
             elif msg[0] == 'resource':
                 if msg[1] == 'docker_image':
                     if msg[2] in ('available', 'unavailable'):
@@ -344,8 +461,15 @@ class Controller(threading.Thread):
                 if msg[1] == 'get':
                     self.master_request_socket.send(
                         encode_msg(self.step_signatures.get(*msg[2:])))
+                elif msg[1] == 'get_many':
+                    self.master_request_socket.send(
+                        encode_msg(self.step_signatures.get_many(msg[2])))
                 else:
                     env.logger.warning(f'Unknown signature request {msg}')
+            elif msg[0] == 'substep_context':
+                self.master_request_socket.send(
+                    encode_msg(
+                        self._substep_contexts.get(msg[1], [None])[0]))
             elif msg[0] == 'nprocs':
                 self.master_request_socket.send(encode_msg(self._nprocs))
             elif msg[0] == 'sos_step':
@@ -383,6 +507,9 @@ class Controller(threading.Thread):
             elif msg[0] == 'worker_available':
                 self.master_request_socket.send(
                     encode_msg(self.workers.worker_available(msg[1], msg[2:])))
+            elif msg[0] == 'lost_ports':
+                self.master_request_socket.send(
+                    encode_msg(self.workers.lost_ports(msg[1:])))
             elif msg[0] == 'resource':
                 if msg[1] == 'docker_image':
                     if msg[2] == 'request':
@@ -444,6 +571,11 @@ class Controller(threading.Thread):
                         f'{succ}{steps_text} ({completed_text}{", " if num_completed and num_ignored else ""}{ignored_text})'
                     )
 
+                # signatures should be available to other processes, or the
+                # next run of workflow, after sos completes
+                self.workflow_signatures.flush()
+                self.step_signatures.flush()
+
                 self.master_request_socket.send(encode_msg('bye'))
 
                 return False
@@ -454,9 +586,13 @@ class Controller(threading.Thread):
             env.logger.warning(f'Failed to respond controller {msg}: {e}')
             self.master_request_socket.send(encode_msg(None))
 
-    def handle_worker_backend_msg(self, msg):
-        # msg should be a port number from the worker
-        self.workers.process_request(msg[0], msg[1:])
+    def handle_worker_backend_msg(self, identity, msg):
+        # msg should be number of pending jobs and ports from the worker, or
+        # a heartbeat from a remote worker
+        if msg[0] == 'heartbeat':
+            self.workers.process_heartbeat(msg[1])
+        else:
+            self.workers.process_request(identity, msg[0], msg[1:])
 
     def handle_tapping_logging_msg(self, msg):
         if env.config['exec_mode'] == 'both':
@@ -493,7 +629,6 @@ class Controller(threading.Thread):
         # there are two sockets
         #
         self.context = zmq.Context.instance()
-        local_ip = get_localhost_ip()
 
         if 'CONTROLLER' in env.config['SOS_DEBUG'] or 'ALL' in env.config[
                 'SOS_DEBUG']:
@@ -502,32 +637,38 @@ class Controller(threading.Thread):
         if 'sockets' not in env.config:
             env.config['sockets'] = {}
 
+        # sockets of the controller, workers and executors are bound to ipc
+        # addresses under this directory if all workers are local.
+        if use_ipc_transport():
+            env.config['sockets']['ipc_dir'] = tempfile.mkdtemp(prefix='sos_')
+        else:
+            env.config['sockets'].pop('ipc_dir', None)
+        ipc_dir = env.config['sockets'].get('ipc_dir', None)
+
         self.master_push_socket = create_socket(self.context, zmq.PULL,
                                                 'controller master_pull')
-        master_push_port = self.master_push_socket.bind_to_random_port(
-            f'tcp://{local_ip}')
-        env.config['sockets'][
-            'master_push'] = f'tcp://{local_ip}:{master_push_port}'
+        env.config['sockets']['master_push'] = bind_to_random_address(
+            self.master_push_socket)
 
         self.master_request_socket = create_socket(self.context, zmq.REP,
                                                    'controller master_request')
-        master_request_port = self.master_request_socket.bind_to_random_port(
-            f'tcp://{local_ip}')
-        env.config['sockets'][
-            'master_request'] = f'tcp://{local_ip}:{master_request_port}'
+        env.config['sockets']['master_request'] = bind_to_random_address(
+            self.master_request_socket)
 
         # broker to handle the execution of substeps
         self.worker_backend_socket = create_socket(
-            self.context, zmq.REP, 'controller backend rep')  # ROUTER
+            self.context, zmq.ROUTER, 'controller backend router')
+        # report an error if a job is sent to a worker that is gone
+        self.worker_backend_socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
         # we assume the router is always on local host, but we will use a non-localhost
         # IP so that others can connect to it.
-        worker_port = self.worker_backend_socket.bind_to_random_port(
-            f'tcp://{local_ip}')
-        env.config['sockets'][
-            'worker_backend'] = f'tcp://{local_ip}:{worker_port}'
+        env.config['sockets']['worker_backend'] = bind_to_random_address(
+            self.worker_backend_socket)
 
         # tapping
+        # tapping sockets are used by other programs such as sos-notebook
         if env.config['exec_mode'] == 'master':
+            local_ip = get_localhost_ip()
             self.tapping_logging_socket = create_socket(self.context, zmq.PULL)
             tapping_logging_port = self.tapping_logging_socket.bind_to_random_port(
                 f'tcp://{local_ip}')
@@ -561,6 +702,8 @@ class Controller(threading.Thread):
         from .workers import WorkerManager
         self.workers = WorkerManager(env.config['worker_procs'],
                                      self.worker_backend_socket)
+        self.metrics = ControllerMetrics()
+        self.metrics.start(self)
 
         # Process messages from receiver and controller
         poller = zmq.Poller()
@@ -578,36 +721,85 @@ class Controller(threading.Thread):
             # leading progress bar
             self._progress_bar = DotProgressBar(self.context)
 
+        # pid -> sentinel of local workers that have been registered to the
+        # poller. Sentinels are keyed by pids because file descriptors of
+        # sentinels of exited workers can be reused by new workers.
+        sentinels = {}
+        # pids of exited workers that have not been removed by check_workers
+        exited_pids = set()
+        # time to check workers after some of them exited
+        check_workers_time = None
         try:
             while True:
-
-                while True:
-                    socks = dict(poller.poll(1000))
-                    if socks:
-                        break
-                    # if the last worker has been pending for more than 5
-                    # seconds, kill it. It is also possible that some others are killed
-                    # by external process.
+                # workers can be started after each message
+                workers = self.workers.sentinels()
+                exited_pids &= set(workers)
+                for pid, sentinel in workers.items():
+                    if pid not in sentinels and pid not in exited_pids:
+                        poller.register(sentinel, zmq.POLLIN)
+                        sentinels[pid] = sentinel
+
+                # wake up for the next snapshot of metrics, retirement of
+                # idle workers, or check of workers
+                timeout = self.metrics.timeout()
+                reap_timeout = self.workers.reap_timeout()
+                if reap_timeout is not None:
+                    timeout = reap_timeout if timeout is None else min(
+                        timeout, reap_timeout)
+                # workers started by the worker daemon can only be checked
+                # by their pids
+                if check_workers_time is None and self.workers.has_daemon_workers(
+                ):
+                    check_workers_time = time.time() + 5
+                if check_workers_time is not None:
+                    wait_time = max(0,
+                                    (check_workers_time - time.time()) * 1000)
+                    timeout = wait_time if timeout is None else min(
+                        timeout, wait_time)
+                socks = dict(poller.poll(timeout))
+                exited = [x for x, y in sentinels.items() if y in socks]
+                if exited:
+                    # some workers have exited. The master terminates workers
+                    # before it stops the controller if it fails so we give
+                    # the master 5 seconds before checking the workers.
+                    for pid in exited:
+                        poller.unregister(sentinels.pop(pid))
+                        exited_pids.add(pid)
+                    if check_workers_time is None:
+                        check_workers_time = time.time() + 5
+                elif check_workers_time is not None and time.time(
+                ) >= check_workers_time:
+                    # workers could have been killed by external process
+                    check_workers_time = None
                     self.workers.check_workers()
 
                 if self.master_push_socket in socks:
                     while True:
                         if self.master_push_socket.poll(0):
-                            self.handle_master_push_msg(
-                                decode_msg(self.master_push_socket.recv()))
+                            msg = decode_msg(self.master_push_socket.recv())
+                            start_time = time.perf_counter()
+                            self.handle_master_push_msg(msg)
+                            self.metrics.record(
+                                'push', msg,
+                                time.perf_counter() - start_time)
                         else:
                             break
 
                 if self.master_request_socket in socks:
-                    if not self.handle_master_request_msg(
-                            decode_msg(self.master_request_socket.recv())):
+                    msg = decode_msg(self.master_request_socket.recv())
+                    start_time = time.perf_counter()
+                    if not self.handle_master_request_msg(msg):
                         break
+                    self.metrics.record('request', msg,
+                                        time.perf_counter() - start_time)
 
                 if self.worker_backend_socket in socks:
                     while True:
                         if self.worker_backend_socket.poll(0):
+                            identity, msg = self.worker_backend_socket.recv_multipart(
+                            )
                             self.handle_worker_backend_msg(
-                                decode_msg(self.worker_backend_socket.recv()))
+                                identity, decode_msg(msg))
                         else:
                             break
 
@@ -624,6 +816,9 @@ class Controller(threading.Thread):
                         self.handle_tapping_controller_msg(
                             decode_msg(self.tapping_controller_socket.recv()))
 
+                self.workers.reap_idle_workers()
+                self.metrics.update(self)
+
                 # if monitor_socket in socks:
                 #     evt = recv_monitor_message(monitor_socket)
                 #     if evt['event'] == zmq.EVENT_ACCEPTED:
@@ -637,6 +832,8 @@ class Controller(threading.Thread):
             sys.stderr.write(f'{env.config["exec_mode"]} get an error {e}')
             return
         finally:
+            # final snapshot of metrics before workers are killed
+            self.metrics.stop(self)
             # kill all workers
             self.workers.kill_all()
 
@@ -644,6 +841,9 @@ class Controller(threading.Thread):
             self.step_signatures.close()
             self.workflow_signatures.close()
 
+            env.log_to_file('CONTROLLER',
+                            f'Messages of controller\n{message_stats()}')
+
             poller.unregister(self.master_push_socket)
             poller.unregister(self.master_request_socket)
             poller.unregister(self.worker_backend_socket)
@@ -664,6 +864,9 @@ class Controller(threading.Thread):
             if env.config['exec_mode'] in ('master', 'slave'):
                 close_socket(self.tapping_controller_socket, now=True)
 
+            if ipc_dir:
+                shutil.rmtree(ipc_dir, ignore_errors=True)
+
             if 'CONTROLLER' in env.config['SOS_DEBUG'] or 'ALL' in env.config[
                     'SOS_DEBUG']:
                 env.log_to_file('CONTROLLER',
@@ -3,8 +3,12 @@
 # Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
 # Distributed under the terms of the 3-clause BSD License.
 import copy
+import heapq
+import os
 import pickle
-import time
+import queue
+import sys
+import threading
 from collections import defaultdict
 
 import fasteners
@@ -14,6 +18,27 @@ from .targets import (sos_step, sos_targets, sos_variable, textMD5, BaseTarget)
 from .utils import ActivityNotifier, env, short_repr
 
 from typing import Union
+
+
+def _wait_for_lock(lock_file, released):
+    '''Wait for a lock held by another process to be released and put
+    lock_file to queue released. The wait is blocked by the operating
+    system instead of trying the lock repeatedly if possible.'''
+    try:
+        if sys.platform == 'win32':
+            lock = fasteners.InterProcessLock(lock_file)
+            lock.acquire(blocking=True)
+            lock.release()
+        else:
+            import fcntl
+            with open(lock_file, 'a') as lock:
+                fcntl.lockf(lock, fcntl.LOCK_EX)
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+    except Exception as e:
+        env.logger.debug(f'Failed to wait for lock {lock_file}: {e}')
+    released.put(lock_file)
+
+
 #
 # DAG design:
 #
@@ -92,7 +117,10 @@ class SoS_Node(object):
         # env.logger.error('Note {}: Input: {} Depends: {} Output: {}'.format(self._node_id, self._input_targets,
         #      self._depends_targets,  self._output_targets))
         self._context = {} if context is None else copy.deepcopy(context)
-        self._status = None
+        # the DAG to which the node belongs, which is notified of changes
+        # of the status of the node
+        self._dag = None
+        self._node_status = None
         # unique ID to avoid add duplicate nodes ...
         self._node_uuid = textMD5(
             pickle.dumps((step_uuid, node_name, node_index, input_targets,
@@ -104,6 +132,17 @@ class SoS_Node(object):
     def __repr__(self):
         return self._node_id
 
+    def _get_status(self):
+        return self._node_status
+
+    def _set_status(self, status):
+        old_status = self._node_status
+        self._node_status = status
+        if self._dag is not None and old_status != status:
+            self._dag._update_status(self, old_status, status)
+
+    _status = property(_get_status, _set_status)
+
     def show(self):
         print(
             f'{self._node_id} ({self._node_index}, {self._status}): input {short_repr(self._input_targets)}, depends {short_repr(self._depends_targets)}, output {short_repr(self._output_targets)}, context {self._context}'
@@ -123,6 +162,23 @@ class SoS_DAG(nx.DiGraph):
         self._dirty = True
         # with error, stop probing
         self._degraded = False
+        # index of nodes, which is updated when nodes and edges are added
+        # and when the status of nodes changes, so that nodes can be
+        # located and scheduled without scanning the whole DAG
+        self._node_order = {}
+        self._nodes_by_uuid = {}
+        # status -> nodes with the status, in the order they enter the status
+        self._nodes_by_status = defaultdict(dict)
+        # number of predecessors of each node that are not completed
+        self._num_unmet = {}
+        # nodes without status and with all predecessors completed
+        self._ready = set()
+        # heap of (priority, order, node) of ready nodes, which might
+        # contain nodes that are no longer ready, and the scheduling mode
+        # with which the heap was built
+        self._ready_heap = []
+        self._ready_heap_mode = None
+        self._critical_path_lengths = {}
 
     def mark_dirty(self, dirty=True):
         self._dirty = dirty
@@ -142,6 +198,64 @@ class SoS_DAG(nx.DiGraph):
     def num_nodes(self):
         return nx.number_of_nodes(self)
 
+    def add_node(self, node, **attr):
+        if node not in self._node_order:
+            self._node_order[node] = len(self._node_order)
+            self._nodes_by_uuid[node._node_uuid] = node
+            self._nodes_by_status[node._status][node] = None
+            self._num_unmet[node] = 0
+            node._dag = self
+            # critical paths have to be recalculated
+            self._ready_heap_mode = None
+            if node._status is None:
+                self._add_ready(node)
+        nx.DiGraph.add_node(self, node, **attr)
+
+    def add_edge(self, u, v, **attr):
+        for node in (u, v):
+            if node not in self._node_order:
+                self.add_node(node)
+        if not self.has_edge(u, v):
+            self._ready_heap_mode = None
+            if u._status != 'completed':
+                self._num_unmet[v] += 1
+                self._ready.discard(v)
+        nx.DiGraph.add_edge(self, u, v, **attr)
+
+    def _add_ready(self, node):
+        self._ready.add(node)
+        if self._ready_heap_mode is not None:
+            heapq.heappush(self._ready_heap,
+                           (self._priority(node), self._node_order[node], node))
+
+    def _priority(self, node):
+        if self._ready_heap_mode == 'fifo':
+            return 0
+        # steps on the critical path of the DAG go first
+        return -self._critical_path_lengths.get(node, 0)
+
+    def _update_status(self, node, old_status, new_status):
+        self._nodes_by_status[old_status].pop(node, None)
+        self._nodes_by_status[new_status][node] = None
+        if old_status is None:
+            self._ready.discard(node)
+        elif new_status is None and self._num_unmet[node] == 0:
+            self._add_ready(node)
+        if 'completed' not in (old_status, new_status):
+            return
+        # nodes that depend on the node
+        for succ in self.successors(node):
+            if new_status == 'completed':
+                self._num_unmet[succ] -= 1
+                if self._num_unmet[succ] == 0 and succ._status is None:
+                    self._add_ready(succ)
+            else:
+                self._num_unmet[succ] += 1
+                self._ready.discard(succ)
+
+    def _nodes_with_status(self, status):
+        return sorted(self._nodes_by_status[status], key=self._node_order.get)
+
     def add_step(self,
                  step_uuid,
                  node_name,
@@ -156,7 +270,7 @@ class SoS_DAG(nx.DiGraph):
             step_uuid, node_name,
             None if node_index is None else self._forward_workflow_id,
             node_index, input_targets, depends_targets, output_targets, context)
-        if node._node_uuid in [x._node_uuid for x in self.nodes()]:
+        if node._node_uuid in self._nodes_by_uuid:
             return
         # adding a step would add a sos_step target to met the depends on sos_step
         # requirement of some steps.
@@ -194,45 +308,77 @@ class SoS_DAG(nx.DiGraph):
         and has no input dependency.'''
         if 'DAG' in env.config['SOS_DEBUG'] or 'ALL' in env.config['SOS_DEBUG']:
             env.log_to_file('DAG', 'find_executable')
-        for node in self.nodes():
-            # if it has not been executed
-            if node._status is None:
-                with_dependency = False
-                for edge in self.in_edges(node):
-                    if edge[0]._status != 'completed':
-                        with_dependency = True
-                        break
-                if not with_dependency:
-                    return node
+        if len(self._ready) == 1:
+            return next(iter(self._ready))
+        elif self._ready:
+            mode = 'fifo' if env.config[
+                'worker_scheduling'] == 'fifo' else 'priority'
+            if mode != self._ready_heap_mode:
+                self._build_ready_heap(mode)
+            # nodes that are no longer ready are removed lazily
+            while self._ready_heap[0][2] not in self._ready:
+                heapq.heappop(self._ready_heap)
+            return self._ready_heap[0][2]
         # if no node could be found, let use try pending ones
-        pending_jobs = [
-            x for x in self.nodes() if x._status == 'signature_pending'
-        ]
+        pending_jobs = self._nodes_with_status('signature_pending')
         if pending_jobs:
             try:
                 notifier = ActivityNotifier(
                     f'Waiting for {len(pending_jobs)} pending job{"s: e.g." if len(pending_jobs) > 1 else ":"} output {short_repr(pending_jobs[0]._signature[0])} with signature file {pending_jobs[0]._signature[1] + "_"}. You can manually remove this lock file if you are certain that no other process is working on the output.'
                 )
+                # locks are held by other processes, so threads wait for
+                # the locks and wake us up when any of them is released
+                nodes = {
+                    node._signature[1] + '_': node for node in pending_jobs
+                }
+                released = queue.Queue()
+                for lock_file in nodes:
+                    threading.Thread(
+                        target=_wait_for_lock,
+                        args=(lock_file, released),
+                        daemon=True).start()
                 while True:
-                    for node in pending_jobs:
-                        # if it has not been executed
-                        lock = fasteners.InterProcessLock(node._signature[1] +
-                                                          '_')
-                        if lock.acquire(blocking=False):
-                            lock.release()
-                            node._status = None
-                            return node
-                    time.sleep(0.1)
+                    try:
+                        lock_file = released.get(timeout=60)
+                    except queue.Empty:
+                        # lock files that are removed manually cannot be
+                        # released by their holders
+                        lock_file = next(
+                            (x for x in nodes if not os.path.exists(x)), None)
+                        if lock_file is None:
+                            continue
+                    nodes[lock_file]._status = None
+                    return nodes[lock_file]
             except Exception as e:
                 env.logger.error(str(e))
             finally:
                 notifier.stop()
         return None
 
+    def _build_ready_heap(self, mode):
+        self._ready_heap_mode = mode
+        if mode == 'priority':
+            try:
+                self._critical_path_lengths = self.critical_path_lengths()
+            except nx.NetworkXUnfeasible:
+                # circular dependencies, nodes are executed in order
+                self._critical_path_lengths = {}
+        self._ready_heap = [(self._priority(node), self._node_order[node], node)
+                            for node in self._ready]
+        heapq.heapify(self._ready_heap)
+
+    def critical_path_lengths(self):
+        '''Number of nodes on the longest path from each node to the end of
+        the DAG'''
+        lengths = {}
+        for node in reversed(list(nx.topological_sort(self))):
+            lengths[node] = 1 + max(
+                (lengths[x] for x in self.successors(node)), default=0)
+        return lengths
+
     def node_by_id(self, node_uuid):
-        for node in self.nodes():
-            if node._node_uuid == node_uuid:
-                return node
+        if node_uuid in self._nodes_by_uuid:
+            return self._nodes_by_uuid[node_uuid]
         raise RuntimeError(f'Failed to locate node with UUID {node_uuid}')
 
     def show_nodes(self):
@@ -256,11 +402,10 @@ class SoS_DAG(nx.DiGraph):
         return ''
 
     def pending(self):
-        return [x for x in self.nodes() if x._status == 'failed'
-               ], [x for x in self.nodes() if x._status is None]
+        return self._nodes_with_status('failed'), self._nodes_with_status(None)
 
     def running(self):
-        return [x for x in self.nodes() if x._status == 'running']
+        return self._nodes_with_status('running')
 
     def dangling(self, targets: sos_targets):
         '''returns
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
+# Distributed under the terms of the 3-clause BSD License.
+'''
+Discovery of actions, targets, previewers, task engines and other extensions
+registered as entry points of sos and third-party packages.
+
+Entry points of all sos groups are scanned once per process with
+importlib.metadata (or pkg_resources if importlib.metadata is unavailable),
+and are saved to ~/.sos/entry_points.cache together with a key derived from
+the distributions installed under sys.path, so that they are not scanned
+again until a distribution is installed, upgraded or removed. Set environment
+variable SOS_ENTRY_POINTS_CACHE to 0 to disable the disk cache.
+'''
+
+import hashlib
+import importlib
+import json
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+
+_cache_file = os.path.join(
+    os.path.expanduser('~'), '.sos', 'entry_points.cache')
+
+# group -> list of EntryPoint
+_entry_points = None
+# name of step -> time in seconds
+_timing = defaultdict(float)
+
+
+class EntryPoint(object):
+    '''A light-weight entry point with the same interface (name, value,
+    group and load()) as entry points of importlib.metadata'''
+
+    def __init__(self, name, value, group):
+        self.name = name
+        self.value = value
+        self.group = group
+        self._obj = None
+
+    def load(self):
+        if self._obj is not None:
+            return self._obj
+        start_time = time.time()
+        try:
+            # value has the format of module:attr.attr [extras]
+            module, _, attrs = self.value.split('[', 1)[0].strip().partition(
+                ':')
+            obj = importlib.import_module(module.strip())
+            for attr in attrs.strip().split('.') if attrs.strip() else []:
+                obj = getattr(obj, attr)
+        finally:
+            _timing[f'load {self.group}'] += time.time() - start_time
+        self._obj = obj
+        return obj
+
+    def __repr__(self):
+        return f'{self.name} = {self.value}'
+
+
+def _scan_entry_points():
+    '''Return (group, name, value) of entry points of all sos groups'''
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            from importlib_metadata import entry_points
+        except ImportError:
+            entry_points = None
+
+    if entry_points is not None:
+        eps = entry_points()
+        if hasattr(eps, 'groups'):
+            eps = {group: eps.select(group=group) for group in eps.groups}
+        return [(group, x.name, x.value)
+                for group, items in eps.items()
+                if group.startswith('sos')
+                for x in items]
+    else:
+        import pkg_resources
+        return [(group, x.name, x.module_name +
+                 (':' + '.'.join(x.attrs) if x.attrs else ''))
+                for dist in pkg_resources.working_set
+                for group, items in dist.get_entry_map().items()
+                if group.startswith('sos')
+                for x in items.values()]
+
+
+def _distributions_key():
+    '''A key that changes when distributions are installed, upgraded, or
+    removed from directories in sys.path'''
+    items = []
+    for path in sys.path:
+        if not os.path.isdir(path):
+            continue
+        try:
+            filenames = sorted(os.listdir(path))
+        except OSError:
+            continue
+        for filename in filenames:
+            if not filename.endswith(('.dist-info', '.egg-info', '.egg-link',
+                                      '.pth')):
+                continue
+            filename = os.path.join(path, filename)
+            if os.path.isdir(filename):
+                filename = os.path.join(filename, 'entry_points.txt')
+            try:
+                items.append(f'{filename} {os.stat(filename).st_mtime_ns}')
+            except OSError:
+                # no entry_points.txt
+                continue
+    return hashlib.md5('\n'.join(items).encode()).hexdigest()
+
+
+def _use_disk_cache():
+    return os.environ.get('SOS_ENTRY_POINTS_CACHE',
+                          '1').lower() not in ('0', 'false', 'no', 'off')
+
+
+def _load_entry_points():
+    global _entry_points
+    start_time = time.time()
+    key = _distributions_key() if _use_disk_cache() else None
+    _timing['distributions key'] += time.time() - start_time
+    records = None
+    if key is not None and os.path.isfile(_cache_file):
+        start_time = time.time()
+        try:
+            with open(_cache_file) as cache:
+                saved = json.load(cache)
+            if saved['key'] == key:
+                records = saved['entry_points']
+        except Exception:
+            # corrupted cache
+            records = None
+        _timing['read cache'] += time.time() - start_time
+    if records is None:
+        start_time = time.time()
+        records = _scan_entry_points()
+        _timing['scan entry points'] += time.time() - start_time
+        if key is not None:
+            try:
+                os.makedirs(os.path.dirname(_cache_file), exist_ok=True)
+                tmp_file = f'{_cache_file}.{os.getpid()}'
+                with open(tmp_file, 'w') as cache:
+                    json.dump({'key': key, 'entry_points': records}, cache)
+                os.replace(tmp_file, _cache_file)
+            except Exception:
+                # the cache is optional
+                pass
+    _entry_points = defaultdict(list)
+    for group, name, value in records:
+        # the same distribution can be found from multiple paths
+        if any(x.name == name and x.value == value
+               for x in _entry_points[group]):
+            continue
+        _entry_points[group].append(EntryPoint(name, value, group))
+
+
+def get_entry_points(group):
+    '''Return entry points of specified group'''
+    if _entry_points is None:
+        _load_entry_points()
+    return _entry_points.get(group, [])
+
+
+def get_entry_point(group, name):
+    '''Return the first entry point of specified group and name, or None if
+    no such entry point exists'''
+    for entrypoint in get_entry_points(group):
+        if entrypoint.name.strip() == name:
+            return entrypoint
+    return None
+
+
+def required_sos_version(entrypoint):
+    '''Return the minimal version of sos required by the distribution that
+    provides the entry point, or None if it cannot be determined. This is
+    only called for entry points that fail to load so distributions are not
+    cached.'''
+    try:
+        try:
+            from importlib.metadata import distributions
+        except ImportError:
+            from importlib_metadata import distributions
+    except ImportError:
+        import pkg_resources
+        for dist in pkg_resources.working_set:
+            if entrypoint.name not in dist.get_entry_map().get(
+                    entrypoint.group, {}):
+                continue
+            for req in dist.requires():
+                if req.project_name == 'sos':
+                    for op, ver in req.specs:
+                        if op == '>=':
+                            return ver
+            return None
+        return None
+
+    for dist in distributions():
+        try:
+            if not any(x.group == entrypoint.group and
+                       x.name == entrypoint.name and
+                       x.value == entrypoint.value
+                       for x in dist.entry_points):
+                continue
+            for req in dist.requires or []:
+                m = re.match(r'sos\s*(\(\s*)?>=\s*([^\s,;)]+)', req)
+                if m:
+                    return m.group(2)
+        except Exception:
+            continue
+        return None
+    return None
+
+
+def clear_entry_points():
+    '''Clear entry points cached in the current process and on disk'''
+    global _entry_points
+    _entry_points = None
+    if os.path.isfile(_cache_file):
+        os.remove(_cache_file)
+
+
+def timing_report():
+    '''Return time spent on the discovery and loading of entry points'''
+    return '\n'.join(
+        f'{step:<30} {secs * 1000:10.2f} ms' for step, secs in _timing.items())
@@ -390,11 +390,19 @@ def reevaluate_output():
     return sos_targets(*args, **kwargs, _verify_existence=True)
 
 
-def validate_step_sig(sig):
+def validate_step_sig(sig, signatures=None):
+    '''Validate signature sig. If a dictionary of signatures prefetched from
+    the controller is provided, the saved signature will be looked up from it
+    before it is requested from the controller. Prefetched signatures that
+    do not exist are saved as None so they are not requested again.'''
+    if signatures and sig.sig_id in signatures:
+        saved_sig = signatures[sig.sig_id] or {}
+    else:
+        saved_sig = None
     if env.config['sig_mode'] in ('default', 'skip', 'distributed'):
         # if users use sos_run, the "scope" of the step goes beyong names in this step
         # so we cannot save signatures for it.
-        matched = sig.validate()
+        matched = sig.validate(saved_sig)
         if isinstance(matched, dict):
             env.logger.info(
                 f'``{env.sos_dict["step_name"]}`` (index={env.sos_dict["_index"]}) is ``ignored`` due to saved signature'
@@ -404,7 +412,7 @@ def validate_step_sig(sig):
             env.logger.debug(f'Signature mismatch: {matched}')
             return {}
     elif env.config['sig_mode'] == 'assert':
-        matched = sig.validate()
+        matched = sig.validate(saved_sig)
         if isinstance(matched, str):
             raise RuntimeError(f'Signature mismatch: {matched}')
         env.logger.info(
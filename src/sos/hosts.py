@@ -13,8 +13,7 @@ import sys
 import pexpect
 from collections.abc import Sequence
 
-import pkg_resources
-
+from .entrypoints import get_entry_points
 from .eval import Undetermined, cfg_interpolate
 from .syntax import SOS_LOGLINE
 from .targets import path, sos_targets
@@ -1227,8 +1226,7 @@ class Host:
                 task_engine = None
                 workflow_engine = None
 
-                for entrypoint in pkg_resources.iter_entry_points(
-                        group='sos_taskengines'):
+                for entrypoint in get_entry_points('sos_taskengines'):
                     try:
                         if entrypoint.name == self._engine_type:
                             task_engine = entrypoint.load()(
@@ -1239,8 +1237,7 @@ class Host:
                             f'Failed to load task engine {self._engine_type}: {e}'
                         )
 
-                for entrypoint in pkg_resources.iter_entry_points(
-                        group='sos_workflowengines'):
+                for entrypoint in get_entry_points('sos_workflowengines'):
                     try:
                         if entrypoint.name == self._engine_type:
                             workflow_engine = entrypoint.load()(
@@ -2,13 +2,204 @@
 #
 # Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
 # Distributed under the terms of the 3-clause BSD License.
+'''
+Serialization of messages passed between controller, workers and executors.
+
+An encoded message starts with a one-byte header that identifies the
+serializer so that decode_msg can decode messages encoded by any serializer:
+
+  MSGPACK   small control messages that consist only of None, bool, int,
+            float, str, bytes, list and dict, if msgpack is installed.
+  PICKLE    pickle protocol 5 with large bytes-like objects passed as
+            out-of-band buffers, which are appended to the same frame.
+  ZLIB      PICKLE compressed by zlib, for messages larger than
+            env.config['msg_compress_size'] (default 1M, 0 to disable).
+
+Messages without header (data pickled by previous versions of sos) start
+with the opcode of pickle protocol 2 and above (\\x80) and are unpickled
+directly. Counts, sizes and time of encoding and decoding are collected
+for each type of message and can be retrieved with message_stats().
+'''
 
 import pickle
+import struct
+import time
+import zlib
+from collections import defaultdict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .utils import env
+
+MSGPACK = b'\x01'
+PICKLE = b'\x02'
+ZLIB = b'\x03'
+
+_PICKLE_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
+# out-of-band buffers smaller than this are copied into the pickle stream
+_MIN_OOB_SIZE = 64 * 1024
+# control messages with more items than this are pickled
+_MAX_MSGPACK_ITEMS = 256
+_DEFAULT_COMPRESS_SIZE = 1024 * 1024
+
+# type of message -> [n_encoded, bytes_encoded, encode_time,
+#                     n_decoded, bytes_decoded, decode_time]
+_stats = defaultdict(lambda: [0, 0, 0.0, 0, 0, 0.0])
+
+
+def _msg_type(msg):
+    '''Name of message used by message counters'''
+    if isinstance(msg, (list, tuple)) and msg and isinstance(msg[0], str):
+        return msg[0]
+    if isinstance(msg, dict):
+        # work sent from controller to workers
+        if 'proc_vars' in msg:
+            return 'substep'
+        if 'section' in msg:
+            return 'step'
+        if 'wf' in msg:
+            return 'workflow'
+    return type(msg).__name__
+
+
+def _msgpackable(msg):
+    '''Test if msg can be passed through msgpack without loss of type, namely
+    without tuples, sets, subclasses of builtin types, or other objects.'''
+    items = [msg]
+    count = 0
+    while items:
+        item = items.pop()
+        count += 1
+        if count > _MAX_MSGPACK_ITEMS:
+            return False
+        t = type(item)
+        if item is None or t in (bool, float, str, bytes):
+            continue
+        if t is int:
+            # msgpack supports signed and unsigned 64bit integers
+            if -2**63 <= item < 2**64:
+                continue
+            return False
+        if t is list:
+            items.extend(item)
+        elif t is dict:
+            for key, value in item.items():
+                if type(key) not in (str, int):
+                    return False
+                items.append(key)
+                items.append(value)
+        else:
+            return False
+    return True
+
+
+def _pickle_dumps(msg):
+    if _PICKLE_PROTOCOL < 5:
+        return PICKLE + struct.pack('<I', 0) + pickle.dumps(
+            msg, protocol=_PICKLE_PROTOCOL)
+
+    buffers = []
+
+    def buffer_callback(buf):
+        raw = buf.raw()
+        if raw.nbytes < _MIN_OOB_SIZE:
+            # pickled in-band
+            return True
+        buffers.append(raw)
+        return False
+
+    payload = pickle.dumps(
+        msg, protocol=_PICKLE_PROTOCOL, buffer_callback=buffer_callback)
+    if not buffers:
+        return PICKLE + struct.pack('<I', 0) + payload
+    # a single frame with header, number of buffers, length of buffers,
+    # buffers, and then the pickle stream
+    return b''.join([
+        PICKLE,
+        struct.pack(f'<I{len(buffers)}Q', len(buffers),
+                    *[x.nbytes for x in buffers]), *buffers, payload
+    ])
+
+
+def _pickle_loads(data):
+    n_buffers = struct.unpack_from('<I', data, 1)[0]
+    if not n_buffers:
+        return pickle.loads(data[5:])
+    view = memoryview(data)
+    sizes = struct.unpack_from(f'<{n_buffers}Q', data, 5)
+    offset = 5 + 8 * n_buffers
+    buffers = []
+    for size in sizes:
+        buffers.append(view[offset:offset + size])
+        offset += size
+    return pickle.loads(view[offset:], buffers=buffers)
+
+
+def _compress_size():
+    size = env.config['msg_compress_size']
+    return _DEFAULT_COMPRESS_SIZE if size in ('', None) else int(size)
 
 
 def encode_msg(msg):
-    return pickle.dumps(msg)
+    start_time = time.perf_counter()
+    if msgpack is not None and _msgpackable(msg):
+        data = MSGPACK + msgpack.packb(msg, use_bin_type=True)
+    else:
+        data = _pickle_dumps(msg)
+        threshold = _compress_size()
+        if threshold > 0 and len(data) > threshold:
+            compressed = zlib.compress(data[1:], 1)
+            if len(compressed) < len(data) - 1:
+                data = ZLIB + compressed
+    stats = _stats[_msg_type(msg)]
+    stats[0] += 1
+    stats[1] += len(data)
+    stats[2] += time.perf_counter() - start_time
+    return data
 
 
 def decode_msg(data):
-    return pickle.loads(data)
+    start_time = time.perf_counter()
+    header = data[:1]
+    if header == MSGPACK:
+        msg = msgpack.unpackb(
+            data[1:], raw=False, use_list=True, strict_map_key=False)
+    elif header == PICKLE:
+        msg = _pickle_loads(data)
+    elif header == ZLIB:
+        msg = _pickle_loads(PICKLE + zlib.decompress(data[1:]))
+    else:
+        # message from previous versions of sos
+        msg = pickle.loads(data)
+    stats = _stats[_msg_type(msg)]
+    stats[3] += 1
+    stats[4] += len(data)
+    stats[5] += time.perf_counter() - start_time
+    return msg
+
+
+def message_stats():
+    '''Return a report of the number, size, and time of encoding and decoding
+    of messages of each type'''
+    lines = [
+        f'{"message":<20} {"encoded":>8} {"bytes":>12} {"ms":>9} '
+        f'{"decoded":>8} {"bytes":>12} {"ms":>9}'
+    ]
+    for name, (n_enc, b_enc, t_enc, n_dec, b_dec,
+               t_dec) in sorted(_stats.items()):
+        lines.append(f'{name:<20} {n_enc:>8} {b_enc:>12} {t_enc*1000:>9.2f} '
+                     f'{n_dec:>8} {b_dec:>12} {t_dec*1000:>9.2f}')
+    return '\n'.join(lines)
+
+
+def message_counts():
+    '''Return the number of messages of each type that have been encoded or
+    decoded'''
+    return {name: stats[0] + stats[3] for name, stats in _stats.items()}
+
+
+def reset_message_stats():
+    _stats.clear()
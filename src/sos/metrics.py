@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
+# Distributed under the terms of the 3-clause BSD License.
+'''
+Throughput statistics of the controller.
+
+The controller records the time it spends on each type of request and takes
+a snapshot of the following statistics every env.config['metrics_interval']
+seconds. Metrics are not collected unless metrics_interval or metrics_port is
+set:
+
+  steps     substeps queued, running, completed and ignored for each step
+  messages  number and rate (per second) of messages of each type
+  latency   number, mean and maximum time spent by the controller on each
+            type of request, including signature requests (step_sig.get etc)
+  workers   number of busy and idle workers, and worker utilization
+  queues    number of pending steps, substeps and tasks
+
+The snapshot is written to .sos/metrics.json and, if
+env.config['metrics_port'] is set, served at http://127.0.0.1:port/metrics
+in Prometheus text format (and /metrics.json in json format).
+'''
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .messages import message_counts
+from .utils import env
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def prometheus_text(snapshot):
+    '''Format a snapshot in Prometheus text exposition format'''
+    lines = []
+
+    def add(name, help_text, metric_type, samples):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in samples:
+            label_text = ','.join(
+                f'{key}="{_label(val)}"' for key, val in labels.items())
+            lines.append(f'{name}{{{label_text}}} {value}'
+                         if label_text else f'{name} {value}')
+
+    add('sos_substeps', 'Number of substeps of each step by state', 'gauge',
+        [({
+            'step': step,
+            'state': state
+        }, count)
+         for step, counts in snapshot['steps'].items()
+         for state, count in counts.items()])
+    add('sos_messages_total', 'Number of messages encoded and decoded',
+        'counter', [({
+            'type': name
+        }, stats['count']) for name, stats in snapshot['messages'].items()])
+    add('sos_messages_per_second',
+        'Rate of messages in the last sampling interval', 'gauge',
+        [({
+            'type': name
+        }, stats['rate']) for name, stats in snapshot['messages'].items()])
+    add('sos_request_seconds_total', 'Time spent on requests', 'counter',
+        [({
+            'request': name
+        }, stats['count'] * stats['mean_ms'] / 1000)
+         for name, stats in snapshot['latency'].items()])
+    add('sos_requests_total', 'Number of requests handled', 'counter',
+        [({
+            'request': name
+        }, stats['count']) for name, stats in snapshot['latency'].items()])
+    add('sos_workers', 'Number of workers by state', 'gauge',
+        [({
+            'state': state
+        }, snapshot['workers'][state]) for state in ('busy', 'idle')])
+    add('sos_worker_utilization', 'Fraction of busy workers', 'gauge',
+        [({}, snapshot['workers']['utilization'])])
+    add('sos_queue_depth', 'Number of pending requests', 'gauge',
+        [({
+            'queue': name
+        }, depth) for name, depth in snapshot['queues'].items()])
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        snapshot = self.server.metrics.snapshot
+        if self.path.split('?')[0].endswith('.json'):
+            content = json.dumps(snapshot).encode()
+            content_type = 'application/json'
+        else:
+            content = prometheus_text(snapshot).encode()
+            content_type = 'text/plain; version=0.0.4'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        env.log_to_file('CONTROLLER', f'Metrics server: {format % args}')
+
+
+class ControllerMetrics:
+    '''Collect statistics of the controller and export them as snapshots'''
+
+    def __init__(self, interval=None, port=None, filename=None):
+        self.interval = float(env.config.get('metrics_interval', None) or
+                              0) if interval is None else interval
+        self.port = env.config.get('metrics_port',
+                                   None) if port is None else port
+        self.filename = os.path.join(
+            env.exec_dir, '.sos',
+            'metrics.json') if filename is None else filename
+        self.enabled = self.interval > 0 or bool(self.port)
+
+        # request -> [count, total time, max time]
+        self._latency = defaultdict(lambda: [0, 0.0, 0.0])
+        self._start_time = time.time()
+        self._last_time = self._start_time
+        self._last_counts = {}
+        self._next_snapshot = self._start_time + self.interval
+        # the snapshot is replaced, never modified, so it can be read by the
+        # http server thread
+        self.snapshot = {}
+        self._server = None
+
+    def start(self, controller):
+        if not self.enabled:
+            return
+        self.take_snapshot(controller)
+        if not self.port:
+            return
+        try:
+            self._server = ThreadingHTTPServer(('127.0.0.1', int(self.port)),
+                                               _MetricsHandler)
+        except Exception as e:
+            env.logger.warning(
+                f'Failed to start metrics server at port {self.port}: {e}')
+            return
+        self._server.daemon_threads = True
+        self._server.metrics = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        env.log_to_file(
+            'CONTROLLER',
+            f'Metrics are served at http://127.0.0.1:{self._server.server_port}/metrics'
+        )
+
+    def stop(self, controller):
+        if not self.enabled:
+            return
+        self.take_snapshot(controller)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def record(self, kind, msg, elapsed):
+        '''Record the time spent on a push or request message'''
+        if not self.enabled or not isinstance(msg, (list, tuple)) or not msg or not isinstance(
+                msg[0], str):
+            return
+        name = msg[0]
+        if kind == 'request' and name.endswith('_sig') and len(msg) > 1:
+            # operations of signature databases
+            name += f'.{msg[1]}'
+        stats = self._latency[f'{kind}.{name}']
+        stats[0] += 1
+        stats[1] += elapsed
+        if elapsed > stats[2]:
+            stats[2] = elapsed
+
+    def timeout(self):
+        '''Time in milliseconds before the next snapshot, None if snapshots
+        are disabled'''
+        if self.interval <= 0:
+            return None
+        return max(0, (self._next_snapshot - time.time()) * 1000)
+
+    def update(self, controller):
+        '''Take a snapshot if it is time to do so'''
+        if self.interval > 0 and time.time() >= self._next_snapshot:
+            self.take_snapshot(controller)
+
+    def take_snapshot(self, controller):
+        now = time.time()
+        elapsed = max(now - self._last_time, 1e-6)
+
+        counts = message_counts()
+        messages = {
+            name: {
+                'count': count,
+                'rate': round((count - self._last_counts.get(name, 0)) /
+                              elapsed, 2)
+            } for name, count in counts.items()
+        }
+        self._last_counts = counts
+
+        steps = defaultdict(lambda: {
+            'queued': 0,
+            'running': 0,
+            'completed': 0,
+            'ignored': 0
+        })
+        for step_id, count in controller._completed.items():
+            steps[str(step_id)]['completed'] = count
+        for step_id, count in controller._ignored.items():
+            steps[str(step_id)]['ignored'] = count
+        workers = {'busy': 0, 'idle': 0, 'utilization': 0.0}
+        queues = {}
+        if controller.workers is not None:
+            for step_id, (queued,
+                          dispatched) in controller.workers.substep_stats(
+                          ).items():
+                step = steps[str(step_id)]
+                step['queued'] = queued
+                # substeps that are not sent to workers (e.g. ignored) are
+                # also counted as completed or ignored
+                step['running'] = max(
+                    0, dispatched - step['completed'] - step['ignored'])
+            workers = controller.workers.worker_stats()
+            queues = controller.workers.queue_depths()
+
+        self.snapshot = {
+            'time': now,
+            'uptime': round(now - self._start_time, 3),
+            'pid': os.getpid(),
+            'steps': dict(steps),
+            'messages': messages,
+            'latency': {
+                name: {
+                    'count': count,
+                    'mean_ms': round(total / count * 1000, 3),
+                    'max_ms': round(max_time * 1000, 3)
+                } for name, (count, total, max_time) in self._latency.items()
+            },
+            'workers': workers,
+            'queues': queues,
+        }
+        self._last_time = now
+        self._next_snapshot = now + self.interval
+        self.write_snapshot()
+
+    def write_snapshot(self):
+        if not os.path.isdir(os.path.dirname(self.filename)):
+            return
+        try:
+            tmp_file = f'{self.filename}.{os.getpid()}'
+            with open(tmp_file, 'w') as snapshot_file:
+                json.dump(self.snapshot, snapshot_file, indent=1)
+            os.replace(tmp_file, self.filename)
+        except Exception as e:
+            env.log_to_file('CONTROLLER', f'Failed to write metrics: {e}')
@@ -111,9 +111,9 @@ def is_type_hint(stmt: str) -> bool:
     # if action is registered
     global _action_list
     if _action_list is None:
-        import pkg_resources
+        from .entrypoints import get_entry_points
         _action_list = [
-            x.name for x in pkg_resources.iter_entry_points(group='sos_actions')
+            x.name for x in get_entry_points('sos_actions')
         ]
     if action in _action_list:
         return False
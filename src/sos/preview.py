@@ -6,7 +6,7 @@
 import argparse
 import base64
 import io
-import pkg_resources
+from sos.entrypoints import get_entry_points
 from sos.utils import dehtml, env, dot_to_gif, linecount_of_file
 
 
@@ -15,7 +15,7 @@ def get_previewers():
     # something to the plugin
     group = 'sos_previewers'
     result = []
-    for entrypoint in pkg_resources.iter_entry_points(group=group):
+    for entrypoint in get_entry_points(group):
         # if ':' in entry point name, it should be a function
         try:
             name, priority = entrypoint.name.split(',', 1)
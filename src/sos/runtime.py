@@ -2,7 +2,7 @@
 #
 # Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
 # Distributed under the terms of the 3-clause BSD License.
-import pkg_resources
+from .entrypoints import get_entry_points, required_sos_version
 
 # backward compatibility #1337
 from .pattern import expand_pattern
@@ -14,7 +14,7 @@ sos_get_param, get_output, path, paths
 
 
 def _load_group(group: str) -> None:
-    for _entrypoint in pkg_resources.iter_entry_points(group=group):
+    for _entrypoint in get_entry_points(group):
         # import all targets and actions from entry_points
         # Grab the function that is the actual plugin.
         _name = _entrypoint.name
@@ -24,17 +24,15 @@ def _load_group(group: str) -> None:
         except Exception as e:
             # look for sos version requirement
             from .utils import get_logger
-            if 'Requirement.parse' in str(e):
-                import re
+            required = required_sos_version(_entrypoint)
+            if required:
                 from ._version import __version__
                 from pkg_resources import parse_version
-                m = re.search(r"Requirement.parse\('sos>=([^)]*)'\)", str(e))
-                if m:
-                    if parse_version(__version__) < parse_version(m.group(1)):
-                        get_logger().warning(
-                            f'Failed to load target {_entrypoint.name}: please upgrade your version of sos from {__version__} to at least version {m.group(1)}'
-                        )
-                        continue
+                if parse_version(__version__) < parse_version(required):
+                    get_logger().warning(
+                        f'Failed to load target {_entrypoint.name}: please upgrade your version of sos from {__version__} to at least version {required}'
+                    )
+                    continue
             if _name == 'run':
                 # this is critical so we print the warning
                 get_logger().warning(f'Failed to load target {_entrypoint.name}: {e}')
@@ -3,49 +3,211 @@
 # Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
 # Distributed under the terms of the 3-clause BSD License.
 
+import ast
 import os
-import pickle
-import lzma
+import queue
 import sqlite3
+import threading
+import time
 
-from .utils import env
+from .compression import dumps, loads
+from .utils import env, short_repr
+
+
+# held by threads while they write to databases so that processes are not
+# forked while sqlite holds its global locks, which would deadlock sqlite in
+# the child process
+_fork_lock = threading.RLock()
+
+_journal_modes = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+_synchronous_levels = ('OFF', 'NORMAL', 'FULL', 'EXTRA', '0', '1', '2', '3')
+
+
+def _pragma_value(key, allowed, default):
+    value = str(env.config[key] or default).upper()
+    if value not in allowed:
+        env.logger.warning(
+            f'Invalid value {env.config[key]} for option {key}, use {default} instead. Allowed values are {", ".join(allowed)}.'
+        )
+        return default
+    return value
+
+
+def connect_db(db_file, **kwargs):
+    '''Connect to a sqlite database with journal mode and synchronous level
+    set by options sig_journal_mode and sig_synchronous, which default to
+    the rollback journal (DELETE) and FULL of sqlite. WAL mode allows
+    reading the database while it is being written but it does not work on
+    network file systems, so it has to be enabled explicitly.'''
+    # setting journal mode opens the database file, which is also protected
+    # from forking because sqlite holds its global locks when opening files
+    with _fork_lock:
+        conn = sqlite3.connect(db_file, timeout=60, **kwargs)
+        try:
+            conn.execute(
+                f'PRAGMA journal_mode={_pragma_value("sig_journal_mode", _journal_modes, "DELETE")}'
+            )
+            conn.execute(
+                f'PRAGMA synchronous={_pragma_value("sig_synchronous", _synchronous_levels, "FULL")}'
+            )
+        except sqlite3.DatabaseError as e:
+            env.logger.debug(f'Failed to set journal mode of {db_file}: {e}')
+    return conn
 
 
 class SignatureDB:
-    '''Base class for signature DB using sqlite'''
+    '''Base class for signature DB using sqlite. Records are written by a
+    background thread that commits them in batches of at most _batch_size
+    records, or _flush_interval seconds after the first record of the
+    batch, so that writing signatures does not block the caller.'''
+
+    _batch_size = 1000
+    _flush_interval = 1
+    # maximum number of records waiting to be written, callers wait for the
+    # writer thread if it falls behind
+    _max_pending = 20000
+    # markers passed to the writer thread
+    _FLUSH = 'flush'
+    _STOP = 'stop'
 
     def __init__(self):
         self.db_file = os.path.join(env.exec_dir, '.sos', self._db_name)
         self._conn = None
-        self._cache = []
+        self._queue = None
+        self._writer = None
 
     def _get_conn(self):
         # there is a possibility that the _conn is copied with a process
         # and we would better have a fresh conn
         if self._conn is None:
-            self._conn = sqlite3.connect(self.db_file, timeout=60)
+            self._conn = connect_db(self.db_file)
             self._conn.execute(self._db_structure)
-            self._conn.commit()
-        if self._cache:
-            self._conn.executemany(self._write_query, self._cache)
-            self._cache = []
+            self._migrate(self._conn)
             self._conn.commit()
         return self._conn
 
-    def _write(self, record):
-        self._cache.append(record)
-        if len(self._cache) > 1000:
-            # this will tricky the action to clear cache
-            self._get_conn()
+    def _migrate(self, conn):
+        # update databases created by previous versions of sos
+        pass
 
-    conn = property(_get_conn)
+    def _start_writer(self):
+        # make sure that the database has been created and migrated
+        self._get_conn()
+        self._queue = queue.Queue(maxsize=self._max_pending)
+        self._writer = threading.Thread(target=self._write_records, daemon=True)
+        self._writer.start()
+
+    def _write_records(self):
+        conn = connect_db(self.db_file)
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            batch = [item]
+            # collect records until the batch is full, the flush interval
+            # has passed, or a flush is requested
+            deadline = time.time() + self._flush_interval
+            while item not in (self._FLUSH, self._STOP) and len(
+                    batch) < self._batch_size:
+                try:
+                    item = self._queue.get(
+                        timeout=max(0, deadline - time.time()))
+                    batch.append(item)
+                except queue.Empty:
+                    break
+            stop = self._STOP in batch
+            records = [x for x in batch if x not in (self._FLUSH, self._STOP)]
+            try:
+                if records:
+                    self._write_batch(conn, records)
+            finally:
+                # callers waiting for the queue should not be blocked by
+                # records that failed to be written
+                for _ in batch:
+                    self._queue.task_done()
+        with _fork_lock:
+            conn.close()
+
+    def _write_batch(self, conn, records):
+        queries = {}
+        for query, record in records:
+            # a bad record should not stop the writer thread or prevent
+            # other records from being written
+            try:
+                queries.setdefault(query, []).append(self._encode(record))
+            except Exception as e:
+                env.logger.warning(
+                    f'Failed to write record {short_repr(record)} to {self.db_file}: {e}'
+                )
+        try:
+            with _fork_lock:
+                for query, values in queries.items():
+                    conn.executemany(query, values)
+                conn.commit()
+        except Exception as e:
+            env.logger.warning(
+                f'Failed to write {len(records)} records to {self.db_file}: {e}'
+            )
+        try:
+            self._written([x[1] for x in records])
+        except Exception as e:
+            env.logger.warning(
+                f'Failed to process records written to {self.db_file}: {e}')
+
+    def _encode(self, record):
+        # called by the writer thread to convert a record to values of query
+        return record
+
+    def _written(self, records):
+        # called by the writer thread after records are written
+        pass
+
+    def _write(self, record, query=None):
+        if self._writer is None:
+            self._start_writer()
+        try:
+            self._queue.put_nowait((query or self._write_query, record))
+        except queue.Full:
+            env.log_to_file(
+                'CONTROLLER',
+                f'Waiting for {self._queue.qsize()} records to be written to {self.db_file}'
+            )
+            self._queue.put((query or self._write_query, record))
+
+    def flush(self, wait=True):
+        '''Write all pending records to the database, and wait till they
+        are written if wait is True'''
+        if self._writer is not None:
+            self._queue.put(self._FLUSH)
+            if wait:
+                self._queue.join()
+
+    def _get_flushed_conn(self):
+        self.flush()
+        return self._get_conn()
+
+    # connection to a database with all records written
+    conn = property(_get_flushed_conn)
 
     def commit(self):
-        # getting conn will commit all cached records
-        self._get_conn()
+        self.flush()
+
+    def vacuum(self):
+        '''Rebuild the database to reclaim space of removed records'''
+        try:
+            conn = self.conn
+            conn.execute('VACUUM')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.DatabaseError as e:
+            env.logger.warning(f'Failed to vacuum {self.db_file}: {e}')
 
     def close(self):
-        self.conn.close()
+        if self._writer is not None:
+            self._queue.put(self._STOP)
+            self._writer.join()
+            self._writer = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
 
 
 class StepSignatures(SignatureDB):
@@ -54,16 +216,64 @@ class StepSignatures(SignatureDB):
     _db_name = 'step_signatures.db'
     _db_structure = '''CREATE TABLE IF NOT EXISTS steps (
         step_id text PRIMARY KEY,
-        signature BLOB
+        signature BLOB,
+        last_modified real
     )'''
-    _write_query = 'INSERT OR REPLACE INTO steps VALUES (?, ?)'
+    _write_query = 'INSERT OR REPLACE INTO steps (step_id, signature, last_modified) VALUES (?, ?, ?)'
+    # maximum number of host parameters in a single sqlite query
+    _max_vars = 500
 
     def __init__(self):
         super(StepSignatures, self).__init__()
+        # records that have not been written by the writer thread, which
+        # are checked before the database so that signatures are available
+        # right after they are set. Signatures of these records are not
+        # pickled until they are written by the writer thread.
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _write(self, record, query=None):
+        with self._lock:
+            self._pending[record[0]] = record
+        super(StepSignatures, self)._write(record, query)
+
+    def _encode(self, record):
+        # signatures are pickled by the writer thread
+        return (record[0], dumps(record[1])) + tuple(record[2:])
+
+    def _written(self, records):
+        with self._lock:
+            for record in records:
+                if self._pending.get(record[0]) is record:
+                    self._pending.pop(record[0])
+
+    def _pending_records(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def _migrate(self, conn):
+        columns = [
+            x[1] for x in conn.execute('PRAGMA table_info(steps)').fetchall()
+        ]
+        if 'last_modified' not in columns:
+            conn.execute('ALTER TABLE steps ADD COLUMN last_modified real')
+            # the age of existing signatures starts from now
+            conn.execute('UPDATE steps SET last_modified = ?', (time.time(),))
+
+    def _load(self, step_id, blob):
+        try:
+            return loads(blob)
+        except Exception as e:
+            env.logger.warning(
+                f'Failed to load signature for step {step_id}: {e}')
+            return None
 
     def get(self, step_id: str):
+        pending = self._pending_records()
+        if step_id in pending:
+            return pending[step_id][1]
         try:
-            cur = self.conn.cursor()
+            cur = self._get_conn().cursor()
             cur.execute('SELECT signature FROM steps WHERE step_id=? ',
                         (step_id,))
             res = cur.fetchone()
@@ -72,18 +282,35 @@ class StepSignatures(SignatureDB):
                 f'Failed to get step signature for step {step_id}: {e}')
             return None
         if res:
-            try:
-                return pickle.loads(lzma.decompress(res[0]))
-            except Exception as e:
-                env.logger.warning(
-                    f'Failed to load signature for step {step_id}: {e}')
-                return None
+            return self._load(step_id, res[0])
         else:
             return None
 
+    def get_many(self, step_ids: list):
+        '''Return a dictionary of signatures of specified steps. Steps without
+        signature are not included.'''
+        pending = self._pending_records()
+        missing = [x for x in step_ids if x not in pending]
+        res = {}
+        try:
+            cur = self._get_conn().cursor()
+            for i in range(0, len(missing), self._max_vars):
+                ids = missing[i:i + self._max_vars]
+                cur.execute(
+                    f'SELECT step_id, signature FROM steps WHERE step_id IN ({", ".join("?" * len(ids))})',
+                    ids)
+                res.update(cur.fetchall())
+        except sqlite3.DatabaseError as e:
+            env.logger.warning(
+                f'Failed to get step signatures for {len(missing)} steps: {e}')
+            return {}
+        res = {x: self._load(x, y) for x, y in res.items()}
+        res.update({x: pending[x][1] for x in step_ids if x in pending})
+        return res
+
     def set(self, step_id: str, signature: dict):
         try:
-            self._write((step_id, lzma.compress(pickle.dumps(signature))))
+            self._write((step_id, signature, time.time()))
         except sqlite3.DatabaseError as e:
             env.logger.warning(
                 f'Failed to set step signature for step {step_id}: {e}')
@@ -109,6 +336,21 @@ class StepSignatures(SignatureDB):
                 f'Failed to remove signature for {len(steps)} substeps: {e}')
             return 0
 
+    def ids(self, before=None):
+        '''Return ids of all steps, or steps with signatures saved before
+        specified time'''
+        try:
+            cur = self.conn.cursor()
+            if before is None:
+                cur.execute('SELECT step_id FROM steps')
+            else:
+                cur.execute('SELECT step_id FROM steps WHERE last_modified < ?',
+                            (before,))
+            return [x[0] for x in cur.fetchall()]
+        except sqlite3.DatabaseError as e:
+            env.logger.warning(f'Failed to get ids of steps: {e}')
+            return []
+
     def clear(self):
         try:
             self.conn.execute('DELETE FROM steps')
@@ -120,20 +362,103 @@ class StepSignatures(SignatureDB):
 class WorkflowSignatures(SignatureDB):
     '''Workflow signature to store runtime information for workflows'''
     _db_name = 'workflow_signatures.db'
+    # version of the database schema, saved as PRAGMA user_version
+    #   0: a single workflows table with repr'd tracked files
+    #   1: indexed workflows table and a separate tracked_files table
+    #   2: time of records saved as last_modified
+    _schema_version = 2
     _db_structure = '''CREATE TABLE IF NOT EXISTS workflows (
             master_id text,
             entry_type text,
             id text,
-            item text
+            item text,
+            last_modified real
+    )'''
+    _write_query = 'INSERT INTO workflows VALUES (?, ?, ?, ?, ?)'
+    _files_structure = '''CREATE TABLE IF NOT EXISTS tracked_files (
+            master_id text,
+            sig_id text,
+            file_type text,
+            path text,
+            last_modified real
     )'''
-    _write_query = 'INSERT INTO workflows VALUES (?, ?, ?, ?)'
+    _files_write_query = 'INSERT INTO tracked_files VALUES (?, ?, ?, ?, ?)'
 
     def __init__(self):
         super(WorkflowSignatures, self).__init__()
 
-    def write(self, entry_type: str, id: str, item: str):
+    def _migrate(self, conn):
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= self._schema_version:
+            return
+        conn.execute(self._files_structure)
+        # tables created before version 2 do not have column last_modified,
+        # and the age of their records starts from now
+        for table in ('workflows', 'tracked_files'):
+            columns = [
+                x[1] for x in conn.execute(
+                    f'PRAGMA table_info({table})').fetchall()
+            ]
+            if 'last_modified' not in columns:
+                conn.execute(
+                    f'ALTER TABLE {table} ADD COLUMN last_modified real')
+                conn.execute(f'UPDATE {table} SET last_modified = ?',
+                             (time.time(),))
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS workflows_master_id_entry_type ON workflows (master_id, entry_type)'
+        )
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS workflows_entry_type ON workflows (entry_type)'
+        )
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS tracked_files_master_id ON tracked_files (master_id)'
+        )
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS tracked_files_path ON tracked_files (path)'
+        )
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS tracked_files_sig_id ON tracked_files (sig_id)'
+        )
+        # move tracked files saved as repr'd dictionaries to tracked_files
+        records = conn.execute(
+            'SELECT master_id, id, item FROM workflows WHERE entry_type = "tracked_files"'
+        ).fetchall()
+        if records:
+            env.logger.debug(
+                f'Migrating {len(records)} tracked file records of {self.db_file}'
+            )
+            conn.executemany(self._files_write_query, [
+                y for master_id, sig_id, item in records
+                for y in self._file_records(master_id, sig_id, item)
+            ])
+            conn.execute(
+                'DELETE FROM workflows WHERE entry_type = "tracked_files"')
+        conn.execute(f'PRAGMA user_version = {self._schema_version}')
+
+    def _file_records(self, master_id, sig_id, item):
+        if isinstance(item, str):
+            try:
+                item = ast.literal_eval(item)
+            except Exception as e:
+                env.logger.debug(
+                    f'Failed to read tracked files of signature {sig_id}: {e}')
+                return []
+        now = time.time()
+        return [(master_id, sig_id, file_type, path, now)
+                for file_type, paths in item.items()
+                for path in paths]
+
+    def write(self, entry_type: str, id: str, item):
+        '''Write a record of a workflow. Tracked files are passed as a
+        dictionary of file types and lists of files.'''
         try:
-            self._write((env.config["master_id"], entry_type, id, item))
+            if entry_type == 'tracked_files':
+                for record in self._file_records(env.config["master_id"], id,
+                                                 item):
+                    self._write(record, self._files_write_query)
+            else:
+                self._write((env.config["master_id"], entry_type, id, item,
+                             time.time()))
         except sqlite3.DatabaseError as e:
             env.logger.warning(
                 f'Failed to write workflow signature of type {entry_type} and id {id}: {e}'
@@ -178,14 +503,30 @@ class WorkflowSignatures(SignatureDB):
         try:
             cur = self.conn.cursor()
             cur.execute(
-                'SELECT id, item FROM workflows WHERE entry_type = "tracked_files"'
+                'SELECT sig_id, file_type, path FROM tracked_files ORDER BY rowid'
             )
-            return [(x[0], eval(x[1])) for x in cur.fetchall()]
+            res = {}
+            for sig_id, file_type, path in cur.fetchall():
+                res.setdefault(sig_id, {}).setdefault(file_type,
+                                                      []).append(path)
+            return list(res.items())
         except sqlite3.DatabaseError as e:
             env.logger.warning(
                 f'Failed to get files from signature database: {e}')
             return []
 
+    def tracked_paths(self):
+        '''Return a set of all files tracked by workflows related to current
+        directory'''
+        try:
+            cur = self.conn.cursor()
+            cur.execute('SELECT DISTINCT path FROM tracked_files')
+            return {x[0] for x in cur.fetchall()}
+        except sqlite3.DatabaseError as e:
+            env.logger.warning(
+                f'Failed to get tracked files from signature database: {e}')
+            return set()
+
     def placeholders(self, workflow_id=None):
         try:
             cur = self.conn.cursor()
@@ -195,19 +536,216 @@ class WorkflowSignatures(SignatureDB):
                 )
             else:
                 cur.execute(
-                    f'SELECT item FROM workflows WHERE entry_type = "placeholder" AND master_id = "{workflow_id}"'
-                )
+                    'SELECT item FROM workflows WHERE master_id = ? AND entry_type = "placeholder"',
+                    (workflow_id,))
             return [x[0] for x in cur.fetchall()]
         except sqlite3.DatabaseError as e:
             env.logger.warning(
                 f'Failed to get placeholders from signature database: {e}')
             return []
 
+    def remove_files(self, sig_ids):
+        '''Remove tracked files of specified signatures'''
+        try:
+            cur = self.conn.cursor()
+            cur.executemany('DELETE FROM tracked_files WHERE sig_id = ?',
+                            [(x,) for x in sig_ids])
+            self.conn.commit()
+        except sqlite3.DatabaseError as e:
+            env.logger.warning(
+                f'Failed to remove tracked files of {len(sig_ids)} signatures: {e}'
+            )
+
+    def remove_before(self, timestamp):
+        '''Remove records of workflows saved before specified time, and
+        return the number of removed records'''
+        try:
+            cur = self.conn.cursor()
+            cur.execute('DELETE FROM workflows WHERE last_modified < ?',
+                        (timestamp,))
+            count = cur.rowcount
+            cur.execute('DELETE FROM tracked_files WHERE last_modified < ?',
+                        (timestamp,))
+            self.conn.commit()
+            return count + cur.rowcount
+        except sqlite3.DatabaseError as e:
+            env.logger.warning(f'Failed to remove workflow records: {e}')
+            return 0
+
     def clear(self):
         try:
             self.conn.execute(f'DELETE FROM workflows WHERE master_id = ?',
                               (env.config["master_id"],))
+            self.conn.execute('DELETE FROM tracked_files WHERE master_id = ?',
+                              (env.config["master_id"],))
             self.conn.commit()
         except sqlite3.DatabaseError as e:
             env.logger.warning(f'Failed to clear workflow database: {e}')
             return []
+
+
+class FileHashCache:
+    '''Project-level cache of file hashes keyed by device, inode, size and
+    mtime (in nanoseconds) of files. Unlike other signature databases, which
+    are written only by the controller, this cache is read and written by all
+    processes that calculate file signatures so records are committed
+    immediately.'''
+
+    _db_name = 'file_hashes.db'
+    _db_structure = '''CREATE TABLE IF NOT EXISTS file_hashes (
+        device integer,
+        inode integer,
+        partial integer,
+        algorithm text,
+        size integer,
+        mtime_ns integer,
+        path text,
+        hash text,
+        PRIMARY KEY (device, inode, partial, algorithm)
+    )'''
+    # files modified this recently might be modified again without a change
+    # of mtime (e.g. on file systems with low mtime resolution), so their
+    # hashes are not cached
+    _min_age = 2
+
+    def __init__(self, db_file=None):
+        self.db_file = db_file if db_file else os.path.join(
+            env.exec_dir, '.sos', self._db_name)
+        self._conn = None
+        self._pid = None
+        # fileMD5 can be called from multiple threads
+        self._lock = threading.Lock()
+
+    def _get_conn(self):
+        # connections cannot be shared by forked processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = connect_db(self.db_file, check_same_thread=False)
+            # the cache can be safely discarded if it was created with
+            # a different structure
+            columns = [
+                x[1] for x in self._conn.execute(
+                    'PRAGMA table_info(file_hashes)').fetchall()
+            ]
+            if columns and 'algorithm' not in columns:
+                self._conn.execute('DROP TABLE file_hashes')
+            self._conn.execute(self._db_structure)
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    conn = property(_get_conn)
+
+    def get(self, stat, partial=True, algorithm='md5'):
+        '''Return cached hash for a file with specified os.stat_result, or
+        None if the file is not cached or has been changed.'''
+        try:
+            with self._lock:
+                res = self.conn.execute(
+                    'SELECT hash FROM file_hashes WHERE device=? AND inode=? '
+                    'AND partial=? AND algorithm=? AND size=? AND mtime_ns=?',
+                    (stat.st_dev, stat.st_ino, int(partial), algorithm,
+                     stat.st_size, stat.st_mtime_ns)).fetchone()
+        except sqlite3.DatabaseError as e:
+            env.logger.debug(f'Failed to get cached file hash: {e}')
+            return None
+        return res[0] if res else None
+
+    def set(self, filename, stat, partial, algorithm, hash):
+        if time.time() - stat.st_mtime < self._min_age:
+            return
+        try:
+            with self._lock:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (stat.st_dev, stat.st_ino, int(partial), algorithm,
+                     stat.st_size, stat.st_mtime_ns, os.path.abspath(filename),
+                     hash))
+                self.conn.commit()
+        except sqlite3.DatabaseError as e:
+            env.logger.debug(f'Failed to cache hash of {filename}: {e}')
+
+    def remove_missing(self):
+        '''Remove hashes of files that no longer exist, and return the number
+        of removed records'''
+        try:
+            with self._lock:
+                paths = [
+                    x[0] for x in self.conn.execute(
+                        'SELECT DISTINCT path FROM file_hashes').fetchall()
+                ]
+                missing = [(x,) for x in paths if not os.path.exists(x)]
+                cur = self.conn.cursor()
+                cur.executemany('DELETE FROM file_hashes WHERE path = ?',
+                                missing)
+                self.conn.commit()
+                return cur.rowcount
+        except sqlite3.DatabaseError as e:
+            env.logger.warning(f'Failed to remove file hashes: {e}')
+            return 0
+
+    def vacuum(self):
+        try:
+            with self._lock:
+                self.conn.execute('VACUUM')
+                self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.DatabaseError as e:
+            env.logger.warning(f'Failed to vacuum {self.db_file}: {e}')
+
+    def clear(self):
+        try:
+            with self._lock:
+                self.conn.execute('DELETE FROM file_hashes')
+                self.conn.commit()
+        except sqlite3.DatabaseError as e:
+            env.logger.warning(f'Failed to clear file hash cache: {e}')
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
+_file_hash_caches = {}
+
+
+_held_locks = []
+
+
+def _acquire_db_locks():
+    # wait for other threads to complete their database operations
+    _held_locks[:] = [_fork_lock] + [
+        cache._lock for cache in list(_file_hash_caches.values())
+    ]
+    for lock in _held_locks:
+        lock.acquire()
+
+
+def _release_db_locks():
+    for lock in reversed(_held_locks):
+        lock.release()
+    _held_locks.clear()
+
+
+def _reset_file_hash_caches():
+    # workers are forked from a process in which other threads might be
+    # holding locks of the caches
+    global _fork_lock
+    _fork_lock = threading.RLock()
+    _held_locks.clear()
+    for cache in _file_hash_caches.values():
+        cache._lock = threading.Lock()
+        cache._conn = None
+
+
+os.register_at_fork(
+    before=_acquire_db_locks,
+    after_in_parent=_release_db_locks,
+    after_in_child=_reset_file_hash_caches)
+
+
+def get_file_hash_cache():
+    '''Return the file hash cache of the current project directory'''
+    db_file = os.path.join(env.exec_dir, '.sos', FileHashCache._db_name)
+    if db_file not in _file_hash_caches:
+        _file_hash_caches[db_file] = FileHashCache(db_file)
+    return _file_hash_caches[db_file]
@@ -5,17 +5,22 @@
 
 import ast
 import copy
+import hashlib
 import os
+import pickle
 import subprocess
 import sys
 import time
+import uuid
 from collections import defaultdict
 from collections.abc import Iterable, Mapping, Sequence
 from typing import List
 
 import zmq
 
-from .controller import close_socket, create_socket, send_message_to_controller
+from .controller import (create_bound_socket, release_bound_socket,
+                         request_answer_from_controller,
+                         send_message_to_controller)
 from .messages import encode_msg, decode_msg
 from .eval import SoS_eval, SoS_exec, accessed_vars, KeepOnlyImportAndDefine
 from .executor_utils import (__named_output__, __null_func__, __output_from__,
@@ -29,7 +34,7 @@ from .targets import (RemovedTarget, RuntimeInfo, UnavailableLock, sos_variable,
                       sos_targets, invalid_target, textMD5)
 from .tasks import MasterTaskParams, TaskFile
 from .utils import (ArgumentError, StopInputGroup, TerminateExecution, env,
-                    get_traceback, short_repr, ProcessKilled, get_localhost_ip)
+                    get_traceback, short_repr, ProcessKilled)
 
 __all__: List = []
 
@@ -528,15 +533,7 @@ class Base_Step_Executor:
             if k not in SOS_OUTPUT_OPTIONS:
                 raise RuntimeError(f'Unrecognized output option {k}')
 
-        if ofiles._num_groups() > 0:
-            if ofiles._num_groups() == 1:
-                ofiles = ofiles._get_group(0)
-            elif ofiles._num_groups() != len(self._substeps):
-                raise RuntimeError(
-                    f'Inconsistent number of output ({ofiles._num_groups()}) and input ({len(self._substeps)}) groups.'
-                )
-            else:
-                ofiles = ofiles._get_group(env.sos_dict['_index'])
+        ofiles = self.output_of_substep(ofiles)
 
         # create directory
         if ofiles.valid():
@@ -561,6 +558,19 @@ class Base_Step_Executor:
                 )
             self._all_outputs.add(oname)
 
+    def output_of_substep(self, ofiles: sos_targets):
+        '''Return the group of output of the current substep'''
+        if ofiles._num_groups() > 0:
+            if ofiles._num_groups() == 1:
+                return ofiles._get_group(0)
+            elif ofiles._num_groups() != len(self._substeps):
+                raise RuntimeError(
+                    f'Inconsistent number of output ({ofiles._num_groups()}) and input ({len(self._substeps)}) groups.'
+                )
+            else:
+                return ofiles._get_group(env.sos_dict['_index'])
+        return ofiles
+
     def submit_task(self, task_info):
         if self.task_manager is None:
             if self.step.task_params:
@@ -777,11 +787,12 @@ class Base_Step_Executor:
 
     def prepare_substep(self):
         # socket to collect result
-        self.result_pull_socket = create_socket(env.zmq_context, zmq.PULL,
-                                                'substep result collector')
-        local_ip = get_localhost_ip()
-        port = self.result_pull_socket.bind_to_random_port(f'tcp://{local_ip}')
-        env.config['sockets']['result_push_socket'] = f'tcp://{local_ip}:{port}'
+        self.result_pull_socket, self.result_push_address = create_bound_socket(
+            env.zmq_context, zmq.PULL, 'substep result collector')
+        env.config['sockets']['result_push_socket'] = self.result_push_address
+        # the socket might have been used by previous steps, whose substeps
+        # could still send results to it, so results are tagged with a nonce
+        self.result_nonce = uuid.uuid4().hex
 
     def submit_substep(self, param):
         send_message_to_controller(['substep', param])
@@ -809,6 +820,13 @@ class Base_Step_Executor:
                 return
             yield self.result_pull_socket
             res = decode_msg(self.result_pull_socket.recv())
+            if res.get('nonce', None) != self.result_nonce:
+                # result of a previous step that used the same socket
+                continue
+            if res.get('index', None) in self._received_substeps:
+                # a substep that is resubmitted after its worker is lost
+                # might return its result twice
+                continue
             if 'exception' in res:
                 if isinstance(res['exception'], ProcessKilled):
                     raise res['exception']
@@ -827,6 +845,7 @@ class Base_Step_Executor:
                         self._substeps
                     ) > 1 else f'(id={env.sos_dict["step_id"]})'
                     self.exec_error.append(idx_msg, res['exception'])
+                    self._received_substeps.add(res.get('index', None))
                     # try to stop everything but wait till for submitted tasks to
                     # complete
                     self._completed_concurrent_substeps + 1
@@ -834,9 +853,14 @@ class Base_Step_Executor:
                     env.logger.warning(
                         f'``{self.step.step_name(True)}`` {idx_msg} returns an error.{f" Terminating step after completing {waiting} submitted substeps." if waiting else " Terminating now."}'
                     )
-                    for i in range(waiting):
+                    while waiting > 0:
                         yield self.result_pull_socket
                         res = decode_msg(self.result_pull_socket.recv())
+                        if res.get('nonce', None) != self.result_nonce or res.get(
+                                'index', None) in self._received_substeps:
+                            continue
+                        self._received_substeps.add(res.get('index', None))
+                        waiting -= 1
                         if 'exception' in res:
                             self.exec_error.append(f'index={res["index"]}',
                                                    res['exception'])
@@ -862,6 +886,7 @@ class Base_Step_Executor:
                     self.proc_results[res['index']] = res
             else:
                 self.proc_results[res['index']] = res
+            self._received_substeps.add(res['index'])
             self._completed_concurrent_substeps += 1
 
     def wait_for_substep(self):
@@ -996,7 +1021,7 @@ class Base_Step_Executor:
                 shared_vars=self.vars_to_be_shared)
             # if singaure match, we skip the substep even  if
             # there are tasks.
-            matched = validate_step_sig(sig)
+            matched = validate_step_sig(sig, self.prefetched_signatures)
             if matched:
                 if env.sos_dict['step_output'].undetermined():
                     self.output_groups[idx] = matched["output"]
@@ -1101,20 +1126,138 @@ class Base_Step_Executor:
         self.proc_results.append({})
         self.submit_substep(
             dict(
-                stmt=statement[1],
-                global_def=self.step.global_def,
-                #1225: the step might contain large variables from global section, but
-                # we do not have to sent them if they are not used in substeps.
-                global_vars={
-                    x: y
-                    for x, y in self.step.global_vars.items()
-                    if x in env.sos_dict['__signature_vars__']
-                },
-                task=self.step.task,
-                task_params=self.step.task_params,
+                context=self.substep_context(statement[1]),
                 proc_vars=env.sos_dict.clone_selected_vars(proc_vars),
-                shared_vars=self.vars_to_be_shared,
-                config=env.config))
+                nonce=self.result_nonce))
+
+    def substep_context(self, stmt):
+        '''Return the id of the context shared by all substeps of the step,
+        namely statement, global definitions, task, and configuration. The
+        context is registered with the controller with the first substep and
+        is retrieved and cached by workers so that it is not sent with every
+        substep.'''
+        if stmt in self._substep_contexts:
+            return self._substep_contexts[stmt]
+        context = dict(
+            stmt=stmt,
+            global_def=self.step.global_def,
+            #1225: the step might contain large variables from global section, but
+            # we do not have to sent them if they are not used in substeps.
+            global_vars={
+                x: y
+                for x, y in self.step.global_vars.items()
+                if x in env.sos_dict['__signature_vars__']
+            },
+            task=self.step.task,
+            task_params=self.step.task_params,
+            shared_vars=self.vars_to_be_shared,
+            config=env.config)
+        context_id = hashlib.md5(pickle.dumps(context)).hexdigest()
+        send_message_to_controller(['substep_context', context_id, context])
+        self._substep_contexts[stmt] = context_id
+        return context_id
+
+    def substep_vars(self, g: sos_targets):
+        '''Variables of targets and groups that are exposed to a substep'''
+        _vars = {}
+        # now, let us expose target level variables as lists
+        if len(g) > 1:
+            names = set.union(*[set(x._dict.keys()) for x in g._targets])
+        elif len(g) == 1:
+            names = set(g._targets[0]._dict.keys())
+        else:
+            names = set()
+        for name in names:
+            _vars[name] = [x.get(name) for x in g._targets]
+        # then we expose all group level variables
+        _vars.update(g._dict)
+        _vars.update(env.sos_dict['step_input']._dict)
+        return _vars
+
+    def substep_sig_ids(self, statements):
+        '''Return ids of signatures of all substeps, which can only be
+        determined before the substeps are executed if the last statement
+        is preceded only by an output statement, or an empty list otherwise.
+        Output of substeps are evaluated without creating directories or
+        changing step_output, and _input, _index and _output are restored
+        afterwards.'''
+        if any(x[0] == '!' for x in statements[:-1]) or len([
+                x for x in statements if x[0] == ':'
+        ]) != 1 or statements[0][:2] != [':', 'output']:
+            return []
+        if statements[-1][0] == '!':
+            stmt = statements[-1][1]
+        elif self.step.task:
+            stmt = ''
+        else:
+            return []
+        value = statements[0][2]
+        step_md5 = statementMD5([stmt, self.step.task])
+        saved = {x: env.sos_dict[x] for x in ('_input', '_index', '_output')}
+        sig_ids = []
+        try:
+            for idx, g in enumerate(self._substeps):
+                env.sos_dict.update(self.substep_vars(g))
+                env.sos_dict.set('_input', g)
+                env.sos_dict.set('_index', idx)
+                args, kwargs = SoS_eval(
+                    f'__null_func__({value})',
+                    extra_dict={
+                        '__null_func__': __null_func__,
+                        'output_from': __output_from__,
+                        'named_output': __named_output__,
+                        'traced': __traced__
+                    })
+                ofiles = self.output_of_substep(
+                    expand_output_files(
+                        value, *args, **{
+                            k: v
+                            for k, v in kwargs.items()
+                            if k not in SOS_OUTPUT_OPTIONS
+                        }))
+                if ofiles.unspecified() or ofiles.undetermined():
+                    continue
+                env.sos_dict.set('_output', ofiles)
+                sig = RuntimeInfo(
+                    step_md5,
+                    g,
+                    ofiles,
+                    env.sos_dict['_depends'],
+                    env.sos_dict['__signature_vars__'],
+                    shared_vars=self.vars_to_be_shared)
+                if sig.sig_id:
+                    sig_ids.append(sig.sig_id)
+        except Exception as e:
+            # the output will be evaluated again with the substeps
+            env.log_to_file(
+                'STEP', f'Failed to determine signatures of substeps: {e}')
+            return []
+        finally:
+            for key, val in saved.items():
+                env.sos_dict.set(key, val)
+        return sig_ids
+
+    def prefetch_signatures(self, statements):
+        '''Retrieve saved signatures of all substeps from the controller with
+        a single request so that substeps do not have to request them one by
+        one.'''
+        self.prefetched_signatures = {}
+        if env.config['sig_mode'] not in (
+                'default', 'skip', 'assert') or len(self._substeps) <= 1:
+            return
+        sig_ids = self.substep_sig_ids(statements)
+        if not sig_ids:
+            return
+        saved_sigs = request_answer_from_controller(
+            ['step_sig', 'get_many', sig_ids]) or {}
+        # substeps without saved signatures do not have to ask the controller
+        # again, unless their signature ids differ from the predicted ones
+        self.prefetched_signatures = {x: None for x in sig_ids}
+        self.prefetched_signatures.update(saved_sigs)
+        env.log_to_file(
+            'STEP',
+            f'{len(saved_sigs)} signatures prefetched for {len(self._substeps)} substeps'
+        )
 
     def check_task_sig(self):
         idx = env.sos_dict["_index"]
@@ -1129,7 +1272,7 @@ class Base_Step_Executor:
             'STEP',
             f'Check task-only step {env.sos_dict["step_name"]} with signature {sig.sig_id}'
         )
-        matched = validate_step_sig(sig)
+        matched = validate_step_sig(sig, self.prefetched_signatures)
         skip_index = bool(matched)
         if matched:
             if env.sos_dict['step_output'].undetermined():
@@ -1485,27 +1628,18 @@ class Base_Step_Executor:
             self.completed['__substep_skipped__'] = 0
             self.completed['__substep_completed__'] = len(self._substeps)
             self._completed_concurrent_substeps = 0
+            # indexes of substeps whose results have been received
+            self._received_substeps = set()
+            # statement -> id of substep context registered with controller
+            self._substep_contexts = {}
             # pending signatures are signatures for steps with external tasks
             self.pending_signatures = [None for x in self._substeps]
+            self.prefetch_signatures(self.step.statements[input_statement_idx:])
 
             for idx, g in enumerate(self._substeps):
                 # other variables
                 #
-                _vars = {}
-                # now, let us expose target level variables as lists
-                if len(g) > 1:
-                    names = set.union(
-                        *[set(x._dict.keys()) for x in g._targets])
-                elif len(g) == 1:
-                    names = set(g._targets[0]._dict.keys())
-                else:
-                    names = set()
-                for name in names:
-                    _vars[name] = [x.get(name) for x in g._targets]
-                # then we expose all group level variables
-                _vars.update(g._dict)
-                _vars.update(env.sos_dict['step_input']._dict)
-                env.sos_dict.update(_vars)
+                env.sos_dict.update(self.substep_vars(g))
 
                 env.sos_dict.set('_input', copy.deepcopy(g))
                 # set vars to _input
@@ -1690,7 +1824,8 @@ class Base_Step_Executor:
                                 env.sos_dict['_depends'],
                                 env.sos_dict['__signature_vars__'],
                                 shared_vars=self.vars_to_be_shared)
-                            matched = validate_step_sig(sig)
+                            matched = validate_step_sig(
+                                sig, self.prefetched_signatures)
                             skip_index = bool(matched)
                             if skip_index:
                                 # matched["output"] might hav vars not defined in "output" #1355
@@ -1924,7 +2059,23 @@ class Base_Step_Executor:
             return self.collect_result()
         finally:
             if self.concurrent_substep:
-                close_socket(self.result_pull_socket, 'substep collector')
+                all_received = self._completed_concurrent_substeps == len(
+                    self.proc_results)
+                # the socket can be used by the next step if results of all
+                # substeps have been received
+                release_bound_socket(
+                    env.zmq_context,
+                    zmq.PULL,
+                    self.result_pull_socket,
+                    self.result_push_address,
+                    'substep collector',
+                    reusable=all_received)
+                # contexts might still be needed by substeps that are running
+                if all_received and self._substep_contexts:
+                    send_message_to_controller([
+                        'release_substep_contexts',
+                        list(self._substep_contexts.values())
+                    ])
 
 
 class Step_Executor(Base_Step_Executor):
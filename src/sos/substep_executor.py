@@ -4,13 +4,17 @@
 # Distributed under the terms of the 3-clause BSD License.
 
 import contextlib
+import copy
 import subprocess
 import sys
+from collections import OrderedDict
 from io import StringIO
 
 import zmq
 
-from .controller import close_socket, create_socket, send_message_to_controller
+from .controller import (close_socket, create_socket,
+                         request_answer_from_controller,
+                         send_message_to_controller)
 from .messages import encode_msg
 from .eval import SoS_exec
 from .executor_utils import (clear_output, create_task, get_traceback_msg,
@@ -34,14 +38,38 @@ def stdoutIO():
     sys.stderr = olderr
 
 
-def execute_substep(stmt,
-                    global_def,
-                    global_vars,
+# id -> context of recently executed steps
+_substep_contexts = OrderedDict()
+_max_substep_contexts = 10
+
+
+def get_substep_context(context_id):
+    '''Return context shared by substeps of a step, which is retrieved from
+    the controller once and cached for subsequent substeps'''
+    if context_id in _substep_contexts:
+        _substep_contexts.move_to_end(context_id)
+        return _substep_contexts[context_id]
+    context = request_answer_from_controller(['substep_context', context_id])
+    if context is None:
+        raise RuntimeError(
+            f'Failed to retrieve context {context_id} of substep from controller'
+        )
+    _substep_contexts[context_id] = context
+    while len(_substep_contexts) > _max_substep_contexts:
+        _substep_contexts.popitem(last=False)
+    return context
+
+
+def execute_substep(stmt='',
+                    global_def='',
+                    global_vars={},
                     task='',
                     task_params='',
                     proc_vars={},
                     shared_vars=[],
-                    config={}):
+                    config={},
+                    context=None,
+                    nonce=None):
     '''Execute a substep with specific input etc
 
     Substep executed by this function should be self-contained. It can contain
@@ -74,6 +102,16 @@ def execute_substep(stmt,
     config:
         Runmode, signature mode, verbosity, etc.
 
+    context:
+        ID of substep context registered with the controller, which provides
+        stmt, global_def, global_vars, task, task_params, shared_vars and config
+        shared by all substeps of a step.
+
+    nonce:
+        Returned with the result so that the step can tell results of its
+        substeps from late results of previous steps that used the same
+        result socket.
+
     The return value should be a dictionary with the following keys:
 
     index: index of the substep within the step
@@ -83,8 +121,18 @@ def execute_substep(stmt,
     stdout: (optional) if in interactive mode
     stderr: (optional) if in interactive mode
     exception: (optional) if an exception occures
+    nonce: (optional) nonce passed to the substep
     '''
     assert not env.zmq_context.closed
+    if context is not None:
+        ctx = get_substep_context(context)
+        stmt = ctx['stmt']
+        global_def = ctx['global_def']
+        global_vars = ctx['global_vars']
+        task = ctx['task']
+        task_params = ctx['task_params']
+        shared_vars = ctx['shared_vars']
+        config = ctx['config']
     assert 'workflow_id' in proc_vars
     assert 'step_id' in proc_vars
     assert '_input' in proc_vars
@@ -115,18 +163,24 @@ def execute_substep(stmt,
         proc_vars=proc_vars,
         shared_vars=shared_vars,
         config=config)
+    if nonce is not None:
+        res['nonce'] = nonce
     env.result_socket.send(encode_msg(res))
 
 
 def _execute_substep(stmt, global_def, global_vars, task, task_params,
                      proc_vars, shared_vars, config):
     # vatlab/sos-notebook#272
-    # if config contains exec_mode, we remove it to avoid it manifest the worker exec_mode
+    # if config contains exec_mode, we remove it to avoid it manifest the worker exec_mode.
+    # config can be shared by substeps of a cached context so it is copied.
+    config = dict(config)
     config.pop('exec_mode', None)
     # passing configuration and port numbers to the subprocess
     env.config.update(config)
-    # prepare a working environment with sos symbols and functions
-    prepare_env(global_def, global_vars)
+    # prepare a working environment with sos symbols and functions for each
+    # substep, with a copy of global variables of the cached context so that
+    # changes made by a substep are not seen by other substeps
+    prepare_env(global_def, copy.deepcopy(global_vars))
     # update it with variables passed from master process
     env.sos_dict.quick_update(proc_vars)
     if env.config['sig_mode'] == 'ignore' or env.sos_dict[
@@ -5,6 +5,7 @@
 
 import copy
 import glob
+import hashlib
 import os
 import pickle
 import re
@@ -13,24 +14,52 @@ import shutil
 import subprocess
 import sys
 from collections.abc import Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from copy import deepcopy
 from itertools import combinations, tee
 from pathlib import Path, WindowsPath, PosixPath
 from shlex import quote
 from typing import Union, Dict, Any, List
 import fasteners
-import pkg_resources
 
 from .utils import (Error, env, pickleable, short_repr, stable_repr)
 from .pattern import extract_pattern
 from .eval import interpolate
 from .controller import request_answer_from_controller, send_message_to_controller
+from .entrypoints import get_entry_point
+from .signatures import get_file_hash_cache
 
 try:
     from xxhash import xxh64 as hash_md5
 except ImportError:
     from hashlib import md5 as hash_md5
 
+# algorithms that can be used to calculate file signatures, selected with
+# option hash_algorithm of the configuration file. Other algorithms can be
+# added to this dictionary as a name and a function that returns a hash
+# object with methods update() and hexdigest().
+file_hashers = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'blake2b': hashlib.blake2b,
+}
+try:
+    import xxhash
+    file_hashers['xxh64'] = xxhash.xxh64
+    if hasattr(xxhash, 'xxh3_64'):
+        file_hashers['xxh3'] = xxhash.xxh3_64
+        file_hashers['xxh128'] = xxhash.xxh3_128
+except ImportError:
+    pass
+# algorithm used if option hash_algorithm is not set, which is the fastest
+# algorithm available
+default_hash_algorithm = 'xxh64' if 'xxh64' in file_hashers else 'md5'
+try:
+    import blake3
+    file_hashers['blake3'] = blake3.blake3
+except ImportError:
+    pass
+
 __all__ = ['dynamic', 'executable', 'env_variable', 'sos_variable']
 
 
@@ -109,14 +138,42 @@ def objectMD5(obj):
         return ''
 
 
-def fileMD5(filename, partial=True):
+def split_file_hash(value):
+    '''Split a file signature into algorithm and digest. Signatures calculated
+    with algorithms other than md5 are saved as "algorithm:digest". Untagged
+    signatures are md5, or xxh64 if they were created with xxhash installed.
+    The two cannot be confused because md5 digests have 32 and xxh64 digests
+    have 16 characters.'''
+    if ':' in value:
+        return tuple(value.split(':', 1))
+    return ('xxh64' if len(value) == 16 else 'md5', value)
+
+
+def fileMD5(filename, partial=True, algorithm=None):
     '''Calculate partial MD5, basically the first and last 8M
     of the file for large files. This should signicicantly reduce
     the time spent on the creation and comparison of file signature
-    when dealing with large bioinformat ics datasets. '''
-    filesize = os.path.getsize(filename)
+    when dealing with large bioinformat ics datasets. Calculated
+    hashes are saved to a project-level cache keyed by device, inode,
+    size and mtime of the file so that unchanged files are not read again.
+
+    The hash is calculated with algorithm (default to option hash_algorithm
+    of env.config, or xxh64 if xxhash is installed and md5 otherwise), and is
+    returned as "algorithm:digest" unless the algorithm is md5 or xxh64.'''
+    if algorithm is None:
+        algorithm = env.config['hash_algorithm'] or default_hash_algorithm
+    if algorithm not in file_hashers:
+        raise ValueError(
+            f'Unsupported hash algorithm {algorithm}: {", ".join(file_hashers.keys())} expected'
+        )
+    stat = os.stat(filename)
+    cache = get_file_hash_cache()
+    cached = cache.get(stat, partial, algorithm)
+    if cached is not None:
+        return cached
+    filesize = stat.st_size
     # calculate md5 for specified file
-    md5 = hash_md5()
+    md5 = file_hashers[algorithm]()
     block_size = 2**20  # buffer of 1M
     try:
         # 2**24 = 16M
@@ -142,7 +199,10 @@ def fileMD5(filename, partial=True):
                     md5.update(data)
     except IOError as e:
         sys.exit(f'Failed to read {filename}: {e}')
-    return md5.hexdigest()
+    res = md5.hexdigest() if algorithm in (
+        'md5', 'xxh64') else f'{algorithm}:{md5.hexdigest()}'
+    cache.set(filename, stat, partial, algorithm, res)
+    return res
 
 
 class BaseTarget(object):
@@ -816,19 +876,38 @@ class file_target(path, BaseTarget):
                     sig_mtime, sig_size, sig_md5 = sig.read().strip().split()
             except Exception:
                 return False
-        if not self.exists():
+        matched = self.validate_stat((sig_mtime, sig_size, sig_md5))
+        if matched is not None:
+            return matched
+        # validate with the algorithm with which the signature was created
+        algorithm, digest = split_file_hash(sig_md5)
+        if algorithm not in file_hashers:
+            # e.g. xxh64 signatures if xxhash is no longer installed
+            return False
+        return split_file_hash(fileMD5(self,
+                                       algorithm=algorithm))[1] == digest
+
+    def validate_stat(self, sig):
+        '''Check if file matches its signature without reading its content.
+        Return True or False if the file matches or does not match the
+        signature by its size and modification time, or None if the content
+        of the file needs to be checked.'''
+        sig_mtime, sig_size, sig_md5 = sig
+        try:
+            st = os.stat(self)
+        except FileNotFoundError:
             if (self + '.zapped').is_file():
                 with open(self + '.zapped') as sig:
                     line = sig.readline()
-                    return sig_md5 == line.strip().rsplit('\t', 3)[-1]
+                    return split_file_hash(sig_md5) == split_file_hash(
+                        line.strip().rsplit('\t', 3)[-1])
             else:
                 return False
-
-        if int(sig_size) != os.path.getsize(self):
+        if int(sig_size) != st.st_size:
             return False
-        if sig_mtime == os.path.getmtime(self):
+        if sig_mtime == st.st_mtime:
             return True
-        return fileMD5(self) == sig_md5
+        return None
 
     def write_sig(self):
         '''Write signature to sig store'''
@@ -2009,6 +2088,102 @@ class sos_targets(BaseTarget, Sequence, os.PathLike):
             return target in self._targets
 
 
+_sig_pool = None
+_sig_pool_pid = None
+
+# target classes by name, including classes defined in this module and
+# classes registered by other modules through entry points
+_target_classes = {}
+
+
+def get_target_class(target_type):
+    if target_type in _target_classes:
+        return _target_classes[target_type]
+    if target_type in globals():
+        target_class = globals()[target_type]
+    else:
+        entrypoint = get_entry_point('sos_targets', target_type)
+        if entrypoint is None:
+            raise ValueError(f'Failed to identify target class {target_type}')
+        target_class = entrypoint.load()
+    _target_classes[target_type] = target_class
+    return target_class
+
+
+def _target_signature(target):
+    try:
+        return target.target_signature()
+    except Exception as e:
+        return e
+
+
+def _validate_target(item):
+    try:
+        return item[0].validate(item[1])
+    except Exception as e:
+        return e
+
+
+def _get_sig_pool():
+    global _sig_pool, _sig_pool_pid
+    # thread pool cannot be inherited by forked processes
+    if _sig_pool is None or _sig_pool_pid != os.getpid():
+        _sig_pool = ThreadPoolExecutor(
+            max_workers=int(env.config['sig_threads'] or 8))
+        _sig_pool_pid = os.getpid()
+    return _sig_pool
+
+
+def find_failed_target(func, items):
+    '''Return the index of an item for which func returns a false value, or
+    None if there is no such item, and indexes of items for which func
+    returns an exception, which are neither matched nor failed. Items are
+    processed by a thread pool and pending items are cancelled as soon as a
+    failed item is found.'''
+    errors = []
+    if len(items) <= 1:
+        for i, x in enumerate(items):
+            res = func(x)
+            if isinstance(res, Exception):
+                errors.append(i)
+            elif not res:
+                return i, errors
+        return None, errors
+    pool = _get_sig_pool()
+    futures = {pool.submit(func, x): i for i, x in enumerate(items)}
+    try:
+        for fut in as_completed(futures):
+            res = fut.result()
+            if isinstance(res, Exception):
+                errors.append(futures[fut])
+            elif not res:
+                return futures[fut], errors
+    finally:
+        for fut in futures:
+            fut.cancel()
+    return None, sorted(errors)
+
+
+def map_targets(func, items):
+    '''Apply func to items and return results in the order of items. Because
+    the calculation of file signatures is I/O bound, items with file targets
+    are processed by a bounded thread pool, whereas other targets, which might
+    not be thread safe, are processed in the current thread.'''
+
+    def is_file(item):
+        return isinstance(item[0] if isinstance(item, tuple) else item,
+                          file_target)
+
+    if sum(is_file(x) for x in items) <= 1:
+        return [func(x) for x in items]
+    pool = _get_sig_pool()
+    futures = [pool.submit(func, x) if is_file(x) else None for x in items]
+    return [
+        fut.result() if fut is not None else func(x)
+        for fut, x in zip(futures, items)
+    ]
+
+
 class InMemorySignature:
 
     def __init__(self,
@@ -2049,33 +2224,24 @@ class InMemorySignature:
             env.log_to_file(
                 'TARGET',
                 f'Set undetermined output files to {env.sos_dict["_output"]}')
-        input_sig = {}
-        for f in self.input_files:
-            try:
-                input_sig[str(f)] = f.target_signature()
-            except Exception:
-                env.logger.debug(
-                    f'Failed to create signature: input target {f} does not exist'
-                )
-                return False
-        output_sig = {}
-        for f in self.output_files:
-            try:
-                output_sig[str(f)] = f.target_signature()
-            except Exception:
-                env.logger.debug(
-                    f'Failed to create signature: output target {f} does not exist'
-                )
-                return False
-        dependent_sig = {}
-        for f in self.dependent_files:
-            try:
-                dependent_sig[str(f)] = f.target_signature()
-            except Exception:
-                env.logger.debug(
-                    f'Failed to create signature: dependent target {f} does not exist'
-                )
-                return False
+        # calculate signatures of all targets together
+        groups = [('input', self.input_files._targets),
+                  ('output', self.output_files._targets),
+                  ('dependent', self.dependent_files._targets)]
+        sigs = iter(
+            map_targets(_target_signature, sum([x[1] for x in groups], [])))
+        target_sigs = []
+        for ftype, files in groups:
+            target_sigs.append({})
+            for f in files:
+                sig = next(sigs)
+                if isinstance(sig, Exception):
+                    env.logger.debug(
+                        f'Failed to create signature: {ftype} target {f} does not exist'
+                    )
+                    return False
+                target_sigs[-1][str(f)] = sig
+        input_sig, output_sig, dependent_sig = target_sigs
         init_context_sig = {
             var: objectMD5(self.init_signature[var])
             for var in self.init_signature
@@ -2102,17 +2268,26 @@ class InMemorySignature:
         }
         return self.content
 
+    def _missing_target(self):
+        # check the existence of files before other targets, which can be
+        # more expensive to check
+        for x in sorted(
+                self.input_files._targets + self.output_files._targets +
+                self.dependent_files._targets,
+                key=lambda x: not isinstance(x, file_target)):
+            if not x.target_exists('any'):
+                return f'Missing target {x}'
+        return None
+
     def validate(self, signature):
         '''Check if ofiles and ifiles match signatures recorded in md5file'''
         if not signature:
             return 'Empty signature'
+        return self._missing_target() or self._validate_signature(signature)
+
+    def _validate_signature(self, signature):
         sig_files = self.input_files._targets + self.output_files._targets + \
             self.dependent_files._targets
-        for x in sig_files:
-            if not x.target_exists('any'):
-                return f'Missing target {x}'
-        #
-
         files_checked = {x.target_name(): False for x in sig_files}
         res = {'input': [], 'output': [], 'depends': [], 'vars': {}}
         cur_type = 'input'
@@ -2140,38 +2315,68 @@ class InMemorySignature:
 
         res['vars'].update(signature['end_context'])
         #
+        # resolve targets first and validate them together
+        targets = []
         for cur_type in ['input', 'output', 'depends']:
             for f, m in signature[cur_type].items():
                 try:
                     if '(' in f and ')' in f:
                         # this part is hard, because this can be a customized target.
                         target_type = f.split('(')[0]
-                        target_class = None
-                        if target_type in globals():
-                            target_class = eval(target_type)
-                        else:
-                            # check registry
-                            for entrypoint in pkg_resources.iter_entry_points(
-                                    group='sos_targets'):
-                                if entrypoint.name.strip() == target_type:
-                                    target_class = entrypoint.load()
-                                    break
-                        if target_class is None:
-                            raise ValueError(
-                                f'Failed to identify target class {target_type}'
-                            )
                         # parameter of class?
-                        freal = eval(f, {target_type: target_class})
+                        freal = eval(
+                            f, {target_type: get_target_class(target_type)})
                     else:
                         freal = file_target(f)
-                    if not freal.validate(m):
-                        return f'Target {f} does not exist or does not match saved signature {m}'
-                    res[cur_type].append(freal.target_name(
-                    ) if isinstance(freal, file_target) else freal)
-                    files_checked[freal.target_name()] = True
+                    targets.append((cur_type, f, m, freal))
                 except Exception as e:
                     env.logger.debug(f'Wrong md5 in signature: {e}')
         #
+        # validate targets from the cheapest to the most expensive checks,
+        # namely size and modification time of files, other targets, and
+        # content of files, and stop at the first mismatch
+        stat_unmatched = []
+        other_targets = []
+        # targets that cannot be validated are ignored
+        skipped = set()
+        for idx, (cur_type, f, m, freal) in enumerate(targets):
+            if not isinstance(freal, file_target):
+                other_targets.append(idx)
+                continue
+            try:
+                matched = freal.validate_stat(m)
+            except Exception as e:
+                env.logger.debug(f'Wrong md5 in signature: {e}')
+                skipped.add(idx)
+                continue
+            if matched is None:
+                stat_unmatched.append(idx)
+            elif not matched:
+                return f'Target {f} does not exist or does not match saved signature {m}'
+        for idx in other_targets:
+            matched = _validate_target((targets[idx][3], targets[idx][2]))
+            if isinstance(matched, Exception):
+                env.logger.debug(f'Wrong md5 in signature: {matched}')
+                skipped.add(idx)
+            elif not matched:
+                return f'Target {targets[idx][1]} does not exist or does not match saved signature {targets[idx][2]}'
+        failed, errors = find_failed_target(
+            _validate_target, [(targets[x][3], targets[x][2])
+                               for x in stat_unmatched])
+        for x in errors:
+            env.logger.debug(
+                f'Wrong md5 in signature: {targets[stat_unmatched[x]][2]}')
+            skipped.add(stat_unmatched[x])
+        if failed is not None:
+            cur_type, f, m, freal = targets[stat_unmatched[failed]]
+            return f'Target {f} does not exist or does not match saved signature {m}'
+        for idx, (cur_type, f, m, freal) in enumerate(targets):
+            if idx in skipped:
+                continue
+            res[cur_type].append(freal.target_name(
+            ) if isinstance(freal, file_target) else freal)
+            files_checked[freal.target_name()] = True
+        #
         if not all(files_checked.values()):
             return f'No MD5 signature for {", ".join(x for x,y in files_checked.items() if not y)}'
         if 'input_obj' in signature:
@@ -2314,10 +2519,10 @@ class RuntimeInfo(InMemorySignature):
         if ret is False:
             env.logger.debug(f'Failed to write signature {self.sig_id}')
             return ret
-        send_message_to_controller(['step_sig', self.sig_id, ret])
+        send_message_to_controller(
+            ['step_sig', self.sig_id, ret])
         send_message_to_controller([
-            'workflow_sig', 'tracked_files', self.sig_id,
-            repr({
+            'workflow_sig', 'tracked_files', self.sig_id, {
                 'input_files': [
                     str(f.resolve())
                     for f in self.input_files
@@ -2333,12 +2538,14 @@ class RuntimeInfo(InMemorySignature):
                     for f in self.output_files
                     if isinstance(f, file_target)
                 ]
-            })
+            }
         ])
         return True
 
-    def validate(self):
-        '''Check if ofiles and ifiles match signatures recorded in md5file'''
+    def validate(self, signature=None):
+        '''Check if ofiles and ifiles match signatures recorded in md5file. The
+        signature will be retrieved from the controller if it is not provided
+        (e.g. prefetched by the step executor).'''
         if not self.sig_id:
             return f'no signature for steps with nested workflow'
         if 'TARGET' in env.config['SOS_DEBUG'] or 'ALL' in env.config[
@@ -2346,13 +2553,15 @@ class RuntimeInfo(InMemorySignature):
             env.log_to_file('TARGET', f'Validating {self.sig_id}')
         #
         # file not exist?
-        sig_files = self.input_files._targets + self.output_files._targets + \
-            self.dependent_files._targets
-        for x in sig_files:
-            if not x.target_exists('any'):
-                return f'Missing target {x}'
+        missing = self._missing_target()
+        if missing:
+            return missing
         #
-        sig = request_answer_from_controller(['step_sig', 'get', self.sig_id])
+        if signature is None:
+            sig = request_answer_from_controller(
+                ['step_sig', 'get', self.sig_id])
+        else:
+            sig = signature
         if not sig:
             return f"No signature found for {self.sig_id}"
-        return super(RuntimeInfo, self).validate(sig)
+        return self._validate_signature(sig)
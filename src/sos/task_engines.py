@@ -11,7 +11,7 @@ import time
 from collections import OrderedDict, defaultdict
 
 from .eval import cfg_interpolate
-from .utils import env, expand_time
+from .utils import env, expand_size, expand_time
 from .tasks import TaskFile
 from .messages import encode_msg
 
@@ -64,6 +64,17 @@ class TaskEngine(threading.Thread):
             'TASK',
             f'Using {self.max_running_jobs} concurrent jobs for task engine {self.alias}'
         )
+        # cores and memory that can be used by all tasks, None if tasks are
+        # limited only by max_running_jobs. Derived engines that know the
+        # capacity of the host can set them. Note that max_cores and max_mem
+        # of hosts are limits of individual tasks.
+        self.packing_cores = None
+        self.packing_mem = None
+        # cores and mem requested by each task, and time since which tasks
+        # have been waiting for resources
+        self._task_resources = {}
+        self._blocked_since = {}
+        self._last_selection = (None, set())
 
         #
         # multiple thread job submission does not work because the threads share the
@@ -89,6 +100,72 @@ class TaskEngine(threading.Thread):
         # let us report the status of task engine from time to time
         self.last_report = time.time()
 
+    # tasks that have been waiting for resources for this long (in seconds)
+    # can no longer be bypassed by smaller tasks
+    max_bypass_time = 60
+
+    def resource_aware(self):
+        return self.packing_cores is not None or self.packing_mem is not None
+
+    def task_resources(self, task_id):
+        '''Return cores and mem requested by a task'''
+        if task_id not in self._task_resources:
+            try:
+                runtime = TaskFile(task_id).runtime['_runtime']
+                cores = int(runtime.get('cores', None) or 1)
+                mem = runtime.get('mem', None) or 0
+                mem = expand_size(mem) if isinstance(mem, str) else int(mem)
+            except Exception as e:
+                env.log_to_file(
+                    'TASK', f'Failed to get resources of task {task_id}: {e}')
+                cores, mem = 1, 0
+            self._task_resources[task_id] = (cores, mem)
+        return self._task_resources[task_id]
+
+    def _used_resources(self):
+        active = [x for slot in self.submitting_tasks.keys() for x in slot
+                 ] + self.running_tasks
+        resources = [self.task_resources(x) for x in active]
+        return sum(x[0] for x in resources), sum(x[1] for x in resources)
+
+    def _select_tasks(self, num_active_tasks):
+        '''Select pending tasks that fit into available cores and memory,
+        in the order they are submitted (first fit). Tasks larger than the
+        capacity are submitted only if no other task is active.'''
+        now = time.time()
+        # tasks cannot be selected if no task has completed or been added
+        # since the last selection, which is repeated at most once a second
+        state = (len(self.pending_tasks), num_active_tasks, int(now))
+        if state == self._last_selection[0]:
+            return self._last_selection[1]
+        used_cores, used_mem = self._used_resources()
+        selected = []
+        for tid in self.pending_tasks:
+            if num_active_tasks + len(selected) >= self.max_running_jobs:
+                break
+            if self.task_status[tid] == 'running' or tid in self.canceled_tasks:
+                # will be removed from pending tasks
+                selected.append(tid)
+                continue
+            cores, mem = self.task_resources(tid)
+            if (num_active_tasks == 0 and not selected) or (
+                (self.packing_cores is None or
+                 used_cores + cores <= self.packing_cores) and
+                (self.packing_mem is None or
+                 used_mem + mem <= self.packing_mem)):
+                selected.append(tid)
+                used_cores += cores
+                used_mem += mem
+                self._blocked_since.pop(tid, None)
+                continue
+            # smaller tasks can use the resources before the task can be
+            # submitted, unless it has been waiting for too long
+            if now - self._blocked_since.setdefault(
+                    tid, now) > self.max_bypass_time:
+                break
+        self._last_selection = (state, set(selected))
+        return self._last_selection[1]
+
     def notify_controller(self, msg):
         if env.config['exec_mode']:
             # set cell_id to slave_id so that the frontend knows which
@@ -293,7 +370,11 @@ class TaskEngine(threading.Thread):
                 num_active_tasks = sum(
                     len(x) for x in self.submitting_tasks.keys()) + len(
                         self.running_tasks)
-                if num_active_tasks >= self.max_running_jobs:
+                # tasks that fit into available cores and memory
+                selected = self._select_tasks(
+                    num_active_tasks) if self.resource_aware() else None
+                if num_active_tasks >= self.max_running_jobs or (
+                        selected is not None and not selected):
                     if time.time() - self.last_report > 60:
                         self.last_report = time.time()
                         env.logger.info(
@@ -309,6 +390,8 @@ class TaskEngine(threading.Thread):
                 removed_from_pending = set()
                 with threading.Lock():
                     for idx, tid in enumerate(self.pending_tasks):
+                        if selected is not None and tid not in selected:
+                            continue
                         if self.task_status[tid] == 'running':
                             # env.logger.info(f'{tid} ``runnng``')
                             removed_from_pending.add(tid)
@@ -331,6 +414,11 @@ class TaskEngine(threading.Thread):
                         if n_submitted >= self.max_running_jobs - num_active_tasks:
                             break
 
+                    if slot:
+                        # the last selected task might not be the last
+                        # pending task
+                        removed_from_pending.update(slot)
+                        slots.append(slot)
                     if removed_from_pending:
                         self.pending_tasks = [
                             x for x in self.pending_tasks
@@ -553,6 +641,12 @@ class TaskEngine(threading.Thread):
                 self.pending_tasks.append(task_id)
                 self.task_status[task_id] = 'pending'
                 self.running_pending_tasks.pop(task_id)
+            # resources of tasks that are no longer pending or running
+            if status in ('missing', 'completed', 'failed',
+                          'aborted') and task_id not in self.running_tasks and (
+                              task_id not in self.pending_tasks):
+                self._task_resources.pop(task_id, None)
+                self._blocked_since.pop(task_id, None)
 
     def query_tasks(self,
                     tasks=None,
@@ -687,6 +781,13 @@ class BackgroundProcess_TaskEngine(TaskEngine):
         else:
             # default allow stacking of up to 1000 jobs
             self.batch_size = 1000
+        # tasks on localhost can be packed into cores and memory specified
+        # by packing_cores and packing_mem
+        if self.config.get('address', None) == 'localhost':
+            self.packing_cores = self.config.get('packing_cores', None)
+            self.packing_mem = self.config.get('packing_mem', None)
+            if isinstance(self.packing_mem, str):
+                self.packing_mem = expand_size(self.packing_mem)
 
     def execute_tasks(self, task_ids):
         if not super(BackgroundProcess_TaskEngine,
@@ -19,13 +19,14 @@ from .eval import SoS_eval, SoS_exec
 from .monitor import ProcessMonitor
 from .targets import (InMemorySignature, file_target, sos_step, dynamic,
                       sos_targets)
-from .utils import StopInputGroup, env, pickleable, ProcessKilled, get_localhost_ip
+from .utils import StopInputGroup, env, pickleable, ProcessKilled
 from .tasks import TaskFile, combine_results, remove_task_files, monitor_interval, resource_monitor_interval
 from .step_executor import parse_shared_vars
 from .messages import decode_msg
 from .executor_utils import __null_func__, get_traceback_msg, prepare_env, clear_output
-from .controller import (Controller, connect_controllers,
-                         disconnect_controllers, create_socket, close_socket,
+from .controller import (Controller, bind_to_random_address,
+                         connect_controllers, disconnect_controllers,
+                         create_socket, close_socket,
                          request_answer_from_controller,
                          send_message_to_controller)
 
@@ -495,11 +496,9 @@ class BaseTaskExecutor(object):
             # start a result receving socket
             self.result_pull_socket = create_socket(env.zmq_context, zmq.PULL,
                                                     'substep result collector')
-            local_ip = get_localhost_ip()
-            port = self.result_pull_socket.bind_to_random_port(
-                f'tcp://{local_ip}')
             env.config['sockets'][
-                'result_push_socket'] = f'tcp://{local_ip}:{port}'
+                'result_push_socket'] = bind_to_random_address(
+                    self.result_pull_socket)
 
             # send tasks to the controller
             results = []
@@ -7,7 +7,6 @@ import os
 import fasteners
 import pickle
 import time
-import lzma
 import math
 import struct
 from enum import Enum
@@ -21,6 +20,7 @@ from .utils import (env, expand_time, linecount_of_file, sample_lines,
                     short_repr, tail_of_file, expand_size, format_HHMMSS,
                     DelayedAction, format_duration)
 from .targets import sos_targets
+from .compression import compress, decompress, dumps, loads
 
 monitor_interval = 5
 resource_monitor_interval = 60
@@ -323,6 +323,10 @@ class TaskFile(object):
     5. compressed stdout
     6. compressed stderr
     7. compressed pickled signatures
+
+    Version 4 of the file has the same header as version 3 but blocks are
+    compressed with sos.compression instead of lzma. Blocks of earlier
+    versions are still recognized by sos.compression.
     '''
     TaskHeader_v1 = namedtuple(
         'TaskHeader', 'version status last_modified '
@@ -350,9 +354,12 @@ class TaskFile(object):
 
     header_fmt = header_fmt_v3
 
+    # version of task files written by this version of sos
+    version_num = 4
+
     header_size = 220  # struct.calcsize(header_fmt)
-    tags_offset = [92, 96, 100]  # struct.calcsize(status_fmt + '6i')
-    tags_size = [128, 124, 120]
+    tags_offset = [92, 96, 100, 100]  # struct.calcsize(status_fmt + '6i')
+    tags_size = [128, 124, 120, 120]
 
     def __init__(self, task_id: str):
         self.task_id = task_id
@@ -375,10 +382,10 @@ class TaskFile(object):
         now = time.time()
         # we keep in both places because params.tags is the only place to have it for subtasks
         tags = params.tags
-        params_block = lzma.compress(pickle.dumps(params))
+        params_block = dumps(params)
         #env.logger.error(f'saving {self.task_id} params of size {len(params_block)}')
         header = self.TaskHeader(
-            version=3,
+            version=self.version_num,
             status=TaskStatus.new.value,
             last_modified=now,
             new_time=now,
@@ -412,7 +419,7 @@ class TaskFile(object):
         header = self._read_header(fh)
         now = time.time()
         header = header._replace(
-            version=2,
+            version=self.version_num,
             status=TaskStatus.new.value,
             last_modified=now,
             new_time=now,
@@ -446,28 +453,31 @@ class TaskFile(object):
         if struct.unpack('!h', data[:2])[0] == 1:
             header = self.TaskHeader_v1._make(
                 struct.unpack(self.header_fmt_v1, data))
-            if header.version not in (1, 2, 3):
+            if header.version not in (1, 2, 3, 4):
                 raise RuntimeError(
                     f'Corrupted task file {self.task_file}. Please report a bug if you can reproduce the generation of this file.'
                 )
             return self.TaskHeader(
                 runtime_size=0, shell_size=0,
-                **header._asdict())._replace(version=3)
+                **header._asdict())._replace(version=self.version_num)
         if struct.unpack('!h', data[:2])[0] == 2:
             header = self.TaskHeader_v2._make(
                 struct.unpack(self.header_fmt_v2, data))
-            if header.version not in (1, 2, 3):
+            if header.version not in (1, 2, 3, 4):
                 raise RuntimeError(
                     f'Corrupted task file {self.task_file}. Please report a bug if you can reproduce the generation of this file.'
                 )
             return self.TaskHeader(
-                runtime_size=0, **header._asdict())._replace(version=3)
+                runtime_size=0,
+                **header._asdict())._replace(version=self.version_num)
         header = self.TaskHeader._make(struct.unpack(self.header_fmt, data))
-        if header.version not in (1, 2, 3):
+        if header.version not in (1, 2, 3, 4):
             raise RuntimeError(
                 f'Corrupted task file {self.task_file}. Please report a bug if you can reproduce the generation of this file.'
             )
-        return header
+        # blocks written with the header are compressed with the current
+        # codec, and blocks of version 3 can still be read
+        return header._replace(version=self.version_num)
 
     def _write_header(self, fh, header):
         fh.seek(0, 0)
@@ -485,7 +495,7 @@ class TaskFile(object):
                 content += fh.read()
         if not content:
             return b''
-        return lzma.compress(content)
+        return compress(content)
 
     def add_outputs(self, keep_result=False):
         # get header
@@ -583,8 +593,8 @@ class TaskFile(object):
         signature = result.get('signature', {})
         result.pop('signature', None)
         #
-        result_block = lzma.compress(pickle.dumps(result))
-        signature_block = lzma.compress(pickle.dumps(signature)) if signature else b''
+        result_block = dumps(result)
+        signature_block = dumps(signature) if signature else b''
         with fasteners.InterProcessLock(
                 os.path.join(env.temp_dir, self.task_id + '.lck')):
             with open(self.task_file, 'r+b') as fh:
@@ -640,14 +650,13 @@ class TaskFile(object):
                 return {}
             else:
                 try:
-                    return pickle.loads(
-                        lzma.decompress(fh.read(header.params_size)))
+                    return loads(fh.read(header.params_size))
                 except Exception as e:
                     raise RuntimeError(
                         f'Failed to obtain params of task {self.task_id}: {e}')
 
     def _set_params(self, params):
-        params_block = lzma.compress(pickle.dumps(params))
+        params_block = dumps(params)
         #env.logger.error(f'updating {self.task_id} params of size {len(params_block)}')
         with fasteners.InterProcessLock(
                 os.path.join(env.temp_dir, self.task_id + '.lck')):
@@ -697,15 +706,14 @@ class TaskFile(object):
                 return {}
             fh.seek(self.header_size + header.params_size, 0)
             try:
-                return pickle.loads(
-                    lzma.decompress(fh.read(header.runtime_size)))
+                return loads(fh.read(header.runtime_size))
             except Exception as e:
                 env.logger.error(
                     f'Failed to obtain runtime of task {self.task_id}: {e}')
                 return {'_runtime': {}}
 
     def _set_runtime(self, runtime):
-        runtime_block = lzma.compress(pickle.dumps(runtime))
+        runtime_block = dumps(runtime)
         #env.logger.error(f'updating {self.task_id} params of size {len(params_block)}')
         with fasteners.InterProcessLock(
                 os.path.join(env.temp_dir, self.task_id + '.lck')):
@@ -765,8 +773,7 @@ class TaskFile(object):
                 params = {}
             else:
                 try:
-                    params = pickle.loads(
-                        lzma.decompress(fh.read(header.params_size)))
+                    params = loads(fh.read(header.params_size))
                 except Exception as e:
                     env.logger.error(
                         f'Failed to obtain params with runtime of task {self.task_id}: {e}'
@@ -776,8 +783,7 @@ class TaskFile(object):
                 params.sos_dict['_runtime'] = {}
             if header.runtime_size > 0:
                 try:
-                    runtime = pickle.loads(
-                        lzma.decompress(fh.read(header.runtime_size)))
+                    runtime = loads(fh.read(header.runtime_size))
                 except Exception as e:
                     env.logger.error(
                         f'Failed to obtain runtime of task {self.task_id}: {e}')
@@ -898,7 +904,7 @@ class TaskFile(object):
             fh.seek(self.header_size + header.params_size + header.runtime_size,
                     0)
             try:
-                return lzma.decompress(fh.read(header.shell_size)).decode()
+                return decompress(fh.read(header.shell_size)).decode()
             except Exception as e:
                 env.logger.warning(f'Failed to decode shell: {e}')
                 return ''
@@ -914,7 +920,7 @@ class TaskFile(object):
                 self.header_size + header.params_size + header.runtime_size +
                 header.shell_size, 0)
             try:
-                return lzma.decompress(fh.read(header.pulse_size)).decode()
+                return decompress(fh.read(header.pulse_size)).decode()
             except Exception as e:
                 env.logger.warning(f'Failed to decode pulse: {e}')
                 return ''
@@ -930,7 +936,7 @@ class TaskFile(object):
                 self.header_size + header.params_size + header.runtime_size +
                 header.pulse_size + header.shell_size, 0)
             try:
-                return lzma.decompress(fh.read(header.stdout_size)).decode()
+                return decompress(fh.read(header.stdout_size)).decode()
             except Exception as e:
                 env.logger.warning(f'Failed to decode stdout: {e}')
                 return ''
@@ -946,7 +952,7 @@ class TaskFile(object):
                 self.header_size + header.params_size + header.runtime_size +
                 header.shell_size + header.pulse_size + header.stdout_size, 0)
             try:
-                return lzma.decompress(fh.read(header.stderr_size)).decode()
+                return decompress(fh.read(header.stderr_size)).decode()
             except Exception as e:
                 env.logger.warning(f'Failed to decode stderr: {e}')
                 return ''
@@ -963,8 +969,7 @@ class TaskFile(object):
                 header.shell_size + header.pulse_size + header.stdout_size +
                 header.stderr_size, 0)
             try:
-                return pickle.loads(
-                    lzma.decompress(fh.read(header.result_size)))
+                return loads(fh.read(header.result_size))
             except Exception as e:
                 env.logger.warning(f'Failed to decode result: {e}')
                 return {'ret_code': 1}
@@ -981,8 +986,7 @@ class TaskFile(object):
                 header.shell_size + header.pulse_size + header.stdout_size +
                 header.stderr_size + header.result_size, 0)
             try:
-                return pickle.loads(
-                    lzma.decompress(fh.read(header.signature_size)))
+                return loads(fh.read(header.signature_size))
             except Exception as e:
                 env.logger.warning(f'Failed to decode signature: {e}')
                 return {'ret_code': 1}
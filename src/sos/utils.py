@@ -26,7 +26,7 @@ from zmq.log.handlers import PUBHandler
 import urllib.parse
 import urllib.request
 from collections.abc import Sequence, Mapping, Set, KeysView
-from collections import defaultdict
+from collections import ChainMap, defaultdict
 from html.parser import HTMLParser
 from io import FileIO, StringIO, BytesIO
 from typing import Optional, List, Dict
@@ -285,6 +285,118 @@ class WorkflowDict(object):
         }
 
 
+class LayeredConfig(ChainMap):
+    '''A copy-on-write configuration dictionary. Values are looked up from a
+    local layer and a list of parent layers that are shared with other
+    configurations and are never modified. Assignments are written to the
+    local layer, and mutable values (dict, list and set) of parent layers are
+    copied once to the local layer when they are first accessed so that they
+    can be modified in place. Missing keys default to '' as in
+    defaultdict(str).'''
+
+    # maximum number of parent layers before they are merged
+    max_depth = 8
+
+    def __missing__(self, key):
+        return ''
+
+    def __getitem__(self, key):
+        local = self.maps[0]
+        if key in local:
+            return local[key]
+        for mapping in self.maps[1:]:
+            if key in mapping:
+                value = mapping[key]
+                if isinstance(value, (dict, list, set)):
+                    # promoted to the local layer, from which later reads
+                    # are served without copying
+                    value = local[key] = copy.deepcopy(value)
+                return value
+        return self.__missing__(key)
+
+    def _inherited(self, key):
+        for mapping in self.maps[1:]:
+            if key in mapping:
+                return True, mapping[key]
+        return False, None
+
+    def update(self, *args, **kwargs):
+        # values that are identical to inherited values are not copied to
+        # the local layer
+        local = self.maps[0]
+        for key, value in dict(*args, **kwargs).items():
+            if key not in local:
+                inherited, old_value = self._inherited(key)
+                try:
+                    if inherited and old_value == value:
+                        continue
+                except Exception:
+                    pass
+            local[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.maps[0] and not self._inherited(key)[0]:
+            del self.maps[0][key]
+            return
+        # deleting inherited values requires a private copy of all values
+        self.maps = [self.flatten()]
+        del self.maps[0][key]
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if args:
+            return args[0]
+        raise KeyError(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def flatten(self):
+        '''Return all values as a dictionary without copying them'''
+        res = {}
+        for mapping in reversed(self.maps):
+            res.update(mapping)
+        return res
+
+    def fork(self):
+        '''Return a configuration that shares all values with the current
+        one. The local layer is frozen and shared by both configurations.
+        Mutable values of the local layer might have been obtained and are
+        modified by callers, so they are copied to the frozen layer and the
+        current configuration keeps the originals.'''
+        local = self.maps[0]
+        if local:
+            frozen = {
+                key: copy.deepcopy(value)
+                if isinstance(value, (dict, list, set)) else value
+                for key, value in local.items()
+            }
+            self.maps = [{
+                key: value
+                for key, value in local.items()
+                if isinstance(value, (dict, list, set))
+            }, frozen] + self.maps[1:]
+        if len(self.maps) > self.max_depth + 1:
+            merged = {}
+            for mapping in reversed(self.maps[1:]):
+                merged.update(mapping)
+            self.maps = [self.maps[0], merged]
+        return LayeredConfig({}, *self.maps[1:])
+
+    def __reduce__(self):
+        return (LayeredConfig, (self.flatten(),))
+
+    def __deepcopy__(self, memo):
+        return LayeredConfig(copy.deepcopy(self.flatten(), memo))
+
+
 #
 # Runtime environment
 #
@@ -343,20 +455,20 @@ class RuntimeEnvironments(object):
         # save old env
         if idx == self._sub_idx:
             return
+        if not isinstance(env.config, LayeredConfig):
+            env.config = LayeredConfig(env.config)
         self._sub_envs[self._sub_idx]['sos_dict'] = self.sos_dict
-        self._sub_envs[self._sub_idx]['config'] = copy.deepcopy(env.config)
+        self._sub_envs[self._sub_idx]['config'] = env.config
         self._sub_envs[self._sub_idx]['socket'] = env.__socket__ if hasattr(
             env, '__socket__') else None
         if len(self._sub_envs) <= idx:
-            self._sub_envs.append({
-                'sos_dict': WorkflowDict(),
-                'config': copy.deepcopy(env.config),
-                'socket': env.__socket__ if hasattr(env, '__socket__') else None
-            })
+            self._sub_envs.append({})
         if not self._sub_envs[idx]:
+            # new environments share configurations with the current one
+            # and keep only their changes
             self._sub_envs[idx] = {
                 'sos_dict': WorkflowDict(),
-                'config': copy.deepcopy(env.config),
+                'config': env.config.fork(),
                 'socket': env.__socket__ if hasattr(env, '__socket__') else None
             }
         self.sos_dict = self._sub_envs[idx]['sos_dict']
@@ -388,8 +500,7 @@ class RuntimeEnvironments(object):
         #
         # run mode, this mode controls how SoS actions behave
         #
-        self.config = defaultdict(str)
-        self.config.update({
+        self.config = LayeredConfig({
             'config_file': None,
             'output_dag': None,
             'output_report': None,
@@ -398,6 +509,21 @@ class RuntimeEnvironments(object):
             'worker_procs': ['2'],
             'max_running_jobs': None,
             'sig_mode': 'default',
+            'hash_algorithm': None,
+            'codec': 'zlib',
+            'sig_journal_mode': 'DELETE',
+            'sig_synchronous': 'FULL',
+            'msg_compress_size': 1024 * 1024,
+            'worker_scheduling': 'priority',
+            'metrics_interval': None,
+            'metrics_port': None,
+            'transport': 'ipc',
+            'worker_prewarm': False,
+            'worker_daemon': False,
+            'worker_idle_timeout': 60,
+            'worker_heartbeat_timeout': 30,
+            'packing_cores': None,
+            'packing_mem': None,
             'run_mode': 'run',
             'verbosity': 1,
             # determined later
@@ -1288,6 +1414,19 @@ class TimeoutInterProcessLock(fasteners.InterProcessLock):
 config_cache: dict = {}
 
 
+# options in config files that are copied to env.config, including algorithm
+# used to calculate file signatures, codec used to compress signatures and
+# task files, journal mode and synchronous level of signature databases, size
+# above which messages between controller and workers are compressed, and the
+# order ('priority' or 'fifo') in which steps and substeps are executed
+env_config_options = ('hash_algorithm', 'codec', 'sig_journal_mode',
+                      'sig_synchronous', 'msg_compress_size',
+                      'worker_scheduling', 'metrics_interval', 'metrics_port',
+                      'transport', 'worker_prewarm', 'worker_daemon',
+                      'worker_idle_timeout', 'packing_cores', 'packing_mem',
+                      'worker_heartbeat_timeout')
+
+
 def load_config_files(filename=None):
     # user-specified configuration file.
     if filename is None and 'config_file' in env.config:
@@ -1308,6 +1447,10 @@ def load_config_files(filename=None):
     if (filename, filemtime, extra_cfg) in config_cache:
         env.sos_dict.set('CONFIG',
                          config_cache[(filename, filemtime, extra_cfg)])
+        for key in env_config_options:
+            if key in config_cache[(filename, filemtime, extra_cfg)]:
+                env.config[key] = config_cache[(filename, filemtime,
+                                                extra_cfg)][key]
         return config_cache[(filename, filemtime, extra_cfg)]
 
     cfg = {}
@@ -1441,6 +1584,10 @@ def load_config_files(filename=None):
             res[k] = v
     config_cache[(filename, filemtime, extra_cfg)] = res
     env.sos_dict.set('CONFIG', res)
+    # options that are passed to workers through env.config
+    for key in env_config_options:
+        if key in res:
+            env.config[key] = res[key]
     return res
 
 
@@ -1867,7 +2014,18 @@ def separate_options(options: str) -> List[str]:
     return pieces
 
 
+_localhost_ip = None
+
+
 def get_localhost_ip():
+    '''Return the IP address of the local host, which is determined once for
+    each process and can be set with environment variable SOS_LOCALHOST_IP'''
+    global _localhost_ip
+    if _localhost_ip is not None:
+        return _localhost_ip
+    if os.environ.get('SOS_LOCALHOST_IP', ''):
+        _localhost_ip = os.environ['SOS_LOCALHOST_IP']
+        return _localhost_ip
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         # doesn't even have to be reachable
@@ -1877,6 +2035,7 @@ def get_localhost_ip():
         IP = '127.0.0.1'
     finally:
         s.close()
+    _localhost_ip = IP
     return IP
 
 
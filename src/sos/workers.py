@@ -3,20 +3,42 @@
 # Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
 # Distributed under the terms of the 3-clause BSD License.
 
+import ast
+import hashlib
 import multiprocessing as mp
 import os
 import signal
+import threading
 import time
 import pickle
+from collections import OrderedDict, defaultdict, deque
+from itertools import count
 from typing import Any, Dict, Optional
 
+import psutil
 import zmq
 
-from .controller import (close_socket, connect_controllers, create_socket,
+from .controller import (bind_to_random_address, close_socket,
+                         connect_controllers, create_socket,
                          disconnect_controllers)
 from .executor_utils import kill_all_subprocesses, prepare_env
-from .utils import env, ProcessKilled, short_repr, get_localhost_ip
-from .messages import encode_msg, decode_msg
+from .utils import (env, ProcessKilled, expand_size, short_repr,
+                    get_localhost_ip)
+from .messages import (encode_msg, decode_msg, message_stats,
+                       reset_message_stats)
+
+
+def send_heartbeats(identity, interval, stopped):
+    '''Tell the worker manager that a worker is alive every interval seconds
+    until stopped is set. Heartbeats are sent from a separate socket so that
+    they are sent while the worker is busy running a job.'''
+    socket = create_socket(env.zmq_context, zmq.DEALER, 'worker heartbeat')
+    socket.connect(env.config['sockets']['worker_backend'])
+    try:
+        while not stopped.wait(interval):
+            socket.send(encode_msg(['heartbeat', identity]))
+    finally:
+        close_socket(socket, now=True)
 
 
 def signal_handler(*args, **kwargs):
@@ -27,7 +49,7 @@ class Runner(object):
     '''
     This runner class takea a generator function and run it.
     1. When the generator returns None, continue to run without yielding.
-    2. When the generator returns a poller, continue is it receives any message in 0.2s.
+    2. When the generator returns a poller, continue if it has received any message.
     3. Otherwise return False.
     4. The the generator completes, return True.
 
@@ -57,9 +79,9 @@ class Runner(object):
                     self._poller = self._runner.send(None)
                     continue
 
-                # if there is a regular poll, let us wait
-                # 0.2 second and see if we can continue
-                if self._poller.poll(200):
+                # if there is a regular poll, continue if there is any message.
+                # Otherwise the worker will wait for the sockets of the runner
+                if self._poller.poll(0):
                     self._poller = self._runner.send(None)
                     continue
 
@@ -72,6 +94,12 @@ class Runner(object):
         # if there is anything waiting to be continued, proceed.
         return self._poller.poll(0)
 
+    def sockets(self):
+        # sockets the runner is waiting for
+        if isinstance(self._poller, zmq.Poller):
+            return [x[0] for x in self._poller.sockets]
+        return [self._poller]
+
 
 class SoS_Worker(mp.Process):
     '''
@@ -99,7 +127,11 @@ class SoS_Worker(mp.Process):
 
     '''
 
-    def __init__(self, config: Optional[Dict[str, Any]] = None,
+    def __init__(self,
+                 config: Optional[Dict[str, Any]] = None,
+                 environ: Optional[Dict[str, str]] = None,
+                 workdir: Optional[str] = None,
+                 verbosity: Optional[int] = None,
                  **kwargs) -> None:
         '''
 
@@ -109,6 +141,11 @@ class SoS_Worker(mp.Process):
             config_file: -c
             output_dag: -d
 
+        environ, workdir, verbosity:
+            environment variables, working directory and verbosity of the
+            worker if they differ from those of the parent process, e.g.
+            for workers started by the worker daemon
+
         args:
             command line argument passed to workflow. However, if a dictionary is passed,
             then it is assumed to be a nested workflow where parameters are made
@@ -118,7 +155,9 @@ class SoS_Worker(mp.Process):
         super(SoS_Worker, self).__init__(**kwargs)
         #
         self.config = config
-        self.local_ip = get_localhost_ip()
+        self.environ = environ
+        self.workdir = workdir
+        self.verbosity = verbosity
 
         # there can be multiple jobs for this worker, each using their own port and socket
         self._master_sockets = []
@@ -161,12 +200,11 @@ class SoS_Worker(mp.Process):
             assert idx == len(self._master_ports)
             # a new socket is needed
             env.master_socket = create_socket(env.zmq_context, zmq.PAIR)
-            port = env.master_socket.bind_to_random_port(
-                f'tcp://{self.local_ip}')
+            address = bind_to_random_address(env.master_socket)
             # switch to a new env_idx and returns new_idx, old_idx
             self._env_idx.append(env.request_new()[0])
             self._master_sockets.append(env.master_socket)
-            self._master_ports.append(f'tcp://{self.local_ip}:{port}')
+            self._master_ports.append(address)
             self._runners.append(True)
             if 'WORKER' in env.config['SOS_DEBUG'] or 'ALL' in env.config[
                     'SOS_DEBUG']:
@@ -175,6 +213,17 @@ class SoS_Worker(mp.Process):
                     f'WORKER {self.name} ({os.getpid()}) creates ports {self._master_ports}'
                 )
 
+    def wait_for_job(self):
+        '''Wait for a job from the worker manager, or a message to any of the
+        pending runners. Return True if a job is available.'''
+        poller = zmq.Poller()
+        poller.register(env.ctrl_socket, zmq.POLLIN)
+        for runner in self._runners:
+            if isinstance(runner, Runner):
+                for socket in runner.sockets():
+                    poller.register(socket, zmq.POLLIN)
+        return env.ctrl_socket in dict(poller.poll())
+
     def __repr__(self):
         return self.name + ' ' + ' '.join(
             str(x) if isinstance(x, Runner) else str(idx)
@@ -182,7 +231,16 @@ class SoS_Worker(mp.Process):
 
     def run(self):
         # env.logger.warning(f'Worker created {os.getpid()}')
+        if self.environ is not None:
+            os.environ.clear()
+            os.environ.update(self.environ)
+        if self.workdir is not None:
+            os.chdir(self.workdir)
+        if self.verbosity is not None:
+            env.verbosity = self.verbosity
         env.config.update(self.config)
+        # do not count messages of the parent process
+        reset_message_stats()
 
         if 'PROFILE' in env.config['SOS_DEBUG'] or 'ALL' in env.config[
                 'SOS_DEBUG']:
@@ -193,8 +251,11 @@ class SoS_Worker(mp.Process):
         env.zmq_context = connect_controllers()
 
         # create controller socket
-        env.ctrl_socket = create_socket(env.zmq_context, zmq.REQ,
+        env.ctrl_socket = create_socket(env.zmq_context, zmq.DEALER,
                                         'worker backend')
+        # the identity allows the worker manager to identify local workers
+        identity = f'{get_localhost_ip()}:{os.getpid()}'
+        env.ctrl_socket.setsockopt(zmq.IDENTITY, identity.encode())
         # worker_backend, or the router, might be on another machine
         env.log_to_file(
             'WORKER',
@@ -202,11 +263,24 @@ class SoS_Worker(mp.Process):
         )
         env.ctrl_socket.connect(self.config["sockets"]["worker_backend"])
 
+        # remote workers send heartbeats so that the worker manager can
+        # resubmit their jobs if they are lost
+        stop_heartbeats = threading.Event()
+        if self.config.get('worker_heartbeat_interval', None):
+            threading.Thread(
+                target=send_heartbeats,
+                args=(identity, self.config['worker_heartbeat_interval'],
+                      stop_heartbeats),
+                daemon=True).start()
+
         signal.signal(signal.SIGTERM, signal_handler)
         # result socket used by substeps
         env.result_socket = None
         env.result_socket_port = None
 
+        # whether or not the worker has told the worker manager that it can
+        # accept a job and is waiting for it
+        announced = False
         # wait to handle jobs
         while True:
             try:
@@ -219,19 +293,28 @@ class SoS_Worker(mp.Process):
                             idx].run_until_waiting()
                     continue
 
-                cr = self.completed_runners()
-                # using an completed slot or create a new one
-                new_idx = len(self._runners) if not cr else cr[0]
-                self.switch_to(new_idx)
+                if not announced:
+                    cr = self.completed_runners()
+                    # using an completed slot or create a new one
+                    new_idx = len(self._runners) if not cr else cr[0]
+                    self.switch_to(new_idx)
 
-                # although we have chosen one port, but we hae advertised multiple ports
-                # and the executor might choose another one. We therefore need to send all
-                # avilable ports to the controller. We also need to send a flag to let the
-                # controller know if we have any pending job, and the controller might decide
-                # to kill this worker.
-                env.ctrl_socket.send(
-                    encode_msg([self.num_pending()] + self.available_ports()))
+                    # although we have chosen one port, but we hae advertised multiple ports
+                    # and the executor might choose another one. We therefore need to send all
+                    # avilable ports to the controller. We also need to send a flag to let the
+                    # controller know if we have any pending job, and the controller might decide
+                    # to kill this worker.
+                    env.ctrl_socket.send(
+                        encode_msg([self.num_pending()] +
+                                   self.available_ports()))
+                    announced = True
+
+                # the worker manager replies only when it has a job for us so
+                # we wait for the job and for pending runners at the same time
+                if not self.wait_for_job():
+                    continue
                 reply = decode_msg(env.ctrl_socket.recv())
+                announced = False
 
                 if reply is None:
                     if len(wr) != 0:
@@ -246,8 +329,9 @@ class SoS_Worker(mp.Process):
                         )
                     break
                 if not reply:  # if an empty job is returned
-                    time.sleep(0.1)
                     continue
+                # pending runners might have been switched to
+                self.switch_to(new_idx)
 
                 #
                 # if a real job is returned, run it. _process_job will either return True
@@ -257,7 +341,7 @@ class SoS_Worker(mp.Process):
                     f'WORKER {self.name} ({os.getpid()}, {self.num_pending()} pending) receives {self._type_of_work(reply)} request {self._name_of_work(reply)} with master port {self._master_ports[new_idx]}'
                 )
 
-                if 'task' in reply:
+                if 'proc_vars' in reply:
                     self.run_substep(reply)
                     env.log_to_file(
                         'WORKER',
@@ -300,10 +384,13 @@ class SoS_Worker(mp.Process):
                     'PROCESS',
                     f'KeyboardInterrupt received by {os.getpid()}. Ignoring.')
         # Finished
+        stop_heartbeats.set()
         signal.signal(signal.SIGTERM, signal.SIG_DFL)
         kill_all_subprocesses(os.getpid())
 
         close_socket(env.result_socket, 'substep result', now=True)
+        env.log_to_file('WORKER',
+                        f'Messages of worker {os.getpid()}\n{message_stats()}')
 
         for socket in self._master_sockets:
             close_socket(socket, 'worker master', now=True)
@@ -438,6 +525,170 @@ class SoS_Worker(mp.Process):
         env.result_socket.send(encode_msg(res))
 
 
+def preload_worker_modules():
+    '''Import modules used by workers so that workers forked from the current
+    process do not have to import them'''
+    from . import step_executor, substep_executor, task_executor, workflow_executor
+
+
+def worker_daemon_dir():
+    '''Directory of sockets of worker daemons, which is accessible only by
+    the user'''
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR', '')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        daemon_dir = os.path.join(runtime_dir, 'sos')
+    else:
+        daemon_dir = os.path.join(os.path.expanduser('~'), '.sos', 'daemons')
+    os.makedirs(daemon_dir, mode=0o700, exist_ok=True)
+    if os.stat(daemon_dir).st_mode & 0o077:
+        os.chmod(daemon_dir, 0o700)
+    return daemon_dir
+
+
+def worker_daemon_address(exec_dir=None):
+    '''Address of the worker daemon of a project'''
+    project = os.path.abspath(exec_dir if exec_dir else env.exec_dir)
+    return f'ipc://{worker_daemon_dir()}/sos_workers_{hashlib.md5(project.encode()).hexdigest()[:10]}'
+
+
+def request_worker_daemon(msg, timeout=5000):
+    '''Send a message to the worker daemon of the project and return its
+    reply, or None if the daemon is not running'''
+    address = worker_daemon_address()
+    if not zmq.has('ipc') or not os.path.exists(address[6:]):
+        return None
+    if os.stat(address[6:]).st_uid != os.getuid():
+        # environment and configuration are sent to the daemon
+        env.logger.warning(
+            f'Worker daemon at {address} is not owned by the current user.')
+        return None
+    socket = create_socket(zmq.Context.instance(), zmq.REQ, 'worker daemon')
+    try:
+        socket.connect(address)
+        socket.send(encode_msg(msg))
+        if not socket.poll(timeout):
+            env.logger.warning(f'Worker daemon at {address} does not respond.')
+            return None
+        return decode_msg(socket.recv())
+    finally:
+        close_socket(socket, 'worker daemon', now=True)
+
+
+class WorkerDaemon(object):
+    '''A persistent process that starts workers for sos processes that are
+    executed in the same project. Workers are forked from the daemon, which
+    has imported all modules used by workers, and connect to the controller
+    of the sos process that requests them. A new worker is forked for each
+    request because workers exit with the controller they connect to.'''
+
+    def __init__(self):
+        self.address = worker_daemon_address()
+        self._workers = []
+
+    def _start_worker(self, config, environ, workdir, verbosity):
+        # workers use environment, working directory and verbosity of the sos
+        # process that requests them, which are set after they are forked
+        worker = SoS_Worker(
+            config, environ=environ, workdir=workdir, verbosity=verbosity)
+        worker.start()
+        self._workers.append(worker)
+        return worker.pid
+
+    def run(self):
+        if not zmq.has('ipc'):
+            raise RuntimeError('Worker daemon requires ipc support of zmq.')
+        preload_worker_modules()
+        context = zmq.Context()
+        socket = create_socket(context, zmq.REP, 'worker daemon')
+        socket.bind(self.address)
+        env.logger.info(f'Worker daemon started at {self.address}')
+        try:
+            while True:
+                if not socket.poll(1000):
+                    # join completed workers
+                    self._workers = [x for x in self._workers if x.is_alive()]
+                    continue
+                msg = decode_msg(socket.recv())
+                if msg[0] == 'start':
+                    try:
+                        socket.send(encode_msg(self._start_worker(*msg[1:])))
+                    except Exception as e:
+                        env.logger.warning(f'Failed to start worker: {e}')
+                        socket.send(encode_msg(None))
+                elif msg[0] == 'stop':
+                    socket.send(encode_msg('bye'))
+                    break
+                else:
+                    env.logger.warning(f'Unknown message passed {msg}')
+                    socket.send(encode_msg(None))
+        finally:
+            close_socket(socket, 'worker daemon', now=True)
+            context.term()
+            if os.path.exists(self.address[6:]):
+                os.remove(self.address[6:])
+        env.logger.info('Worker daemon stopped')
+
+
+def task_options(task_params, variables):
+    '''Return options cores and mem of a task statement that can be
+    determined without executing the statement, namely literal values and
+    variables'''
+    options = {}
+    if not task_params:
+        return options
+    try:
+        call = ast.parse(f'__null_func__({task_params})', mode='eval').body
+    except SyntaxError:
+        return options
+    for keyword in call.keywords:
+        if keyword.arg not in ('cores', 'mem'):
+            continue
+        if isinstance(keyword.value, ast.Name):
+            if keyword.value.id in variables:
+                options[keyword.arg] = variables[keyword.value.id]
+            continue
+        try:
+            options[keyword.arg] = ast.literal_eval(keyword.value)
+        except Exception:
+            pass
+    return options
+
+
+def request_resources(msg_type, msg, context=None):
+    '''Return cores and mem requested by a substep or task, which are
+    specified by runtime options cores and mem. Substeps request the
+    resources of the tasks of their steps, which are specified in the
+    context of the substeps.'''
+    if msg_type == 'substep':
+        runtime = dict(msg['proc_vars'].get('_runtime', {}))
+        context = context or msg
+        if context.get('task', None):
+            runtime.update(
+                task_options(
+                    context.get('task_params', None), msg['proc_vars']))
+    elif msg_type == 'task':
+        runtime = dict(msg['runtime'].get('_runtime', {}))
+        runtime.update(msg['runtime'].get(msg['task_id'], {}))
+    else:
+        # steps and workflows wait for substeps most of the time
+        return 0, 0
+    try:
+        cores = int(runtime.get('cores', None) or 1)
+        mem = runtime.get('mem', None) or 0
+        mem = expand_size(mem) if isinstance(mem, str) else int(mem)
+    except Exception:
+        cores, mem = 1, 0
+    return cores, mem
+
+
+def _is_running(pid):
+    '''Check if a process is running and has not become a zombie'''
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
 class WorkerManager(object):
     # manager worker processes
 
@@ -483,6 +734,11 @@ class WorkerManager(object):
             )
 
         self._local_workers = []
+        # local workers that have been retired but might not have quit
+        self._retired_workers = []
+        # pids of local workers that are started by the worker daemon
+        self._daemon_pids = set()
+        self._use_daemon = env.config.get('worker_daemon', False)
         self._remote_connections = []
 
         self._num_remote_workers = {}
@@ -490,12 +746,20 @@ class WorkerManager(object):
         self._n_requested = 0
         self._n_processed = 0
 
-        self._local_worker_alive_time = time.time()
         # self._last_pending_time = {}
 
-        self._substep_requests = []
-        self._task_requests = []
+        # substep requests of each step, step_id -> deque of (seq, msg,
+        # resources)
+        self._substep_requests = OrderedDict()
+        self._num_substep_requests = 0
+        self._task_requests = deque()
+        # number of substeps of each step that have been sent to workers
+        self._dispatched_substeps = defaultdict(int)
         self._step_requests = {}
+        # sequence number of requests
+        self._seq = count()
+        # maximum number of requests in each queue
+        self._max_queue_depths = defaultdict(int)
 
         self._worker_backend_socket = backend_socket
 
@@ -507,33 +771,162 @@ class WorkerManager(object):
 
         self._last_pending_msg = {}
 
+        # workers that are waiting for jobs, identity -> (num_pending, ports).
+        # Each worker tells the manager that it can accept a job (a credit)
+        # and receives a reply only when a job is sent to it.
+        self._idle_workers = OrderedDict()
+
+        # identities of workers that have connected to the manager
+        self._worker_identities = set()
+        # time at which each idle worker became idle
+        self._idle_since = {}
+        # workers that are idle for more than worker_idle_timeout seconds
+        # are retired, and extra workers started for blocking subworkflows
+        # are retired after the subworkflows are completed
+        self._idle_timeout = float(
+            env.config.get('worker_idle_timeout', 60) or 0)
+        self._num_extra_workers = 0
+        self._next_reap_time = None
+
+        # cores and memory of each host that can be used by substeps and
+        # tasks. Those of the local host are given by packing_cores and
+        # packing_mem, which default to all cores and memory of the host.
+        # Substeps and tasks without runtime options cores and mem use one
+        # core, so they are not limited by the number of cores. Resources of
+        # remote hosts are unknown and not limited.
+        max_cores = env.config.get('packing_cores', None) or os.cpu_count()
+        max_mem = env.config.get('packing_mem', None)
+        max_mem = expand_size(max_mem) if isinstance(
+            max_mem, str) else max_mem or psutil.virtual_memory().total
+        self._max_resources = {
+            get_localhost_ip(): (max(max_cores, self._max_workers[0]),
+                                 max_mem)
+        }
+        # cores and mem used by substeps and tasks of each host
+        self._used_resources = defaultdict(lambda: [0, 0])
+        # worker -> (host, cores, mem) of the job that the worker is running
+        self._worker_resources = {}
+
+        # remote workers send heartbeats and are considered lost if no
+        # heartbeat or request is received for worker_heartbeat_timeout
+        # seconds, in which case their substeps and tasks are resubmitted
+        self._heartbeat_timeout = float(
+            env.config.get('worker_heartbeat_timeout', 30) or 0)
+        # identities of workers that are not started by the manager or the
+        # worker daemon on the local host
+        self._remote_identities = set()
+        # remote worker -> time of last heartbeat or request
+        self._last_heartbeat = {}
+        # remote worker -> (num_pending, ports) of its last request
+        self._remote_requests = {}
+        # identities of remote workers that are considered lost
+        self._lost_workers = set()
+        # worker -> (msg_type, key, request) of the last job sent to it
+        self._worker_jobs = {}
+        # remote worker -> ports of steps and workflows that are sent to it
+        # and are not completed
+        self._remote_step_ports = defaultdict(set)
+        # ports of steps and workflows of lost workers, which are reported
+        # to the executors as failed
+        self._lost_ports = set()
+
         # start a worker, note that we do not start all workers for performance
-        # considerations
-        self.start_worker()
+        # considerations, unless workers are prewarmed
+        if env.config.get('worker_prewarm', False):
+            # workers are forked from the master process with modules imported
+            preload_worker_modules()
+            for i in range(self._max_workers[0]):
+                self.start_worker()
+        else:
+            self.start_worker()
 
     def report(self, msg):
         if 'WORKER' in env.config['SOS_DEBUG'] or 'ALL' in env.config[
                 'SOS_DEBUG']:
             env.log_to_file(
                 'WORKER',
-                f'{msg.upper()}: {self._num_workers} workers (of which {len(self._blocking_ports)} is blocking), {self._n_requested} requested, {self._n_processed} processed'
+                f'{msg.upper()}: {self._num_workers} workers (of which {len(self._blocking_ports)} is blocking), {self._n_requested} requested, {self._n_processed} processed, queues {self.queue_depths()}'
             )
 
-    def add_request(self, msg_type, msg):
+    def queue_depths(self):
+        '''Number of pending requests of each type and number of idle workers'''
+        return {
+            'step': len(self._step_requests),
+            'substep': self._num_substep_requests,
+            'task': len(self._task_requests),
+            'idle_workers': len(self._idle_workers)
+        }
+
+    def substep_stats(self):
+        '''Number of pending and dispatched substeps of each step'''
+        stats = {
+            step_id: (0, dispatched)
+            for step_id, dispatched in self._dispatched_substeps.items()
+        }
+        for step_id, requests in self._substep_requests.items():
+            stats[step_id] = (len(requests),
+                              self._dispatched_substeps.get(step_id, 0))
+        return stats
+
+    def worker_stats(self):
+        '''Number of busy and idle workers'''
+        num_workers = sum(self._num_workers) - len(self._lost_workers)
+        num_idle = min(len(self._idle_workers), num_workers)
+        return {
+            'busy': num_workers - num_idle,
+            'idle': num_idle,
+            'max': sum(self._max_workers),
+            'utilization':
+                round((num_workers - num_idle) /
+                      num_workers, 3) if num_workers else 0.0
+        }
+
+    def max_queue_depths(self):
+        '''Maximum number of pending requests of each type'''
+        return dict(self._max_queue_depths)
+
+    def add_request(self, msg_type, msg, context=None):
         self._n_requested += 1
         if msg_type == 'substep':
-            self._substep_requests.insert(0, msg)
+            step_id = msg['proc_vars'].get('step_id', None)
+            if step_id not in self._substep_requests:
+                self._substep_requests[step_id] = deque()
+            self._substep_requests[step_id].append(
+                (next(self._seq), msg,
+                 request_resources(msg_type, msg, context)))
+            self._num_substep_requests += 1
             self.report(f'Substep requested')
         elif msg_type == 'task':
-            self._task_requests.insert(0, msg)
+            self._task_requests.append(
+                (msg, request_resources(msg_type, msg)))
             self.report(f'Task requested')
         else:
             port = msg['config']['sockets']['master_port']
+            if port in self._lost_ports:
+                # the worker is lost after the port is claimed
+                return
             self._step_requests[port] = msg
             self.report(f'Step {port} requested')
-
-        if sum(self._num_workers) < sum(self._max_workers):
-            self.start_worker()
+        for name, depth in self.queue_depths().items():
+            if depth > self._max_queue_depths[name]:
+                self._max_queue_depths[name] = depth
+
+        self.dispatch()
+        self.scale_up()
+
+    def scale_up(self):
+        '''Start workers for pending requests that cannot be handled by idle
+        workers or workers that are being started'''
+        num_requests = len(self._step_requests) + len(
+            self._task_requests) + self._num_substep_requests
+        # workers that are started but have not connected to the manager
+        num_starting = sum(self._num_workers) - len(self._worker_identities)
+        while num_requests > num_starting and sum(self._num_workers) < sum(
+                self._max_workers):
+            num_started = self.start_worker()
+            if not num_started:
+                break
+            num_starting += num_started
 
     def worker_available(self, blocking, excluded):
         if self._available_ports:
@@ -550,15 +943,25 @@ class WorkerManager(object):
                 self.start_worker()
             return None
 
-        # we start a worker right now.
+        # we start a worker right now, which will be retired after the
+        # blocking subworkflow is completed
         self._max_workers[0] += 1
+        self._num_extra_workers += 1
         self.start_worker()
         while True:
             if not self._worker_backend_socket.poll(5000):
                 raise RuntimeError('No worker is started after 5 seconds')
-            msg = decode_msg(self._worker_backend_socket.recv())
-            port = self.process_request(msg[0], msg[1:], request_blocking=True)
-            if port is None or port in excluded:
+            identity, msg = self._worker_backend_socket.recv_multipart()
+            msg = decode_msg(msg)
+            if msg[0] == 'heartbeat':
+                self.process_heartbeat(msg[1])
+                continue
+            port = self.process_request(
+                identity, msg[0], msg[1:], request_blocking=True)
+            if port is None:
+                continue
+            if port in excluded:
+                self._available_ports.add(port)
                 continue
             self._claimed_ports.add(port)
             self._blocking_ports.add(port)
@@ -567,103 +970,381 @@ class WorkerManager(object):
             )
             return port
 
-    def process_request(self, num_pending, ports, request_blocking=False):
-        '''port is the open port at the worker, num_pending is the num_pending of stack.
-        A non-zero num_pending means that the worker is pending on something while
-        looking for new job, so the worker should not be killed.
-        '''
+    def _send(self, identity, msg):
+        try:
+            self._worker_backend_socket.send_multipart(
+                [identity, encode_msg(msg)])
+            return True
+        except zmq.ZMQError:
+            # the worker is no longer connected
+            self._idle_workers.pop(identity, None)
+            self._idle_since.pop(identity, None)
+            return False
+
+    def _host_of(self, identity):
+        return identity.decode(errors='replace').rpartition(':')[0]
+
+    def _fits(self, host, resources):
+        '''If a job with requested resources can be run on host'''
+        used_cores, used_mem = self._used_resources[host]
+        if used_cores == 0 and used_mem == 0:
+            # jobs larger than the host are run alone
+            return True
+        max_cores, max_mem = self._max_resources.get(host, (None, None))
+        return (max_cores is None or used_cores + resources[0] <= max_cores
+               ) and (max_mem is None or used_mem + resources[1] <= max_mem)
+
+    def _acquire_resources(self, identity, host, resources):
+        self._worker_resources[identity] = (host,) + tuple(resources)
+        used = self._used_resources[host]
+        used[0] += resources[0]
+        used[1] += resources[1]
+
+    def _release_resources(self, identity):
+        '''Release resources used by the last job of a worker, return True
+        if any resources are released'''
+        if identity not in self._worker_resources:
+            return False
+        host, cores, mem = self._worker_resources.pop(identity)
+        used = self._used_resources[host]
+        used[0] -= cores
+        used[1] -= mem
+        return True
+
+    def _assign_work(self, identity, ports):
+        '''Send a job to a worker that can accept it, return True if a job
+        is sent.'''
         if any(port in self._step_requests for port in ports):
             # if the port is available
             port = [x for x in ports if x in self._step_requests][0]
-            self._worker_backend_socket.send(
-                encode_msg(self._step_requests.pop(port)))
+            if not self._send(identity, self._step_requests[port]):
+                return False
+            self._step_requests.pop(port)
+            self._worker_jobs[identity] = ('step', port, None)
+            if identity in self._remote_identities:
+                self._remote_step_ports[identity].add(port)
             self._n_processed += 1
             self.report(f'Step {port} processed')
             # port should be in claimed ports
             self._claimed_ports.remove(port)
-            # if ports[0] in self._last_pending_time:
-            #     self._last_pending_time.pop(ports[0])
+            return True
         elif any(port in self._claimed_ports for port in ports):
             # the port is claimed, but the real message is not yet available
-            self._worker_backend_socket.send(encode_msg({}))
             self.report(f'pending with claimed {ports}')
-        # elif any(port in self._blocking_ports for port in ports):
-        #     # in block list but appear to be idle, kill it
-        #     self._max_workers -= 1
-        #     env.logger.debug(
-        #         f'Reduce maximum number of workers to {self._max_workers} after completion of a blocking subworkflow.'
-        #     )
-        #     for port in ports:
-        #         if port in self._blocking_ports:
-        #             self._blocking_ports.remove(port)
-        #         if port in self._available_ports:
-        #             self._available_ports.remove(port)
-        #     self._worker_backend_socket.send(encode_msg(None))
-        #     self._num_local_workers -= 1
-        #     self.report(f'Blocking worker {ports} killed')
-        elif self._task_requests:
-            # port is not claimed, free to use for substep worker
-            msg = self._task_requests.pop()
-            self._worker_backend_socket.send(encode_msg(msg))
-            self._n_processed += 1
+            return False
+
+        host = self._host_of(identity)
+        # the first task that fits into available resources of the host
+        task_idx = next(
+            (idx for idx, (msg, resources) in enumerate(self._task_requests)
+             if self._fits(host, resources)), None)
+        step_id = self._next_substep_step(
+            host) if task_idx is None and self._substep_requests else None
+        if task_idx is not None:
+            msg, resources = self._task_requests[task_idx]
+            if not self._send(identity, msg):
+                return False
+            del self._task_requests[task_idx]
+            self._worker_jobs[identity] = ('task', None, (msg, resources))
+            self._acquire_resources(identity, host, resources)
             self.report(f'Task processed with {ports[0]}')
-            # port can however be in available ports
-            for port in ports:
-                if port in self._available_ports:
-                    self._available_ports.remove(port)
-                # if port in self._last_pending_time:
-                #     self._last_pending_time.pop(port)
-        elif self._substep_requests:
-            # port is not claimed, free to use for substep worker
-            msg = self._substep_requests.pop()
-            self._worker_backend_socket.send(encode_msg(msg))
-            self._n_processed += 1
+        elif step_id is not None:
+            requests = self._substep_requests[step_id]
+            if not self._send(identity, requests[0][1]):
+                return False
+            self._acquire_resources(identity, host, requests[0][2])
+            self._worker_jobs[identity] = ('substep', step_id,
+                                           requests.popleft())
+            if not requests:
+                self._substep_requests.pop(step_id)
+            self._dispatched_substeps[step_id] += 1
+            self._num_substep_requests -= 1
             self.report(f'Substep processed with {ports[0]}')
-            # port can however be in available ports
-            for port in ports:
-                if port in self._available_ports:
-                    self._available_ports.remove(port)
-                # if port in self._last_pending_time:
-                #     self._last_pending_time.pop(port)
-        elif request_blocking:
-            self._worker_backend_socket.send(encode_msg({}))
+        else:
+            return False
+        self._n_processed += 1
+        # port is not claimed, free to use for substep worker, but it can
+        # however be in available ports
+        for port in ports:
+            if port in self._available_ports:
+                self._available_ports.remove(port)
+        return True
+
+    def _next_substep_step(self, host):
+        '''Return the step from which the next substep will be sent, or None
+        if no substep fits into available resources of host'''
+        steps = [
+            x for x, requests in self._substep_requests.items()
+            if self._fits(host, requests[0][2])
+        ]
+        if len(steps) <= 1:
+            return steps[0] if steps else None
+        if env.config['worker_scheduling'] == 'fifo':
+            # the step with the earliest request
+            return min(steps, key=lambda x: self._substep_requests[x][0][0])
+        # substeps of the step that is closest to completion go first so that
+        # the step, and steps that depend on it, can continue
+        return min(
+            steps,
+            key=lambda x: (len(self._substep_requests[x]), self.
+                           _substep_requests[x][0][0]))
+
+    def dispatch(self):
+        '''Send pending requests to idle workers'''
+        for identity, (num_pending, ports) in list(self._idle_workers.items()):
+            if not (self._step_requests or self._task_requests or
+                    self._substep_requests):
+                break
+            if self._assign_work(identity, ports):
+                self._idle_workers.pop(identity, None)
+                self._idle_since.pop(identity, None)
+
+    def process_request(self,
+                        identity,
+                        num_pending,
+                        ports,
+                        request_blocking=False):
+        '''identity is the zmq identity of the worker, ports are the open ports
+        at the worker, num_pending is the num_pending of stack. A non-zero
+        num_pending means that the worker is pending on something while
+        looking for new job, so the worker should not be killed.
+
+        A job is sent to the worker if there is one. Otherwise the worker is
+        kept as an idle worker until a job becomes available.
+        '''
+        self._idle_workers.pop(identity, None)
+        self._idle_since.pop(identity, None)
+        if identity not in self._worker_identities:
+            self._worker_identities.add(identity)
+            if self._local_pid(identity) is None:
+                self._remote_identities.add(identity)
+        # the last job sent to the worker is completed, or has yielded
+        # if num_pending is not zero
+        self._worker_jobs.pop(identity, None)
+        if identity in self._remote_identities:
+            self._remote_requests[identity] = (num_pending, ports)
+            # steps and workflows on available ports are completed
+            self._remote_step_ports[identity].difference_update(ports)
+            self._lost_ports.difference_update(ports)
+            self.process_heartbeat(identity)
+        # the worker has completed its last job, so resources used by the
+        # job can be used by jobs waiting for resources
+        if self._release_resources(identity) and (self._task_requests or
+                                                  self._substep_requests):
+            self.dispatch()
+        if self._blocking_ports.intersection(ports):
+            # ports of blocking subworkflows are available again after the
+            # subworkflows are completed
+            self._complete_blocking(
+                self._blocking_ports.intersection(ports) - self._claimed_ports)
+        if self._assign_work(identity, ports):
+            return None
+        self._idle_workers[identity] = (num_pending, ports)
+        self._idle_since[identity] = time.time()
+        if self._idle_timeout:
+            self._schedule_reap(self._idle_since[identity] +
+                                self._idle_timeout)
+        if any(port in self._claimed_ports for port in ports):
+            return None
+        if request_blocking:
             return ports[0]
-        # elif num_pending == 0 and self._num_local_workers > 1 and ports[
-        #         0] in self._last_pending_time and time.time(
-        #         ) - self._last_pending_time[ports[0]] > 5:
-        #     # kill the worker
-        #     for port in ports:
-        #         if port in self._available_ports:
-        #             self._available_ports.remove(port)
-        #     self._worker_backend_socket.send(encode_msg(None))
-        #     self._num_local_workers -= 1
-        #     self.report(f'Kill standing {ports}')
-        #     self._last_pending_time.pop(ports[0])
+        self._available_ports.add(ports[0])
+        ports = tuple(ports)
+        if (ports, num_pending) not in self._last_pending_msg or time.time(
+        ) - self._last_pending_msg[(ports, num_pending)] > 1.0:
+            self.report(
+                f'pending with port {ports} at num_pending {num_pending}')
+            self._last_pending_msg[(ports, num_pending)] = time.time()
+        return None
+
+    def process_heartbeat(self, identity):
+        '''Record that a remote worker is alive'''
+        if isinstance(identity, str):
+            identity = identity.encode()
+        if identity in self._lost_workers:
+            # the worker is alive after all, e.g. after a network outage
+            self._lost_workers.remove(identity)
+            self._worker_identities.add(identity)
+            self._remote_identities.add(identity)
+            env.logger.warning(
+                f'Worker {identity.decode()} is reconnected after being considered lost.'
+            )
+        if not self._heartbeat_timeout:
+            return
+        self._last_heartbeat[identity] = time.time()
+        self._schedule_reap(self._last_heartbeat[identity] +
+                            self._heartbeat_timeout)
+
+    def _lose_worker(self, identity):
+        '''Remove a remote worker that has stopped sending heartbeats and
+        resubmit its substep or task'''
+        self._last_heartbeat.pop(identity, None)
+        self._lost_workers.add(identity)
+        self._worker_identities.discard(identity)
+        self._remote_identities.discard(identity)
+        self._idle_workers.pop(identity, None)
+        self._idle_since.pop(identity, None)
+        self._release_resources(identity)
+        num_pending, ports = self._remote_requests.pop(identity, (0, []))
+        for port in ports:
+            self._available_ports.discard(port)
+        msg_type, key, request = self._worker_jobs.pop(identity,
+                                                       (None, None, None))
+        # steps and workflows keep their states in the worker and cannot
+        # be resubmitted, so they fail, as well as steps that are going to
+        # be sent to ports of the worker
+        lost_ports = self._remote_step_ports.pop(identity, set()) | (
+            set(ports) & self._claimed_ports)
+        if lost_ports:
+            for port in lost_ports:
+                self._claimed_ports.discard(port)
+                self._step_requests.pop(port, None)
+            self._lost_ports |= lost_ports
+            env.logger.error(
+                f'Worker {identity.decode()} with pending steps or workflows has not responded for {self._heartbeat_timeout} seconds.'
+            )
         else:
-            # if num_pending == 0 and ports[0] not in self._last_pending_time:
-            #     self._last_pending_time[ports[0]] = time.time()
-            self._available_ports.add(ports[0])
-            self._worker_backend_socket.send(encode_msg({}))
-            ports = tuple(ports)
-            if (ports, num_pending) not in self._last_pending_msg or time.time(
-            ) - self._last_pending_msg[(ports, num_pending)] > 1.0:
-                self.report(
-                    f'pending with port {ports} at num_pending {num_pending}')
-                self._last_pending_msg[(ports, num_pending)] = time.time()
+            env.logger.warning(
+                f'Worker {identity.decode()} has not responded for {self._heartbeat_timeout} seconds and is considered lost.'
+            )
+        # resubmitted jobs go to the front of the queues so that they are
+        # picked up by the next idle worker on any host
+        if msg_type == 'substep':
+            if key not in self._substep_requests:
+                self._substep_requests[key] = deque()
+            self._substep_requests[key].appendleft(request)
+            self._num_substep_requests += 1
+            self._dispatched_substeps[key] -= 1
+            self._n_processed -= 1
+            self.report(f'Substep of lost worker resubmitted')
+        elif msg_type == 'task':
+            self._task_requests.appendleft(request)
+            self._n_processed -= 1
+            self.report(f'Task of lost worker resubmitted')
+
+    def lost_ports(self, ports):
+        '''Ports of steps and workflows that are lost with their workers'''
+        return [port for port in ports if port in self._lost_ports]
+
+    def _reap_lost_workers(self, now):
+        lost = [
+            identity for identity, last in self._last_heartbeat.items()
+            if now - last >= self._heartbeat_timeout
+        ]
+        for identity in lost:
+            self._lose_worker(identity)
+        for last in self._last_heartbeat.values():
+            self._schedule_reap(last + self._heartbeat_timeout)
+        if lost:
+            self.dispatch()
+
+    def _complete_blocking(self, ports):
+        for port in ports:
+            self._blocking_ports.discard(port)
+            if self._num_extra_workers > 0:
+                self._num_extra_workers -= 1
+                self._max_workers[0] -= 1
+                env.logger.debug(
+                    f'Decreasing maximum number of local workers to {self._max_workers[0]} after a blocking subworkflow is completed.'
+                )
+
+    def _local_pid(self, identity):
+        '''Return pid of a local worker from its identity, or None if the
+        worker is not started by the manager or the worker daemon'''
+        host, _, pid = identity.decode(errors='replace').rpartition(':')
+        if not pid.isdigit() or host != get_localhost_ip():
+            return None
+        pid = int(pid)
+        if pid in self._daemon_pids or any(
+                worker.pid == pid for worker in self._local_workers):
+            return pid
+        return None
+
+    def _retire_worker(self, identity, pid):
+        num_pending, ports = self._idle_workers.pop(identity)
+        self._idle_since.pop(identity, None)
+        self._worker_identities.discard(identity)
+        for port in ports:
+            self._available_ports.discard(port)
+        self._send(identity, None)
+        if pid in self._daemon_pids:
+            self._daemon_pids.remove(pid)
+        else:
+            self._retired_workers.extend(
+                [worker for worker in self._local_workers if worker.pid == pid])
+            self._local_workers = [
+                worker for worker in self._local_workers if worker.pid != pid
+            ]
+        self._num_workers[0] -= 1
+        self.report(f'retire idle worker {pid}')
+
+    def reap_timeout(self):
+        '''Time in milliseconds before idle workers should be checked for
+        retirement, None if no worker needs to be checked'''
+        if self._next_reap_time is None:
+            return None
+        return max(0, (self._next_reap_time - time.time()) * 1000)
+
+    def _schedule_reap(self, reap_time):
+        if self._next_reap_time is None or reap_time < self._next_reap_time:
+            self._next_reap_time = reap_time
+
+    def reap_idle_workers(self):
+        '''Retire local workers that have been idle for more than
+        worker_idle_timeout seconds, and idle workers beyond the maximum
+        number of local workers. At least one local worker is kept. Remote
+        workers that have not responded for worker_heartbeat_timeout seconds
+        are removed and their jobs are resubmitted.'''
+        now = time.time()
+        excess = self._num_workers[0] - self._max_workers[0]
+        if excess <= 0 and (self._next_reap_time is None or
+                            now < self._next_reap_time):
+            return
+        self._next_reap_time = None
+        if self._last_heartbeat:
+            self._reap_lost_workers(now)
+        for identity, since in list(self._idle_since.items()):
+            num_pending, ports = self._idle_workers[identity]
+            # workers with pending jobs or claimed ports are still needed
+            if self._num_workers[0] <= 1 or num_pending or any(
+                    port in self._claimed_ports for port in ports):
+                continue
+            pid = self._local_pid(identity)
+            if pid is None:
+                continue
+            if excess > 0 or (self._idle_timeout and
+                              now - since >= self._idle_timeout):
+                self._retire_worker(identity, pid)
+                excess -= 1
+            elif self._idle_timeout:
+                self._schedule_reap(since + self._idle_timeout)
 
     def start_worker(self):
+        '''Start workers on the first host that has not reached its maximum
+        number of workers, and return the number of started workers'''
         for idx, (worker_host, num_worker, max_worker) in enumerate(
                 zip(self._worker_hosts, self._num_workers, self._max_workers)):
             if num_worker == max_worker:
                 continue
             # local host
             if idx == 0:
-                worker = SoS_Worker(env.config)
-                worker.start()
-                self._local_worker_alive_time = time.time()
-                self._local_workers.append(worker)
+                pid = request_worker_daemon([
+                    'start', env.config,
+                    dict(os.environ),
+                    os.getcwd(), env.verbosity
+                ]) if self._use_daemon else None
+                if pid:
+                    self._daemon_pids.add(pid)
+                    self.report('start a local worker from worker daemon')
+                else:
+                    # start workers directly if the daemon is not available
+                    self._use_daemon = False
+                    worker = SoS_Worker(env.config)
+                    worker.start()
+                    self._local_workers.append(worker)
+                    self.report('start a local worker')
                 self._num_workers[0] += 1
-                self.report('start a local worker')
+                return 1
             else:
                 # start all remote workers on a host
                 try:
@@ -683,12 +1364,20 @@ class WorkerManager(object):
                     # NOTE: we assume file systems are shared so we do not copy env_file to remote host
                     cmd = [
                         'sos', 'worker', '--router',
-                        env.config["sockets"]["worker_backend"], '--sig_mode',
+                        env.config["sockets"]["worker_backend"],
+                        '--master_push', env.config['sockets']['master_push'],
+                        '--master_request',
+                        env.config['sockets']['master_request'], '--sig_mode',
                         env.config['sig_mode'], '--run_mode',
                         env.config['run_mode'], '--env', env_file, '--workdir',
                         os.getcwd(), '-v',
                         str(env.config['verbosity'])
                     ]
+                    if self._heartbeat_timeout:
+                        cmd += [
+                            '--heartbeat',
+                            str(max(self._heartbeat_timeout / 5, 0.1))
+                        ]
                     if max_worker is not None:
                         cmd += ['-j', str(max_worker)]
                     p = host._host_agent.run_command(cmd, wait_for_task=False)
@@ -701,33 +1390,67 @@ class WorkerManager(object):
                 self._num_workers[idx] = self._max_workers[idx]
                 self.report(
                     f'start {max_worker} remote workers on {worker_host}')
-            break
+                return max_worker - num_worker
+        return 0
+
+    def sentinels(self):
+        '''Sentinels of local workers by their pids, which become ready when
+        the workers exit'''
+        return {worker.pid: worker.sentinel for worker in self._local_workers}
+
+    def has_daemon_workers(self):
+        '''If there are workers started by the worker daemon, which do not
+        have sentinels and have to be checked periodically'''
+        return bool(self._daemon_pids)
 
     def check_workers(self):
-        '''Kill workers that have been pending for a while and check if all workers
-        are alive. '''
-        if time.time() - self._local_worker_alive_time > 5:
-            self._local_worker_alive_time = time.time()
-            # join processes if they are now gone, it should not do anything bad
-            # if the process is still running
-            [
-                worker.join()
-                for worker in self._local_workers
-                if not worker.is_alive()
-            ]
-            self._local_workers = [
-                worker for worker in self._local_workers if worker.is_alive()
-            ]
-            if len(self._local_workers) < self._num_workers[0]:
-                raise ProcessKilled('One of the local workers has been killed.')
+        '''Check if all local workers, including those started by the worker
+        daemon, are alive. '''
+        # join processes if they are now gone, it should not do anything bad
+        # if the process is still running
+        [
+            worker.join()
+            for worker in self._local_workers
+            if not worker.is_alive()
+        ]
+        self._local_workers = [
+            worker for worker in self._local_workers if worker.is_alive()
+        ]
+        self._retired_workers = [
+            worker for worker in self._retired_workers if worker.is_alive()
+        ]
+        # workers started by the worker daemon are not our children, so
+        # they are checked by their pids
+        self._daemon_pids = {
+            pid for pid in self._daemon_pids if _is_running(pid)
+        }
+        if len(self._local_workers) + len(
+                self._daemon_pids) < self._num_workers[0]:
+            raise ProcessKilled('One of the local workers has been killed.')
 
     def kill_all(self):
         '''Kill all workers'''
         total_num_workers = sum(self._num_workers)
+        for identity, (num_pending, ports) in list(
+                self._idle_workers.items()):
+            self._send(identity, None)
+            total_num_workers -= 1
+            self.report(f'Kill {ports}')
+        self._idle_workers.clear()
+        total_num_workers -= len(self._lost_workers)
         while total_num_workers > 0 and self._worker_backend_socket.poll(1000):
-            msg = decode_msg(self._worker_backend_socket.recv())
-            self._worker_backend_socket.send(encode_msg(None))
+            identity, msg = self._worker_backend_socket.recv_multipart()
+            if decode_msg(msg)[0] == 'heartbeat':
+                continue
+            self._send(identity, None)
             total_num_workers -= 1
-            self.report(f'Kill {msg[1:]}')
+            self.report(f'Kill {decode_msg(msg)[1:]}')
         # join all local processes
-        [worker.join() for worker in self._local_workers]
+        [
+            worker.join()
+            for worker in self._local_workers + self._retired_workers
+        ]
+        if 'WORKER' in env.config['SOS_DEBUG'] or 'ALL' in env.config[
+                'SOS_DEBUG']:
+            env.log_to_file(
+                'WORKER', f'Maximum queue depths {self.max_queue_depths()}')
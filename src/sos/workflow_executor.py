@@ -24,7 +24,7 @@ from .hosts import Host
 from .parser import SoS_Workflow
 from .pattern import extract_pattern
 from .workflow_report import render_report
-from .controller import Controller, connect_controllers, disconnect_controllers, create_socket, close_socket, request_answer_from_controller, send_message_to_controller
+from .controller import Controller, bind_to_random_address, connect_controllers, disconnect_controllers, create_socket, close_socket, request_answer_from_controller, send_message_to_controller
 from .section_analyzer import analyze_section
 from .targets import (BaseTarget, RemovedTarget, UnavailableLock, UnknownTarget,
                       file_target, path, paths, sos_step, sos_targets,
@@ -97,6 +97,12 @@ class ExecutionManager(object):
         self.workflow_queue = []
         self.poller = zmq.Poller() if dummy else None
         self._dummy = dummy
+        # ports of running steps whose workers are lost, which can only
+        # happen with remote workers (hosts other than the first one of -j)
+        self.lost_ports = set()
+        worker_procs = env.config.get('worker_procs', None)
+        self._has_remote_workers = isinstance(
+            worker_procs, (list, tuple)) and len(worker_procs) > 1
 
     def report(self, msg=''):
         env.log_to_file(
@@ -189,6 +195,30 @@ class ExecutionManager(object):
                 ProcInfo(socket=master_socket, port=master_port, step=runnable))
         return True
 
+    def wait_for_messages(self):
+        '''Wait till a message arrives from any of the workers. The wait is
+        shorter if there are jobs waiting for workers, or pending steps that
+        can be resumed without a message from their workers.'''
+        sockets = [x.socket for x in self.procs if x is not None]
+        timeout = 100 if self.step_queue or self.workflow_queue or any(
+            x.is_pending() for x in self.procs if x is not None) else 1000
+        if not sockets:
+            time.sleep(timeout / 1000)
+            return False
+        poller = zmq.Poller()
+        for socket in sockets:
+            poller.register(socket, zmq.POLLIN)
+        if poller.poll(timeout):
+            return True
+        if not self._has_remote_workers:
+            return False
+        # remote workers might be lost while running the steps
+        self.lost_ports = set(
+            request_answer_from_controller(['lost_ports'] + [
+                x.port for x in self.procs if x is not None and x.port
+            ]))
+        return False
+
     def _num_of_procs(self):
         return len([x for x in self.procs if x is not None])
 
@@ -1158,12 +1188,17 @@ class Base_Executor:
                     if proc is None:
                         continue
 
+                    if proc.port in manager.lost_ports:
+                        # the worker will not return a result
+                        manager.lost_ports.discard(proc.port)
+                        res = RuntimeError(
+                            f'Worker running step {proc.step} is lost.')
                     # echck if there is any message from the socket
-                    if not proc.socket.poll(0):
+                    elif not proc.socket.poll(0):
                         continue
-
-                    # receieve something from the worker
-                    res = decode_msg(proc.socket.recv())
+                    else:
+                        # receieve something from the worker
+                        res = decode_msg(proc.socket.recv())
                     runnable = proc.step
                     # if this is NOT a result, rather some request for task, step, workflow etc
                     if isinstance(res, list):
@@ -1590,7 +1625,7 @@ class Base_Executor:
                     )
                     break
                 else:
-                    time.sleep(0.1)
+                    manager.wait_for_messages()
         except KeyboardInterrupt:
             if exec_error.errors:
                 failed_steps, pending_steps = dag.pending()
@@ -1833,7 +1868,7 @@ class Base_Executor:
 
                     socket = create_socket(env.zmq_context, zmq.PAIR,
                                            'worker pair socket')
-                    port = socket.bind_to_random_port(f'tcp://{self.local_ip}')
+                    address = bind_to_random_address(socket)
                     env.log_to_file(
                         'WORKER',
                         f'- SUBRUN - SEND STEP S{env.config["workflow_vars"].get("idx", "?")}'
@@ -1843,7 +1878,7 @@ class Base_Executor:
                         encode_msg([
                             'step', step_id, section, runnable._context, shared,
                             self.args, env.config, env.verbosity,
-                            f'tcp://{self.local_ip}:{port}'
+                            address
                         ]))
                     # the nested workflow also needs a step to receive result
                     manager.add_placeholder_worker(runnable, socket)
@@ -0,0 +1,4 @@
+echo something
+else:
+    python:
+print(1)
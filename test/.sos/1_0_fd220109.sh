@@ -0,0 +1,4 @@
+echo something
+
+    python:
+print(1)
@@ -0,0 +1,3 @@
+touch failed.csv
+eco "something wrong"
+
@@ -768,6 +768,78 @@ A_2;
             if file_target(f).exists():
                 file_target(f).unlink()
 
+    def testCriticalPath(self):
+        '''Test if steps on the critical path are executed first'''
+        script = SoS_Script('''
+[A_1]
+output: 'A1.txt'
+_output.touch()
+
+[A_2]
+input:  'B2.txt'
+output: 'A2.txt'
+_output.touch()
+
+[B: provides='B2.txt']
+output: 'B2.txt'
+_output.touch()
+''')
+        wf = script.workflow()
+        dag = Base_Executor(wf).initialize_dag()
+        self.assertEqual(
+            sorted(dag.critical_path_lengths().values()), [1, 1, 2])
+        # B is on the longest path B -> A_2
+        self.assertEqual(dag.find_executable()._node_id, 'B (B2.txt)')
+        env.config['worker_scheduling'] = 'fifo'
+        try:
+            self.assertEqual(dag.find_executable()._node_id, 'A_1')
+        finally:
+            env.config['worker_scheduling'] = 'priority'
+
+    def testReadyQueue(self):
+        '''Test incremental update of executable steps of the DAG'''
+        script = SoS_Script('''
+[A_1]
+output: 'A1.txt'
+_output.touch()
+
+[A_2]
+input:  'B2.txt'
+output: 'A2.txt'
+_output.touch()
+
+[B: provides='B2.txt']
+output: 'B2.txt'
+_output.touch()
+''')
+        wf = script.workflow()
+        scheduling = env.config['worker_scheduling']
+        env.config['worker_scheduling'] = 'priority'
+        try:
+            dag = Base_Executor(wf).initialize_dag()
+            a1, a2, b = sorted(dag.nodes(), key=lambda x: x._node_id)
+            self.assertIs(dag.node_by_id(b._node_uuid), b)
+            self.assertRaises(RuntimeError, dag.node_by_id, 'no such uuid')
+            self.assertEqual(dag.pending(), ([], [a1, a2, b]))
+            self.assertIs(dag.find_executable(), b)
+            b._status = 'running'
+            self.assertEqual(dag.running(), [b])
+            self.assertIs(dag.find_executable(), a1)
+            a1._status = 'running'
+            self.assertIsNone(dag.find_executable())
+            # A_2 can be executed after B is completed
+            b._status = 'completed'
+            self.assertEqual(dag.running(), [a1])
+            self.assertEqual(dag.pending(), ([], [a2]))
+            self.assertIs(dag.find_executable(), a2)
+            # and has to wait for B again if B is re-executed
+            b._status = None
+            self.assertIs(dag.find_executable(), b)
+            a1._status = 'failed'
+            self.assertEqual(dag.pending(), ([a1], [a2, b]))
+        finally:
+            env.config['worker_scheduling'] = scheduling
+
     def testSharedDependency(self):
         #
         # shared variable should introduce additional dependency
@@ -2316,6 +2316,63 @@ time.sleep(2)
         # job
         #self.assertNotEqual(ret.returncode, 0)
 
+    @unittest.skipIf(sys.platform == 'win32',
+                     'Sentinels of workers are not polled under windows')
+    def testKilledWorkerDetected(self):
+        '''Test if a killed worker is detected after idle workers retire'''
+        import psutil
+        import time
+        with open('testKilledWorker.sos', 'w') as tk:
+            tk.write('''
+[1]
+input: for_each=dict(i=range(4))
+import time
+time.sleep(0.5)
+
+[2: shared='old_workers']
+input: group_by='all'
+import psutil, time
+time.sleep(7)
+old_workers = [x.pid for x in psutil.Process().parent().children()]
+
+[3]
+input: for_each=dict(i=range(4))
+import os, signal, time
+# kill workers started after idle workers are retired, which might reuse
+# file descriptors of sentinels of retired workers
+if os.getpid() not in old_workers:
+    os.kill(os.getpid(), signal.SIGKILL)
+time.sleep(2)
+''')
+        with open('killed_worker.yml', 'w') as conf:
+            conf.write('worker_idle_timeout: 1\n')
+        start_time = time.time()
+        ret = subprocess.Popen([
+            'sos', 'run', 'testKilledWorker', '-j4', '-s', 'force', '-c',
+            'killed_worker.yml'
+        ])
+        proc = psutil.Process(ret.pid)
+        workers = set()
+        try:
+            while ret.poll() is None and time.time() - start_time < 60:
+                try:
+                    workers |= set(proc.children(recursive=True))
+                except psutil.NoSuchProcess:
+                    pass
+                time.sleep(0.1)
+            self.assertNotEqual(ret.poll(), None)
+            self.assertNotEqual(ret.returncode, 0)
+            # the killed worker is detected from its sentinel, not by polling
+            self.assertLess(time.time() - start_time, 30)
+        finally:
+            if ret.poll() is None:
+                ret.kill()
+            for worker in workers:
+                try:
+                    worker.kill()
+                except psutil.NoSuchProcess:
+                    pass
+
     @unittest.skipIf(
         sys.platform == 'win32',
         'Cannot test due to a bug (ampaolo/psutil#875) with psutils under windows'
@@ -2742,6 +2799,56 @@ with open(_input, 'r') as ifile, open(_output, 'w') as ofile:
         self.assertTrue(os.path.isfile('test_1270.txt'))
         self.assertTrue(os.path.isfile('test_1270.out'))
 
+    def testSubstepContext(self):
+        '''Test global definitions shared by concurrent substeps of steps'''
+        script = SoS_Script(r'''
+scale = 10
+offset = 5
+
+def transform(x):
+    return x * scale
+
+[1: shared={'res1': 'step_output'}]
+input: for_each=dict(i=range(6))
+output: f'ctx_{i}.txt'
+with open(_output, 'w') as out:
+    out.write(str(transform(i)))
+
+[2: shared={'res2': 'step_output'}]
+input: group_by=1
+output: f'{_input:n}.out'
+with open(_input) as inf, open(_output, 'w') as out:
+    out.write(str(int(inf.read()) + offset))
+''')
+        wf = script.workflow()
+        Base_Executor(wf, config={'sig_mode': 'force'}).run()
+        for i in range(6):
+            with open(f'ctx_{i}.out') as res:
+                self.assertEqual(res.read(), str(i * 10 + 5))
+            os.remove(f'ctx_{i}.txt')
+            os.remove(f'ctx_{i}.out')
+
+    def testSubstepGlobalsNotShared(self):
+        '''Test that changes to global definitions by a substep are not seen
+        by other substeps executed by the same worker'''
+        script = SoS_Script(r'''
+def record(i, seen=[]):
+    seen.append(i)
+    return len(seen)
+
+[1]
+input: for_each=dict(i=range(12))
+output: f'globals_{i}.txt'
+with open(_output, 'w') as out:
+    out.write(str(record(i)))
+''')
+        wf = script.workflow()
+        Base_Executor(wf, config={'sig_mode': 'force'}).run()
+        for i in range(12):
+            with open(f'globals_{i}.txt') as res:
+                self.assertEqual(res.read(), '1')
+            os.remove(f'globals_{i}.txt')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -169,6 +169,27 @@ run:
         self.assertFalse(os.path.isfile('t_f1'))
         self.assertFalse(os.path.isfile('t_d1/t_f2'))
 
+    def testGarbageCollection(self):
+        '''Test removing signatures of removed files with sos gc'''
+        import sqlite3
+
+        def num_signatures():
+            conn = sqlite3.connect('.sos/step_signatures.db')
+            count = conn.execute('SELECT COUNT(*) FROM steps').fetchone()[0]
+            conn.close()
+            return count
+
+        self.assertEqual(num_signatures(), 3)
+        os.remove('t_f1')
+        subprocess.call('sos gc -n', shell=True)
+        self.assertEqual(num_signatures(), 3)
+        # t_f1 is the output of step 0 and input of step 1
+        subprocess.call('sos gc', shell=True)
+        self.assertEqual(num_signatures(), 1)
+        # signatures older than specified age
+        subprocess.call('sos gc --age 0', shell=True)
+        self.assertEqual(num_signatures(), 0)
+
     def tearDown(self):
         os.chdir('..')
         shutil.rmtree('temp')
@@ -910,5 +910,181 @@ print(_input.seed)
         # second time sshould be fine (using signature
         execute_workflow(script)
 
+    def testGetManyStepSignatures(self):
+        '''Test retrieving multiple step signatures at once'''
+        from sos.signatures import StepSignatures
+        sigs = StepSignatures()
+        sigs.set('sig_a1', {'a': 1})
+        sigs.set('sig_a2', {'a': 2})
+        sigs.set('sig_b1', {'b': 1})
+        self.assertEqual(
+            sigs.get_many(['sig_a1', 'sig_b1', 'sig_c1']), {
+                'sig_a1': {'a': 1},
+                'sig_b1': {'b': 1}
+            })
+        self.assertEqual(
+            sigs.get_many(['sig_a1', 'sig_a2']), {
+                'sig_a1': {'a': 1},
+                'sig_a2': {'a': 2}
+            })
+        self.assertEqual(sigs.remove_many(['sig_a1', 'sig_a2', 'sig_b1']), 3)
+        sigs.close()
+
+    def testPrefetchedSignatures(self):
+        '''Test skipping substeps with prefetched signatures'''
+        script = '''
+[1]
+input: for_each=dict(i=range(4))
+output: f'temp/prefetch_{i}.txt'
+_output.touch()
+'''
+        execute_workflow(script)
+        res = execute_workflow(script)
+        self.assertEqual(res['__completed__']['__substep_skipped__'], 4)
+        # signatures of substeps with output that depends on statements
+        # cannot be prefetched
+        script = '''
+[1]
+input: for_each=dict(i=range(4))
+j = i + 10
+output: f'temp/prefetch_{j}.txt'
+_output.touch()
+'''
+        execute_workflow(script)
+        res = execute_workflow(script)
+        self.assertEqual(res['__completed__']['__substep_skipped__'], 4)
+        # task-only steps
+        script = '''
+[1]
+input: for_each=dict(i=range(4))
+output: f'temp/prefetch_task_{i}.txt'
+task:
+_output.touch()
+'''
+        execute_workflow(script, options={'default_queue': 'localhost'})
+        res = execute_workflow(script, options={'default_queue': 'localhost'})
+        self.assertEqual(res['__completed__']['__substep_skipped__'], 4)
+
+    def testSignatureCodecs(self):
+        '''Test compression of signatures with different codecs'''
+        import lzma
+        import pickle
+        from sos.compression import available_codecs, dumps, loads
+        from sos.signatures import StepSignatures
+        obj = {'a': list(range(100)), 'b': 'string'}
+        for codec in available_codecs():
+            self.assertEqual(loads(dumps(obj, codec)), obj)
+        # signatures saved by previous versions of sos
+        self.assertEqual(loads(lzma.compress(pickle.dumps(obj))), obj)
+        sigs = StepSignatures()
+        sigs.conn.execute(
+            'INSERT OR REPLACE INTO steps (step_id, signature) VALUES (?, ?)',
+            ('sig_lzma', lzma.compress(pickle.dumps(obj))))
+        sigs.conn.commit()
+        self.assertEqual(sigs.get('sig_lzma'), obj)
+        sigs.remove_many(['sig_lzma'])
+        sigs.close()
+
+    def testMigrateWorkflowSignatures(self):
+        '''Test migration of workflow signatures from old layout'''
+        import sqlite3
+        from sos.signatures import WorkflowSignatures
+        os.makedirs('temp/.sos')
+        conn = sqlite3.connect('temp/.sos/workflow_signatures.db')
+        conn.execute('''CREATE TABLE workflows (master_id text,
+            entry_type text, id text, item text)''')
+        conn.executemany('INSERT INTO workflows VALUES (?, ?, ?, ?)', [
+            ('w1', 'placeholder', 'file_target', '/a.txt'),
+            ('w1', 'tracked_files', 'sig1',
+             repr({'input_files': ['/a.txt'], 'output_files': ['/b.txt']})),
+        ])
+        conn.commit()
+        conn.close()
+        exec_dir = env.exec_dir
+        env.exec_dir = os.path.abspath('temp')
+        try:
+            sigs = WorkflowSignatures()
+            self.assertEqual(sigs.files(), [('sig1', {
+                'input_files': ['/a.txt'],
+                'output_files': ['/b.txt']
+            })])
+            self.assertEqual(sigs.placeholders('w1'), ['/a.txt'])
+            self.assertEqual(sigs.records('w1'),
+                             [('placeholder', 'file_target', '/a.txt')])
+            env.config['master_id'] = 'w2'
+            sigs.write('tracked_files', 'sig2', {'input_files': ['/c.txt']})
+            self.assertEqual(sigs.tracked_paths(),
+                             {'/a.txt', '/b.txt', '/c.txt'})
+            sigs.clear()
+            self.assertEqual(sigs.tracked_paths(), {'/a.txt', '/b.txt'})
+            self.assertEqual(
+                sigs.conn.execute('PRAGMA user_version').fetchone()[0], 2)
+            sigs.close()
+        finally:
+            env.exec_dir = exec_dir
+
+    def testSignatureWriterThread(self):
+        '''Test writing signatures with a background thread'''
+        import sqlite3
+        from sos.signatures import StepSignatures
+        sigs = StepSignatures()
+        for i in range(2500):
+            sigs.set(f'sig_writer_{i}', {'i': i})
+        # records are available before they are written
+        self.assertEqual(sigs.get('sig_writer_2499'), {'i': 2499})
+        self.assertEqual(
+            len(sigs.get_many([f'sig_writer_{i}' for i in range(2500)])),
+            2500)
+        sigs.commit()
+        self.assertEqual(sigs._pending, {})
+        conn = sqlite3.connect(sigs.db_file)
+        self.assertEqual(
+            conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+        self.assertEqual(
+            conn.execute(
+                'SELECT COUNT(*) FROM steps WHERE step_id LIKE "sig_writer_%"')
+            .fetchone()[0], 2500)
+        conn.close()
+        self.assertEqual(
+            sigs.remove_many([f'sig_writer_{i}' for i in range(2500)]), 2500)
+        sigs.close()
+        # WAL mode has to be enabled explicitly
+        env.config['sig_journal_mode'] = 'WAL'
+        try:
+            sigs = StepSignatures()
+            sigs.set('sig_writer_wal', {'i': 0})
+            sigs.commit()
+            conn = sqlite3.connect(sigs.db_file)
+            self.assertEqual(
+                conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            conn.close()
+            self.assertEqual(sigs.remove_many(['sig_writer_wal']), 1)
+            sigs.close()
+        finally:
+            env.config['sig_journal_mode'] = 'DELETE'
+        # callers wait for the writer thread if too many records are pending
+        sigs = StepSignatures()
+        sigs._max_pending = 10
+        for i in range(100):
+            sigs.set(f'sig_writer_{i}', {'i': i})
+        self.assertLessEqual(sigs._queue.qsize(), 10)
+        self.assertEqual(
+            len(sigs.get_many([f'sig_writer_{i}' for i in range(100)])), 100)
+        self.assertEqual(
+            sigs.remove_many([f'sig_writer_{i}' for i in range(100)]), 100)
+        sigs.close()
+        # records that cannot be written do not stop the writer thread
+        sigs = StepSignatures()
+        sigs.set('sig_writer_bad', {'i': lambda x: x})
+        sigs.set('sig_writer_good', {'i': 0})
+        sigs.commit()
+        self.assertEqual(sigs._pending, {})
+        self.assertEqual(sigs.get('sig_writer_good'), {'i': 0})
+        self.assertTrue(sigs._writer.is_alive())
+        self.assertEqual(
+            sigs.remove_many(['sig_writer_bad', 'sig_writer_good']), 1)
+        sigs.close()
+
+
 if __name__ == '__main__':
     unittest.main()
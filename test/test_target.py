@@ -692,5 +692,148 @@ assert 'home' in path.names('docker')
                     os.path.join(os.path.expanduser('~'), 'docker.yml')
             }).run()
 
+    def testFileHashCache(self):
+        '''Test caching of file hashes by inode, size, and mtime'''
+        import tempfile
+        from sos.signatures import get_file_hash_cache
+        from sos.targets import default_hash_algorithm, fileMD5
+        exec_dir = env.exec_dir
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # hashes are cached to temp_dir/.sos/file_hashes.db
+            env.exec_dir = temp_dir
+            filename = os.path.join(temp_dir, 'hash_cache.txt')
+            try:
+                with open(filename, 'w') as tmp:
+                    tmp.write('test')
+                # cache hashes only for files that have not been modified
+                # recently
+                os.utime(filename, (1000000000, 1000000000))
+                md5 = fileMD5(filename)
+                self.assertEqual(
+                    get_file_hash_cache().get(
+                        os.stat(filename), algorithm=default_hash_algorithm),
+                    md5)
+                # change content without changing size
+                with open(filename, 'w') as tmp:
+                    tmp.write('TEST')
+                os.utime(filename, (1000000001, 1000000001))
+                self.assertEqual(
+                    get_file_hash_cache().get(
+                        os.stat(filename), algorithm=default_hash_algorithm),
+                    None)
+                self.assertNotEqual(fileMD5(filename), md5)
+            finally:
+                get_file_hash_cache().close()
+                env.exec_dir = exec_dir
+
+    def testHashAlgorithm(self):
+        '''Test file signatures calculated with different algorithms'''
+        import hashlib
+        from sos.targets import (default_hash_algorithm, fileMD5,
+                                 file_hashers, split_file_hash)
+        self.touch('hash_algo.txt')
+        # xxh64 is used by default if xxhash is installed
+        self.assertEqual(
+            fileMD5('hash_algo.txt'),
+            file_hashers[default_hash_algorithm](b'test').hexdigest())
+        self.assertEqual(
+            fileMD5('hash_algo.txt', algorithm='md5'),
+            hashlib.md5(b'test').hexdigest())
+        self.assertEqual(
+            fileMD5('hash_algo.txt', algorithm='blake2b'),
+            'blake2b:' + hashlib.blake2b(b'test').hexdigest())
+        self.assertRaises(ValueError, fileMD5, 'hash_algo.txt', algorithm='unknown')
+        self.assertEqual(split_file_hash('blake2b:abc'), ('blake2b', 'abc'))
+        self.assertEqual(split_file_hash('a' * 32), ('md5', 'a' * 32))
+        # signatures created with one algorithm validate with another
+        sig = file_target('hash_algo.txt').target_signature()
+        env.config['hash_algorithm'] = 'blake2b'
+        try:
+            ft = file_target('hash_algo.txt')
+            self.assertTrue(ft.target_signature()[2].startswith('blake2b:'))
+            self.assertTrue(ft.validate((0, sig[1], sig[2])))
+            self.assertFalse(ft.validate((0, sig[1], 'md5:' + 'a' * 32)))
+        finally:
+            env.config['hash_algorithm'] = None
+
+    def testLegacyFileSignature(self):
+        '''Test untagged signatures created by previous versions of sos'''
+        import hashlib
+        from sos.targets import file_hashers, split_file_hash
+        self.touch('legacy_sig.txt')
+        ft = file_target('legacy_sig.txt')
+        size = os.path.getsize('legacy_sig.txt')
+        # md5 signatures created without xxhash are still matched
+        legacy_md5 = hashlib.md5(b'test').hexdigest()
+        self.assertEqual(split_file_hash(legacy_md5), ('md5', legacy_md5))
+        self.assertTrue(ft.validate((0, size, legacy_md5)))
+        self.assertFalse(ft.validate((0, size, 'a' * 32)))
+        env.config['hash_algorithm'] = 'blake2b'
+        try:
+            self.assertTrue(ft.validate((0, size, legacy_md5)))
+        finally:
+            env.config['hash_algorithm'] = None
+        # xxh64 signatures cannot be matched without xxhash
+        self.assertEqual(split_file_hash('a' * 16), ('xxh64', 'a' * 16))
+        xxh64 = file_hashers.pop('xxh64', None)
+        try:
+            self.assertFalse(ft.validate((0, size, 'a' * 16)))
+        finally:
+            if xxh64 is not None:
+                file_hashers['xxh64'] = xxh64
+
+    def testMapTargets(self):
+        '''Test calculating signatures of targets with a thread pool'''
+        from sos.targets import map_targets, fileMD5
+        files = [f'map_targets_{i}.txt' for i in range(10)]
+        for idx, f in enumerate(files):
+            with open(f, 'w') as tmp:
+                tmp.write(str(idx))
+        self.temp_files.extend(files)
+        targets = [file_target(x) for x in files] + [sos_step('a')]
+        res = map_targets(
+            lambda x: x.target_name()
+            if isinstance(x, sos_step) else fileMD5(x), targets)
+        self.assertEqual(res[:10], [fileMD5(x) for x in files])
+        self.assertEqual(res[10], 'a')
+
+    def testValidateStat(self):
+        '''Test validating files by size and modification time'''
+        from sos.targets import find_failed_target
+        files = [f'validate_stat_{i}.txt' for i in range(4)]
+        for idx, f in enumerate(files):
+            with open(f, 'w') as tmp:
+                tmp.write(str(idx))
+        self.temp_files.extend(files)
+        targets = [file_target(x) for x in files]
+        sigs = [x.target_signature() for x in targets]
+        self.assertTrue(targets[0].validate_stat(sigs[0]))
+        self.assertFalse(targets[0].validate_stat(sigs[1][:1] + (10,) + sigs[1][2:]))
+        self.assertIsNone(targets[0].validate_stat((0,) + sigs[0][1:]))
+        self.assertFalse(file_target('non_existing.txt').validate_stat(sigs[0]))
+        # malformed signatures cannot be validated
+        with self.assertRaises(ValueError):
+            targets[0].validate_stat(sigs[0][:1] + ('size',) + sigs[0][2:])
+        #
+        self.assertEqual(
+            find_failed_target(lambda x: x[0].validate(x[1]),
+                               list(zip(targets, sigs))), (None, []))
+        with open(files[2], 'w') as tmp:
+            tmp.write('9')
+        self.assertEqual(
+            find_failed_target(lambda x: x[0].validate(x[1]),
+                               [(x, (0,) + y[1:]) for x, y in zip(targets, sigs)])[0],
+            2)
+        # exceptions are neither matches nor mismatches
+        for items in ([1], [0, 1, 2, 3]):
+            self.assertEqual(
+                find_failed_target(lambda x: ValueError() if x % 2 else True,
+                                   items),
+                (None, [i for i, x in enumerate(items) if x % 2]))
+        self.assertEqual(
+            find_failed_target(lambda x: ValueError() if x else False,
+                               range(2))[0], 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -146,6 +146,45 @@ class TestTask(unittest.TestCase):
         a.add_result({'ret_code': 5})
         self.assertEqual(a.result['ret_code'], 5)
 
+    def testTaskFileVersion3(self):
+        '''Test reading task files with lzma compressed blocks'''
+        import lzma
+        import pickle
+        import struct
+        task_id = 'fffffffffffffff3'
+        params = TaskParams(
+            name=task_id,
+            global_def={},
+            task='b=a',
+            sos_dict={'a': 3},
+            tags=['c'])
+        a = TaskFile(task_id)
+        params_block = lzma.compress(pickle.dumps(params))
+        now = time.time()
+        with open(a.task_file, 'wb') as fh:
+            fh.write(
+                struct.pack(TaskFile.header_fmt_v3, 3, 0, now, now, 0, 0, 0,
+                            0, 0, 0, len(params_block), 0, 0, 0, 0, 0, 0, 0,
+                            'c'.ljust(120).encode()))
+            fh.write(params_block)
+        try:
+            self.assertEqual(a.version, 3)
+            self.assertEqual(a.tags, 'c')
+            self.assertEqual(a.status, 'new')
+            self.assertEqual(a.params.sos_dict['a'], 3)
+            # the file is upgraded when blocks are added
+            a.add_result({'ret_code': 0})
+            self.assertEqual(a.version, 4)
+            self.assertEqual(a.result['ret_code'], 0)
+            self.assertEqual(a.params.sos_dict['a'], 3)
+        finally:
+            os.remove(a.task_file)
+        a.save(params)
+        try:
+            self.assertEqual(a.version, 4)
+        finally:
+            os.remove(a.task_file)
+
     def testWorkdir(self):
         '''Test workdir option for runtime environment'''
         import tempfile
@@ -1206,6 +1245,49 @@ run: expand=True
         self.assertFalse(os.path.isfile('test.py'))
         self.assertFalse(os.path.isfile('test.py.bak'))
 
+    def testResourceAwareTaskSelection(self):
+        '''Test packing of pending tasks into cores and memory of a host'''
+        from sos.task_engines import BackgroundProcess_TaskEngine
+        engine = BackgroundProcess_TaskEngine(Host('localhost')._host_agent)
+        # tasks are packed only if packing_cores or packing_mem is set
+        self.assertFalse(engine.resource_aware())
+        engine.packing_cores = 4
+        engine.packing_mem = None
+        task_ids = []
+        for idx, cores in enumerate([2, 3, 1, 1]):
+            task_id = f'fffffffffffff{idx}ce'
+            tf = TaskFile(task_id)
+            tf.save(
+                TaskParams(
+                    name=task_id,
+                    global_def={},
+                    task='a=1',
+                    sos_dict={'_runtime': {
+                        'cores': cores
+                    }},
+                    tags=[]))
+            tf.runtime = {'_runtime': {'cores': cores}}
+            task_ids.append(task_id)
+            engine.task_status[task_id] = 'pending'
+        engine.pending_tasks = list(task_ids)
+        self.assertEqual(engine.task_resources(task_ids[1]), (3, 0))
+        # the 3-core task does not fit, the 1-core tasks fill the host
+        self.assertEqual(
+            engine._select_tasks(0), {task_ids[0], task_ids[2], task_ids[3]})
+        # a task larger than the host is admitted if no task is active
+        engine.packing_cores = 1
+        engine.pending_tasks = [task_ids[1]]
+        self.assertEqual(engine._select_tasks(0), {task_ids[1]})
+        # and waits for active tasks otherwise
+        engine.running_tasks = [task_ids[2]]
+        self.assertEqual(engine._select_tasks(1), set())
+        # resources of completed tasks are forgotten
+        engine.update_task_status(task_ids[2], 'completed')
+        self.assertFalse(task_ids[2] in engine._task_resources)
+        self.assertTrue(task_ids[1] in engine._task_resources)
+        for task_id in task_ids:
+            os.remove(TaskFile(task_id).task_file)
+
 
 if __name__ == '__main__':
     unittest.main()
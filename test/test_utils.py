@@ -326,6 +326,492 @@ input: something_unknown, sos_groups(output_from(['C1', 'C2']), by=2), group_by=
         ]:
             self.assertEqual(as_fstring(string), fstring)
 
+    def testEntryPoints(self):
+        '''Test discovery and caching of entry points'''
+        import sos.entrypoints
+        from sos.entrypoints import (clear_entry_points, get_entry_point,
+                                     get_entry_points)
+        from sos.targets import sos_targets
+        clear_entry_points()
+        names = [x.name for x in get_entry_points('sos_actions')]
+        self.assertTrue('sh' in names)
+        self.assertTrue(os.path.isfile(sos.entrypoints._cache_file))
+        self.assertEqual(
+            get_entry_point('sos_targets', 'sos_targets').load(), sos_targets)
+        self.assertIsNone(get_entry_point('sos_targets', 'non_existing'))
+        # read from disk cache
+        sos.entrypoints._entry_points = None
+        self.assertEqual([x.name for x in get_entry_points('sos_actions')],
+                         names)
+        self.assertEqual(get_entry_points('non_existing_group'), [])
+
+    def testRequiredSoSVersion(self):
+        '''Test version of sos required by plugins'''
+        import tempfile
+        from sos.entrypoints import (EntryPoint, get_entry_point,
+                                     required_sos_version)
+        self.assertIsNone(
+            required_sos_version(get_entry_point('sos_actions', 'sh')))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            dist_info = os.path.join(temp_dir, 'sos_fake-1.0.dist-info')
+            os.mkdir(dist_info)
+            with open(os.path.join(dist_info, 'METADATA'), 'w') as metadata:
+                metadata.write('Metadata-Version: 2.1\nName: sos-fake\n'
+                               'Version: 1.0\nRequires-Dist: sos>=99.0\n')
+            with open(os.path.join(dist_info, 'entry_points.txt'), 'w') as eps:
+                eps.write('[sos_actions]\nfake_action = sos_fake:fake_action\n')
+            sys.path.insert(0, temp_dir)
+            try:
+                self.assertEqual(
+                    required_sos_version(
+                        EntryPoint('fake_action', 'sos_fake:fake_action',
+                                   'sos_actions')), '99.0')
+            finally:
+                sys.path.remove(temp_dir)
+
+    def testMessages(self):
+        '''Test encoding and decoding of messages'''
+        import pickle
+        from sos.messages import (decode_msg, encode_msg, message_stats,
+                                  reset_message_stats)
+        reset_message_stats()
+        for msg in [
+                None, [3, 5001, 5002], ['step_sig', 'get', 'a', 'b'], {},
+                ('progress', 'substep_completed', 1),
+                {'context': 'a1b2', 'proc_vars': {'_index': 0}},
+                sos_targets(['a.txt', 'b.txt']),
+                ['large', 'a' * 2000000],
+                ['buffer', pickle.PickleBuffer(bytearray(200000))],
+        ]:
+            decoded = decode_msg(encode_msg(msg))
+            if isinstance(msg, list) and msg[0] == 'buffer':
+                self.assertEqual(bytes(decoded[1]), bytes(200000))
+            else:
+                self.assertEqual(decoded, msg)
+                self.assertEqual(type(decoded), type(msg))
+        # large messages are compressed
+        self.assertLess(len(encode_msg(['large', 'a' * 2000000])), 100000)
+        # messages pickled by previous versions
+        self.assertEqual(decode_msg(pickle.dumps(['a', 1])), ['a', 1])
+        stats = message_stats()
+        self.assertTrue('step_sig' in stats)
+        self.assertTrue('substep' in stats)
+
+    def testMetrics(self):
+        '''Test snapshot of metrics of the controller'''
+        import json
+        import tempfile
+        from sos.metrics import prometheus_text
+        script = SoS_Script('''
+[10]
+input: for_each=dict(i=range(4))
+print(i)
+''')
+        wf = script.workflow()
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.chdir(temp_dir)
+            env.exec_dir = temp_dir
+            try:
+                # metrics are not collected by default
+                Base_Executor(wf).run()
+                self.assertFalse(
+                    os.path.isfile(os.path.join('.sos', 'metrics.json')))
+                env.config['metrics_interval'] = 5
+                Base_Executor(wf).run()
+                with open(os.path.join('.sos', 'metrics.json')) as metrics:
+                    snapshot = json.load(metrics)
+            finally:
+                env.config['metrics_interval'] = None
+                os.chdir(cwd)
+                env.exec_dir = cwd
+        self.assertEqual(
+            sum(x['completed'] for x in snapshot['steps'].values()), 4)
+        self.assertTrue('substep' in snapshot['messages'])
+        self.assertTrue('request.worker_available' in snapshot['latency'])
+        self.assertTrue('utilization' in snapshot['workers'])
+        self.assertTrue('sos_worker_utilization' in prometheus_text(snapshot))
+
+    def testTransport(self):
+        '''Test ipc and tcp transport of sockets'''
+        import zmq
+        from sos.controller import use_ipc_transport
+        env.config['worker_procs'] = ['4', 'localhost:2']
+        self.assertEqual(use_ipc_transport(), zmq.has('ipc'))
+        # remote workers have to connect to tcp ports
+        env.config['worker_procs'] = ['4', 'remote_host:2']
+        self.assertFalse(use_ipc_transport())
+        env.config['worker_procs'] = ['4']
+        script = SoS_Script('''
+[10]
+input: for_each=dict(i=range(2))
+print(i)
+''')
+        wf = script.workflow()
+        for transport in ('ipc', 'tcp'):
+            env.config['transport'] = transport
+            Base_Executor(wf).run()
+            self.assertEqual(
+                env.config['sockets']['master_push'].split(':')[0],
+                transport if zmq.has('ipc') else 'tcp')
+        env.config['transport'] = 'ipc'
+
+    def testSocketPool(self):
+        '''Test reuse of sockets and cached localhost ip'''
+        import zmq
+        import sos.utils
+        from sos.controller import (close_bound_sockets, create_bound_socket,
+                                    release_bound_socket)
+        from sos.utils import get_localhost_ip
+        sos.utils._localhost_ip = None
+        os.environ['SOS_LOCALHOST_IP'] = '127.0.0.1'
+        try:
+            self.assertEqual(get_localhost_ip(), '127.0.0.1')
+        finally:
+            os.environ.pop('SOS_LOCALHOST_IP')
+            sos.utils._localhost_ip = None
+        #
+        sockets = env.config.get('sockets', {})
+        env.config['sockets'] = {}
+        context = zmq.Context()
+        try:
+            socket, address = create_bound_socket(context, zmq.PULL)
+            self.assertTrue(address.startswith('tcp://'))
+            release_bound_socket(context, zmq.PULL, socket, address)
+            self.assertEqual(
+                create_bound_socket(context, zmq.PULL), (socket, address))
+            # sockets that might receive messages are not reused
+            release_bound_socket(
+                context, zmq.PULL, socket, address, reusable=False)
+            new_socket, address = create_bound_socket(context, zmq.PULL)
+            self.assertNotEqual(new_socket, socket)
+            # messages received by released sockets are discarded
+            push_socket = context.socket(zmq.PUSH)
+            push_socket.connect(address)
+            push_socket.send(b'late result')
+            self.assertTrue(new_socket.poll(5000))
+            release_bound_socket(context, zmq.PULL, new_socket, address)
+            self.assertEqual(
+                create_bound_socket(context, zmq.PULL), (new_socket, address))
+            self.assertFalse(new_socket.poll(0))
+            push_socket.close(linger=0)
+            release_bound_socket(context, zmq.PULL, new_socket, address)
+            close_bound_sockets(context)
+        finally:
+            env.config['sockets'] = sockets
+            context.destroy(linger=0)
+
+    def testLayeredConfig(self):
+        '''Test copy-on-write configurations of sub environments'''
+        import pickle
+        from sos.utils import LayeredConfig
+        env.config['sockets'] = {'master_push': 'a'}
+        sockets = env.config['sockets']
+        new_idx, old_idx = env.request_new()
+        try:
+            self.assertIsInstance(env.config, LayeredConfig)
+            self.assertEqual(env.config['run_mode'], 'run')
+            # values obtained before the fork do not alias the shared layer
+            sockets['master_request'] = 'c'
+            self.assertEqual(env.config['sockets'], {'master_push': 'a'})
+            # mutable values are copied only once
+            self.assertIs(env.config['sockets'], env.config['sockets'])
+            # changes are not visible from the parent environment
+            env.config['sockets']['result_push_socket'] = 'b'
+            env.config['run_mode'] = 'dryrun'
+            del env.config['sig_mode']
+            self.assertEqual(env.config['nonexisting'], '')
+            config = pickle.loads(pickle.dumps(env.config))
+            self.assertEqual(config['sockets']['result_push_socket'], 'b')
+            self.assertNotIn('sig_mode', config)
+        finally:
+            env.restore_to_old(new_idx, old_idx)
+        self.assertEqual(env.config['sockets'], {
+            'master_push': 'a',
+            'master_request': 'c'
+        })
+        self.assertIs(env.config['sockets'], sockets)
+        self.assertEqual(env.config['run_mode'], 'run')
+        self.assertIn('sig_mode', env.config)
+
+    def testWorkerIdleTimeout(self):
+        '''Test retirement of idle workers'''
+        from sos.workers import WorkerManager
+        # workers that run substeps of step 10 are idle while step 20, which
+        # has a single substep, is executed
+        script = SoS_Script('''
+[10]
+input: for_each=dict(i=range(4))
+import time
+time.sleep(0.5)
+
+[20]
+input: group_by='all'
+import time
+time.sleep(3)
+
+[30]
+input: for_each=dict(i=range(4))
+print(i)
+''')
+        wf = script.workflow()
+        retired = []
+        retire_worker = WorkerManager._retire_worker
+
+        def record_retirement(manager, identity, pid):
+            retired.append(pid)
+            retire_worker(manager, identity, pid)
+
+        WorkerManager._retire_worker = record_retirement
+        env.config['worker_idle_timeout'] = 0.5
+        try:
+            res = Base_Executor(wf, config={'worker_procs': ['4']}).run()
+        finally:
+            env.config['worker_idle_timeout'] = 60
+            WorkerManager._retire_worker = retire_worker
+        self.assertEqual(res['__completed__']['__step_completed__'], 3)
+        self.assertTrue(retired)
+
+    def testLostRemoteWorker(self):
+        '''Test resubmission of substeps of lost workers on loopback hosts'''
+        import time
+        import zmq
+        from sos.messages import decode_msg, encode_msg
+        from sos.workers import WorkerManager
+        context = zmq.Context()
+        router = context.socket(zmq.ROUTER)
+        router.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        port = router.bind_to_random_port('tcp://127.0.0.1')
+        env.config['worker_heartbeat_timeout'] = 0.5
+        workers = []
+        try:
+            # no local worker so that substeps go to the "remote" workers
+            manager = WorkerManager('0', router)
+            for host in ('127.0.0.2', '127.0.0.3'):
+                worker = context.socket(zmq.DEALER)
+                worker.setsockopt(zmq.IDENTITY, f'{host}:1000'.encode())
+                worker.connect(f'tcp://127.0.0.1:{port}')
+                workers.append(worker)
+
+            def receive_request():
+                self.assertTrue(router.poll(5000))
+                identity, msg = router.recv_multipart()
+                msg = decode_msg(msg)
+                if msg[0] == 'heartbeat':
+                    manager.process_heartbeat(msg[1])
+                else:
+                    manager.process_request(identity, msg[0], msg[1:])
+
+            substep = {'proc_vars': {'step_id': 'a', '_index': 0}}
+            manager.add_request('substep', substep)
+            workers[0].send(encode_msg([0, 'port0']))
+            receive_request()
+            self.assertTrue(workers[0].poll(5000))
+            self.assertEqual(decode_msg(workers[0].recv()), substep)
+            workers[1].send(encode_msg([0, 'port1']))
+            receive_request()
+            # the first worker stops responding and the second one sends
+            # heartbeats
+            time.sleep(0.3)
+            workers[1].send(encode_msg(['heartbeat', '127.0.0.3:1000']))
+            receive_request()
+            time.sleep(0.3)
+            manager.reap_idle_workers()
+            self.assertEqual(manager._lost_workers, {b'127.0.0.2:1000'})
+            # the substep is resubmitted to the idle worker
+            self.assertTrue(workers[1].poll(5000))
+            self.assertEqual(decode_msg(workers[1].recv()), substep)
+            # the lost worker is back
+            workers[0].send(encode_msg([0, 'port0']))
+            receive_request()
+            self.assertEqual(manager._lost_workers, set())
+            # a step is sent to the second worker, which is then lost
+            workers[1].send(encode_msg([0, 'port1']))
+            receive_request()
+            self.assertEqual(manager.worker_available(False, ['port0']), 'port1')
+            step = {'config': {'sockets': {'master_port': 'port1'}}}
+            manager.add_request('step', step)
+            self.assertTrue(workers[1].poll(5000))
+            self.assertEqual(decode_msg(workers[1].recv()), step)
+            time.sleep(0.6)
+            # the step is reported as lost instead of stopping the controller
+            manager.reap_idle_workers()
+            self.assertTrue(b'127.0.0.3:1000' in manager._lost_workers)
+            self.assertEqual(manager.lost_ports(['port0', 'port1']), ['port1'])
+        finally:
+            env.config['worker_heartbeat_timeout'] = 30
+            for worker in workers:
+                worker.close(0)
+            router.close(0)
+            context.term()
+
+    def testResourcePacking(self):
+        '''Test delay of substeps that do not fit into packing_cores'''
+        import zmq
+        from sos.messages import decode_msg, encode_msg
+        from sos.utils import get_localhost_ip
+        from sos.workers import WorkerManager
+        context = zmq.Context()
+        router = context.socket(zmq.ROUTER)
+        router.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        port = router.bind_to_random_port('tcp://127.0.0.1')
+        env.config['packing_cores'] = 2
+        workers = []
+        try:
+            manager = WorkerManager('0', router)
+            for pid in (1001, 1002):
+                worker = context.socket(zmq.DEALER)
+                worker.setsockopt(zmq.IDENTITY,
+                                  f'{get_localhost_ip()}:{pid}'.encode())
+                worker.connect(f'tcp://127.0.0.1:{port}')
+                workers.append(worker)
+
+            def receive_request():
+                self.assertTrue(router.poll(5000))
+                identity, msg = router.recv_multipart()
+                msg = decode_msg(msg)
+                manager.process_request(identity, msg[0], msg[1:])
+
+            # the task of the first step uses both cores
+            big = {'context': 'a', 'proc_vars': {'step_id': 'a', 'n': 2}}
+            small = {'context': 'b', 'proc_vars': {'step_id': 'b'}}
+            manager.add_request('substep', big, {
+                'task': 'run()',
+                'task_params': 'cores=n, mem="1M"'
+            })
+            manager.add_request('substep', small, {'task': ''})
+            workers[0].send(encode_msg([0, 'port0']))
+            receive_request()
+            self.assertTrue(workers[0].poll(5000))
+            self.assertEqual(decode_msg(workers[0].recv()), big)
+            # the second substep waits for the first one although a worker
+            # is available
+            workers[1].send(encode_msg([0, 'port1']))
+            receive_request()
+            self.assertFalse(workers[1].poll(500))
+            # the first substep is completed
+            workers[0].send(encode_msg([0, 'port0']))
+            receive_request()
+            self.assertTrue(workers[1].poll(5000))
+            self.assertEqual(decode_msg(workers[1].recv()), small)
+        finally:
+            env.config['packing_cores'] = None
+            for worker in workers:
+                worker.close(0)
+            router.close(0)
+            context.term()
+
+    def testDeadDaemonWorker(self):
+        '''Test detection of dead workers started by the worker daemon'''
+        import subprocess
+        import zmq
+        from sos.utils import ProcessKilled
+        from sos.workers import WorkerManager
+        context = zmq.Context()
+        router = context.socket(zmq.ROUTER)
+        router.bind_to_random_port('tcp://127.0.0.1')
+        try:
+            manager = WorkerManager('0', router)
+            # pretend that this process is a worker from the daemon
+            manager._daemon_pids.add(os.getpid())
+            manager._num_workers[0] = 1
+            self.assertTrue(manager.has_daemon_workers())
+            manager.check_workers()
+            # a worker that has exited
+            proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+            proc.wait()
+            manager._daemon_pids = {proc.pid}
+            self.assertRaises(ProcessKilled, manager.check_workers)
+            self.assertFalse(manager.has_daemon_workers())
+        finally:
+            router.close(0)
+            context.term()
+
+    def testWorkerPrewarm(self):
+        '''Test prewarmed workers and fallback from worker daemon'''
+        from sos.workers import request_worker_daemon, worker_daemon_address
+        self.assertTrue(worker_daemon_address().startswith('ipc://'))
+        self.assertEqual(worker_daemon_address(), worker_daemon_address('.'))
+        script = SoS_Script('''
+[10]
+input: for_each=dict(i=range(4))
+print(i)
+''')
+        wf = script.workflow()
+        env.config['worker_prewarm'] = True
+        try:
+            Base_Executor(wf).run()
+            # all workers are started before the first job
+            Base_Executor(
+                SoS_Script('''
+[10]
+import os
+import psutil
+with open('prewarm_workers.txt', 'w') as workers:
+    workers.write(str(len(psutil.Process(os.getppid()).children())))
+''').workflow(),
+                config={
+                    'worker_procs': ['3'],
+                    'sig_mode': 'ignore'
+                }).run()
+            with open('prewarm_workers.txt') as workers:
+                self.assertEqual(workers.read(), '3')
+        finally:
+            env.config['worker_prewarm'] = False
+            if os.path.exists('prewarm_workers.txt'):
+                os.remove('prewarm_workers.txt')
+        # workers are started by the master if the daemon is not running
+        self.assertIsNone(request_worker_daemon(['stop']))
+        env.config['worker_daemon'] = True
+        try:
+            Base_Executor(wf).run()
+        finally:
+            env.config['worker_daemon'] = False
+
+    @unittest.skipIf(sys.platform == 'win32', 'Worker daemon requires ipc')
+    def testWorkerDaemon(self):
+        '''Test execution of workflows with workers from the worker daemon'''
+        import multiprocessing as mp
+        import stat
+        import time
+        from sos.workers import (WorkerDaemon, request_worker_daemon,
+                                 worker_daemon_address)
+        address = worker_daemon_address()[6:]
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(address)).st_mode),
+                         0o700)
+        daemon = mp.Process(target=WorkerDaemon().run)
+        daemon.start()
+        try:
+            for i in range(50):
+                if os.path.exists(address):
+                    break
+                time.sleep(0.1)
+            script = SoS_Script('''
+[10]
+input: for_each=dict(i=range(4))
+import os
+with open(f'daemon_worker_{i}.txt', 'w') as ppid:
+    ppid.write(f'{os.getppid()} {os.environ.get("SOS_DAEMON_TEST", "")}')
+''')
+            wf = script.workflow()
+            env.config['worker_daemon'] = True
+            os.environ['SOS_DAEMON_TEST'] = 'from master'
+            try:
+                Base_Executor(wf).run()
+            finally:
+                env.config['worker_daemon'] = False
+                os.environ.pop('SOS_DAEMON_TEST')
+            # workers are forked from the daemon with the environment of
+            # the master process
+            for i in range(4):
+                with open(f'daemon_worker_{i}.txt') as ppid:
+                    self.assertEqual(ppid.read(), f'{daemon.pid} from master')
+                os.remove(f'daemon_worker_{i}.txt')
+        finally:
+            self.assertEqual(request_worker_daemon(['stop']), 'bye')
+            daemon.join(10)
+        self.assertFalse(os.path.exists(address))
+
 
 if __name__ == '__main__':
     unittest.main()